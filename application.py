@@ -7,6 +7,7 @@ from tornado.options import options
 from monstor.app import make_app
 
 from titan.projects.models import User
+from titan.projects.fragments import Fragment
 
 
 settings = {
@@ -17,7 +18,8 @@ settings = {
     'cookie_secret': 'N7qxweo0malDySdP',
     'template_path': os.path.join(os.getcwd(), 'templates'),
     'user_model': User,
-    'login_url': '/login'
+    'login_url': '/login',
+    'ui_modules': {'Fragment': Fragment},
 }
 application = make_app(**settings)
 
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    concurrency
+
+    Measure the throughput of titan under concurrent requests with the
+    database calls run inline on the IOLoop (the old behaviour) and in the
+    database thread pool.
+
+    Needs a running MongoDB. Usage::
+
+        python benchmarks/concurrency.py --requests=2000 --concurrency=50
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+from urllib import urlencode
+
+from tornado import ioloop, httpserver, netutil
+from tornado.httpclient import AsyncHTTPClient
+from tornado.options import define, options, parse_command_line
+from mongoengine.connection import get_connection
+from monstor.app import make_app
+
+from titan.settings import SETTINGS
+from titan.projects import db
+from titan.projects.models import User, Organisation, Team
+
+
+define("requests", default=1000, type=int, help="Requests per run")
+define("concurrency", default=50, type=int, help="Requests in flight")
+define("path", default="/my-organisations/", help="URL to benchmark")
+
+
+def seed():
+    """
+    Create a user who belongs to a handful of organisations
+    """
+    user = User(name="Bench User", email="bench@example.com", active=True)
+    user.set_password("password")
+    user.save(safe=True)
+    for index in xrange(10):
+        organisation = Organisation(
+            name="Organisation %d" % index, slug="org-%d" % index
+        )
+        organisation.save()
+        Team(
+            name="Developers", organisation=organisation, members=[user]
+        ).save()
+
+
+def run(port, cookie):
+    """
+    Fire `options.requests` GET requests at `options.path` keeping
+    `options.concurrency` of them in flight and return the requests served
+    per second.
+    """
+    loop = ioloop.IOLoop.instance()
+    client = AsyncHTTPClient(max_clients=options.concurrency)
+    url = "http://127.0.0.1:%d%s" % (port, options.path)
+    state = {'sent': 0, 'done': 0, 'errors': 0}
+
+    def fire():
+        state['sent'] += 1
+        client.fetch(
+            url, on_response, follow_redirects=False,
+            headers={'Cookie': cookie, 'X-Requested-With': 'XMLHttpRequest'}
+        )
+
+    def on_response(response):
+        state['done'] += 1
+        if response.code != 200:
+            state['errors'] += 1
+        if state['sent'] < options.requests:
+            fire()
+        elif state['done'] == options.requests:
+            loop.stop()
+
+    start = time.time()
+    for _ in xrange(min(options.concurrency, options.requests)):
+        fire()
+    loop.start()
+    elapsed = time.time() - start
+    return options.requests / elapsed, state['errors']
+
+
+def login(port):
+    loop = ioloop.IOLoop.instance()
+    client = AsyncHTTPClient()
+    result = {}
+
+    def on_response(response):
+        result['cookie'] = response.headers.get('Set-Cookie')
+        loop.stop()
+
+    client.fetch(
+        "http://127.0.0.1:%d/login" % port, on_response, method="POST",
+        follow_redirects=False, body=urlencode({
+            'email': 'bench@example.com', 'password': 'password'
+        })
+    )
+    loop.start()
+    return result['cookie']
+
+
+def main():
+    parse_command_line()
+    options.database = 'benchmark_titan'
+    workers = options.db_workers
+
+    SETTINGS['xsrf_cookies'] = False
+    application = make_app(**SETTINGS)
+    seed()
+
+    sockets = netutil.bind_sockets(0, '127.0.0.1')
+    port = sockets[0].getsockname()[1]
+    server = httpserver.HTTPServer(application)
+    server.add_sockets(sockets)
+
+    cookie = login(port)
+    try:
+        for label, count in (('inline', 0), ('executor', workers)):
+            db.shutdown_executor()
+            options.db_workers = count
+            rate, errors = run(port, cookie)
+            print("%-10s workers=%-3d %8.1f req/s  errors=%d" % (
+                label, count, rate, errors
+            ))
+    finally:
+        db.shutdown_executor()
+        get_connection().drop_database('benchmark_titan')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    hydration
+
+    Compare the rows per second of a listing read as mongoengine documents
+    (with and without `only`) and as read only records.
+
+    Needs a running MongoDB. Usage::
+
+        python benchmarks/hydration.py --rows=10000 --repeat=5
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+
+from bson import ObjectId
+from tornado.options import define, options, parse_command_line
+from mongoengine import connect
+from mongoengine.connection import get_connection
+
+from titan.projects.models import Task, to_reference
+from titan.projects.records import TaskRecord
+
+
+define("rows", default=10000, type=int, help="Number of tasks read")
+define("repeat", default=5, type=int, help="Number of reads of each kind")
+
+
+def seed():
+    """
+    Insert `options.rows` raw tasks in one task list and return its id
+    """
+    task_list_id = ObjectId()
+    user_id = ObjectId()
+    user = to_reference(Task, 'assigned_to', user_id)
+    watchers = [to_reference(Task, 'watchers', user_id)]
+    task_list = to_reference(Task, 'task_list', task_list_id)
+    Task._get_collection().insert([
+        {
+            'title': "Task %d" % index,
+            'status': 'new',
+            'assigned_to': user,
+            'watchers': watchers,
+            'task_list': task_list,
+            'follow_ups': [
+                {'message': "Follow up %d" % i, 'time_spent': 60}
+                for i in xrange(5)
+            ],
+            'time_spent': 300,
+        } for index in xrange(options.rows)
+    ])
+    return task_list_id
+
+
+def measure(label, read):
+    best = None
+    for _ in xrange(options.repeat):
+        start = time.time()
+        count = len(read())
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("%-12s %10.0f rows/s" % (label, count / best))
+
+
+def main():
+    parse_command_line()
+    connect('benchmark_titan_hydration')
+    try:
+        task_list_id = seed()
+        queryset = Task.objects(task_list=task_list_id)
+        query = queryset._query
+        measure('documents', lambda: list(queryset.clone()))
+        measure('only', lambda: list(queryset.clone().only(
+            'title', 'status', 'due_date', 'assigned_to', 'task_list',
+            'time_spent'
+        )))
+        measure('records', lambda: TaskRecord.find(query)[0])
+    finally:
+        get_connection().drop_database('benchmark_titan_hydration')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    load
+
+    Drive every URL of the projects app at a fixed concurrency and write
+    the throughput and latency percentiles of each to a JSON file, to be
+    compared between versions.
+
+    The database is seeded with `--organisations` organisations, each with
+    `--teams` teams, `--projects` projects, `--task_lists` task lists per
+    project and `--tasks` tasks per task list. The benchmark user is a
+    member of every team.
+
+    Needs a running MongoDB. Usage::
+
+        python benchmarks/load.py --requests=500 --concurrency=20 \\
+            --output=load.json
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import json
+import time
+import random
+from urllib import urlencode
+
+from tornado import ioloop, httpserver, netutil
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.options import define, options, parse_command_line
+from mongoengine.connection import get_connection
+from monstor.app import make_app
+
+from titan.settings import SETTINGS
+from titan.projects import db
+from titan.projects.models import (User, Organisation, Team, Project,
+    AccessControlList, TaskList, Task, to_reference)
+from titan.projects.urls import HANDLERS
+
+# The benchmarks are scripts, not a package, so the directory of this one
+# is added to the path for it to be importable from anywhere
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# Defines the `requests` and `concurrency` options
+from concurrency import login
+
+
+define("organisations", default=10, type=int, help="Organisations seeded")
+define("teams", default=2, type=int, help="Teams per organisation")
+define("projects", default=5, type=int, help="Projects per organisation")
+define("task_lists", default=3, type=int, help="Task lists per project")
+define("tasks", default=50, type=int, help="Tasks per task list")
+define("output", default="load.json", help="File the results are written to")
+
+#: Words the titles of the tasks are made of
+WORDS = ['design', 'review', 'deploy', 'login', 'report', 'search', 'bug']
+
+
+def seed():
+    """
+    Create the benchmark user and the organisations and return the slugs
+    of the first organisation and its first project
+    """
+    random.seed(0)
+    user = User(name="Bench User", email="bench@example.com", active=True)
+    user.set_password("password")
+    user.save(safe=True)
+    user_ref = to_reference(Task, 'assigned_to', user.id)
+    for index in xrange(options.organisations):
+        organisation = Organisation(
+            name="Organisation %d" % index, slug="org-%d" % index
+        ).save()
+        teams = [
+            Team(
+                name="Team %d" % team_index, organisation=organisation,
+                members=[user]
+            ).save() for team_index in xrange(options.teams)
+        ]
+        for project_index in xrange(options.projects):
+            project = Project(
+                name="Project %d" % project_index,
+                slug="project-%d" % project_index, organisation=organisation,
+                acl=[AccessControlList(team=team, role="admin")
+                    for team in teams]
+            ).save()
+            for task_list_index in xrange(options.task_lists):
+                task_list = TaskList(
+                    name="Version %d" % task_list_index, project=project
+                ).save()
+                tasks = [
+                    {
+                        'title': ' '.join(random.sample(WORDS, 3)),
+                        'status': random.choice(['new', 'resolved']),
+                        'assigned_to': user_ref,
+                        'watchers': [],
+                        'task_list': to_reference(
+                            Task, 'task_list', task_list.id
+                        ),
+                        'follow_ups': [],
+                        'time_spent': 0,
+                        'version': 1,
+                    } for _ in xrange(options.tasks)
+                ]
+                if tasks:
+                    Task._get_collection().insert(tasks)
+    return 'org-0', 'project-0'
+
+
+def get_requests(application, base_url, org, project, attachment_id):
+    """
+    Return a dictionary of the name of every URL in HANDLERS to the
+    keyword arguments of the request which benchmarks it
+    """
+    def url(name, *args, **query):
+        path = application.reverse_url(name, *args)
+        if query:
+            path += '?' + urlencode(query)
+        return base_url + path
+
+    requests = {
+        'home': {'url': url('home')},
+        'metrics': {'url': url('metrics')},
+        'projects.organisations': {'url': url('projects.organisations')},
+        'projects.organisation': {
+            'url': url('projects.organisation', org),
+        },
+        'projects.organisations.slug-check': {
+            'url': url('projects.organisations.slug-check'),
+            'method': 'POST', 'body': urlencode({'slug': 'new-org'}),
+        },
+        'projects.organisations.slug-check-batch': {
+            'url': url('projects.organisations.slug-check-batch'),
+            'method': 'POST',
+            'body': urlencode([('slug', org), ('slug', 'new-org')]),
+        },
+        'projects.organisation.dashboard': {
+            'url': url('projects.organisation.dashboard', org),
+        },
+        'projects.organisation.export': {
+            'url': url('projects.organisation.export', org),
+        },
+        'projects.organisation.search': {
+            'url': url('projects.organisation.search', org, q='deploy'),
+        },
+        'projects.projects': {'url': url('projects.projects', org)},
+        'projects.project': {'url': url('projects.project', org, project)},
+        'projects.project.slug-check': {
+            'url': url('projects.project.slug-check', org),
+            'method': 'POST', 'body': urlencode({'project_slug': project}),
+        },
+        'projects.project.slug-check-batch': {
+            'url': url('projects.project.slug-check-batch', org),
+            'method': 'POST',
+            'body': urlencode([
+                ('project_slug', project), ('project_slug', 'new-project'),
+            ]),
+        },
+        'projects.project.attachments': {
+            'url': url(
+                'projects.project.attachments', org, project,
+                filename='bench.txt'
+            ),
+            'method': 'POST', 'body': 'x' * 64 * 1024,
+        },
+        'projects.project.attachment': {
+            'url': url(
+                'projects.project.attachment', org, project, attachment_id
+            ),
+        },
+        'projects.project.tasks.import': {
+            'url': url('projects.project.tasks.import', org, project),
+            'method': 'POST',
+            'body': '\n'.join(json.dumps({
+                'title': 'Imported %d' % i, 'task_list': 'Version 0',
+                'assigned_to': 'bench@example.com',
+            }) for i in xrange(10)),
+        },
+        'projects.project.search': {
+            'url': url('projects.project.search', org, project, q='deploy'),
+        },
+    }
+    missing = [spec.name for spec in HANDLERS if spec.name not in requests]
+    if missing:
+        raise RuntimeError("No benchmark request for %s" % ', '.join(missing))
+    return requests
+
+
+def percentile(timings, fraction):
+    """
+    The nearest rank percentile of the sorted timings
+    """
+    if not timings:
+        return None
+    return timings[min(int(len(timings) * fraction), len(timings) - 1)]
+
+
+def drive(cookie, request):
+    """
+    Send `options.requests` copies of the request keeping
+    `options.concurrency` in flight and return the throughput and latency
+    of the responses
+    """
+    loop = ioloop.IOLoop.instance()
+    client = AsyncHTTPClient(max_clients=options.concurrency)
+    state = {'sent': 0, 'done': 0, 'errors': 0}
+    latencies = []
+    headers = {'Cookie': cookie, 'X-Requested-With': 'XMLHttpRequest'}
+
+    def fire():
+        state['sent'] += 1
+        client.fetch(HTTPRequest(
+            headers=headers, follow_redirects=False, request_timeout=60,
+            **request
+        ), on_response)
+
+    def on_response(response):
+        state['done'] += 1
+        latencies.append(response.request_time * 1000)
+        if response.code >= 400:
+            state['errors'] += 1
+        if state['sent'] < options.requests:
+            fire()
+        elif state['done'] == options.requests:
+            loop.stop()
+
+    start = time.time()
+    for _ in xrange(min(options.concurrency, options.requests)):
+        fire()
+    loop.start()
+    elapsed = time.time() - start
+    latencies.sort()
+    return {
+        'method': request.get('method', 'GET'),
+        'url': request['url'],
+        'requests': options.requests,
+        'errors': state['errors'],
+        'throughput': options.requests / elapsed,
+        'mean': sum(latencies) / len(latencies),
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+def upload_attachment(base_url, cookie, org, project):
+    """
+    Upload an attachment to benchmark the download, and return its id
+    """
+    loop = ioloop.IOLoop.instance()
+    result = {}
+
+    def on_response(response):
+        result['id'] = json.loads(response.body)['id']
+        loop.stop()
+
+    AsyncHTTPClient().fetch(
+        "%s/%s/%s/+attachments?filename=seed.txt" % (base_url, org, project),
+        on_response, method="POST", body='x' * 1024 * 1024,
+        headers={'Cookie': cookie}
+    )
+    loop.start()
+    return result['id']
+
+
+def main():
+    parse_command_line()
+    options.database = 'benchmark_titan_load'
+
+    SETTINGS['xsrf_cookies'] = False
+    application = make_app(**SETTINGS)
+    org, project = seed()
+
+    sockets = netutil.bind_sockets(0, '127.0.0.1')
+    port = sockets[0].getsockname()[1]
+    server = httpserver.HTTPServer(application)
+    server.add_sockets(sockets)
+    base_url = "http://127.0.0.1:%d" % port
+
+    try:
+        cookie = login(port)
+        attachment_id = upload_attachment(base_url, cookie, org, project)
+        requests = get_requests(
+            application, base_url, org, project, attachment_id
+        )
+        results = {}
+        for spec in HANDLERS:
+            results[spec.name] = result = drive(cookie, requests[spec.name])
+            print("%-42s %8.1f req/s  p50 %7.1fms  p99 %7.1fms  errors=%d" % (
+                spec.name, result['throughput'], result['p50'],
+                result['p99'], result['errors']
+            ))
+        with open(options.output, 'w') as output:
+            json.dump({
+                'settings': dict(
+                    (name, getattr(options, name)) for name in (
+                        'organisations', 'teams', 'projects', 'task_lists',
+                        'tasks', 'requests', 'concurrency', 'db_workers',
+                    )
+                ),
+                'results': results,
+            }, output, indent=2, sort_keys=True)
+    finally:
+        db.shutdown_executor()
+        get_connection().drop_database('benchmark_titan_load')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    search
+
+    Measure the latency of the full text task search on a large number of
+    tasks.
+
+    Needs a running MongoDB. Usage::
+
+        python benchmarks/search.py --tasks=1000000 --queries=1000
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import random
+
+from bson import ObjectId
+from tornado.options import define, options, parse_command_line
+from mongoengine import connect
+from mongoengine.connection import get_connection
+
+from titan.projects.models import Task, to_reference
+from titan.projects.search import search_tasks
+
+
+define("tasks", default=1000000, type=int, help="Number of tasks seeded")
+define("task_lists", default=100, type=int, help="Number of task lists")
+define("queries", default=1000, type=int, help="Number of searches")
+define("seed", default=0, type=int, help="Seed of the random generator")
+
+#: Words the titles and follow up messages are made of
+WORDS = [
+    'design', 'review', 'deploy', 'database', 'index', 'login', 'page',
+    'report', 'invoice', 'customer', 'export', 'import', 'search', 'cache',
+    'release', 'bug', 'crash', 'upgrade', 'migrate', 'test', 'server',
+    'email', 'template', 'settings', 'mobile', 'layout', 'payment', 'api',
+]
+
+#: Number of tasks inserted with one query
+BATCH_SIZE = 5000
+
+
+def sentence(length):
+    return ' '.join(random.choice(WORDS) for _ in xrange(length))
+
+
+def seed():
+    """
+    Insert `options.tasks` raw task documents spread over
+    `options.task_lists` task lists and return the ids of the task lists
+    """
+    user = to_reference(Task, 'assigned_to', ObjectId())
+    task_list_ids = [ObjectId() for _ in xrange(options.task_lists)]
+    task_lists = [
+        to_reference(Task, 'task_list', task_list_id)
+        for task_list_id in task_list_ids
+    ]
+    collection = Task._get_collection()
+    batch = []
+    for index in xrange(options.tasks):
+        batch.append({
+            'title': sentence(random.randint(3, 8)),
+            'status': random.choice(['new', 'in-progress', 'hold', 'resolved']),
+            'assigned_to': user,
+            'watchers': [],
+            'task_list': random.choice(task_lists),
+            'follow_ups': [
+                {'message': sentence(random.randint(5, 15))}
+                for _ in xrange(random.randint(0, 3))
+            ],
+            'time_spent': 0,
+        })
+        if len(batch) == BATCH_SIZE:
+            collection.insert(batch)
+            batch = []
+    if batch:
+        collection.insert(batch)
+    Task.ensure_indexes()
+    return task_list_ids
+
+
+def percentile(timings, fraction):
+    return timings[min(int(len(timings) * fraction), len(timings) - 1)]
+
+
+def main():
+    parse_command_line()
+    random.seed(options.seed)
+    connect('benchmark_titan_search')
+    try:
+        start = time.time()
+        task_list_ids = seed()
+        print("Seeded %d tasks in %.1fs" % (
+            options.tasks, time.time() - start
+        ))
+
+        timings = []
+        for _ in xrange(options.queries):
+            # Search a random tenth of the task lists, like a user with a
+            # role in some of the projects of an organisation.
+            scope = random.sample(
+                task_list_ids, max(1, len(task_list_ids) // 10)
+            )
+            status = random.choice([None, ['new', 'in-progress']])
+            start = time.time()
+            search_tasks(
+                scope, sentence(random.randint(1, 2)), status=status
+            )
+            timings.append((time.time() - start) * 1000)
+        timings.sort()
+        print("p50 %.1fms  p95 %.1fms  p99 %.1fms" % tuple(
+            percentile(timings, f) for f in (0.5, 0.95, 0.99)
+        ))
+    finally:
+        get_connection().drop_database('benchmark_titan_search')
+
+
+if __name__ == '__main__':
+    main()
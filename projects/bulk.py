@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+    bulk
+
+    Bulk import and update of tasks from NDJSON (one JSON object per line)
+
+    Every line describes a task of a project::
+
+        {"title": "Design", "task_list": "Version 0.1",
+         "assigned_to": "user@example.com", "status": "new",
+         "due_date": "2012-12-31", "watchers": ["other@example.com"]}
+
+    `task_list` is the name of a task list of the project, which is
+    created by the first valid line using it if it does not exist. Users
+    are given by email or id. A line with an `id` updates the task with
+    that id (or creates it with that id); the id of a task of another
+    project is an error of the line. Lines are validated and written in batches with unordered bulk
+    writes, and the errors of individual lines are reported without
+    stopping the import.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import json
+from datetime import datetime
+
+from bson import ObjectId, DBRef
+from mongoengine import ValidationError
+from pymongo.errors import BulkWriteError
+
+from .models import User, TaskList, Task, ref_id, version_update
+from .dashboard import get_dashboard_cache
+
+
+#: Formats accepted for the due date
+DATE_FORMATS = ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
+
+#: Fields which an update does not overwrite
+INSERT_ONLY_FIELDS = ['follow_ups', 'time_spent']
+
+#: Fields which are maintained by the update itself
+VERSION_FIELDS = ['version', 'updated_at']
+
+
+class RowError(Exception):
+    """
+    An error in a row of the import
+    """
+
+
+def parse_date(value):
+    if value is None:
+        return None
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    raise RowError("Invalid date: %s" % value)
+
+
+class TaskImporter(object):
+    """
+    Import tasks into a project in batches.
+
+    Feed lines with :meth:`feed`, which returns True when a batch is ready
+    to be written with :meth:`flush`. Call :meth:`flush` once more at the
+    end. Both may query the database.
+
+    :param project: The project the tasks are imported into
+    :param batch_size: Number of rows written with one bulk operation
+    :param max_errors: Maximum number of row errors which are kept
+    """
+
+    def __init__(self, project, batch_size=1000, max_errors=1000):
+        self.project = project
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        self.created = 0
+        self.updated = 0
+        self.failed = 0
+        self.errors = []
+        self.line_number = 0
+        self._rows = []
+        self._task_lists = None
+
+    def error(self, line_number, message):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line_number, 'error': message})
+
+    def feed(self, line):
+        """
+        Add a line of NDJSON. Blank lines are skipped.
+        """
+        self.line_number += 1
+        line = line.strip()
+        if not line:
+            return False
+        try:
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise ValueError("Expected an object")
+        except ValueError as exc:
+            self.error(self.line_number, "Invalid JSON: %s" % exc)
+            return False
+        self._rows.append((self.line_number, row))
+        return len(self._rows) >= self.batch_size
+
+    def get_task_lists(self):
+        """
+        Return a dictionary of the names of the task lists of the project
+        to their ids
+        """
+        if self._task_lists is None:
+            self._task_lists = dict(
+                (t['name'], t['_id']) for t in TaskList._get_collection().find(
+                    TaskList.objects(project=self.project)._query,
+                    {'name': 1}
+                )
+            )
+        return self._task_lists
+
+    def create_task_list(self, name, task_list_id):
+        """
+        Create the task list with the name and id in the project
+        """
+        TaskList(id=task_list_id, name=name, project=self.project).save()
+        self.get_task_lists()[name] = task_list_id
+
+    def find_foreign_tasks(self, rows):
+        """
+        Return the ids given in the rows which belong to tasks of other
+        projects, with one query.
+        """
+        ids = [
+            ObjectId(row['id']) for line_number, row in rows
+            if ObjectId.is_valid(row.get('id'))
+        ]
+        if not ids:
+            return set()
+        task_list_ids = set(self.get_task_lists().values())
+        return set(
+            task['_id'] for task in Task._get_collection().find(
+                {'_id': {'$in': ids}}, {'task_list': 1}
+            ) if ref_id(task['task_list']) not in task_list_ids
+        )
+
+    def resolve_users(self, rows):
+        """
+        Return a dictionary of the emails and ids used in the rows to user
+        ids, with one query.
+        """
+        keys = set()
+        for line_number, row in rows:
+            keys.add(row.get('assigned_to'))
+            keys.update(row.get('watchers') or [])
+        keys.discard(None)
+        ids = [ObjectId(k) for k in keys if ObjectId.is_valid(k)]
+        emails = [k for k in keys if not ObjectId.is_valid(k)]
+        users = {}
+        for user in User._get_collection().find(
+                {'$or': [{'_id': {'$in': ids}}, {'email': {'$in': emails}}]},
+                {'email': 1}):
+            users[unicode(user['_id'])] = user['_id']
+            users[user.get('email')] = user['_id']
+        return users
+
+    def build(self, row, users, foreign_tasks=()):
+        """
+        Build and validate the raw document of the task in a row. A task
+        list which does not exist is only created once the row is valid.
+
+        :param foreign_tasks: Ids of the tasks of other projects
+        """
+        def user_ref(key):
+            try:
+                return DBRef(User._get_collection_name(), users[key])
+            except KeyError:
+                raise RowError("Unknown user: %s" % key)
+
+        if not row.get('task_list'):
+            raise RowError("task_list is required")
+        task_list_id = self.get_task_lists().get(row['task_list'])
+        new_task_list = task_list_id is None
+        if new_task_list:
+            task_list_id = ObjectId()
+        task = Task(
+            title=row.get('title'),
+            status=row.get('status', 'new'),
+            due_date=parse_date(row.get('due_date')),
+            assigned_to=user_ref(row.get('assigned_to')),
+            watchers=[user_ref(w) for w in row.get('watchers') or []],
+            task_list=DBRef(TaskList._get_collection_name(), task_list_id),
+        )
+        if row.get('id') is not None:
+            if not ObjectId.is_valid(row['id']):
+                raise RowError("Invalid id: %s" % row['id'])
+            task.id = ObjectId(row['id'])
+            if task.id in foreign_tasks:
+                raise RowError("Task of another project: %s" % row['id'])
+        task.validate()
+        if new_task_list:
+            self.create_task_list(row['task_list'], task_list_id)
+        return task.to_mongo()
+
+    def flush(self):
+        """
+        Validate the pending rows and write them with one unordered bulk
+        operation.
+        """
+        rows, self._rows = self._rows, []
+        if not rows:
+            return
+        users = self.resolve_users(rows)
+        foreign_tasks = self.find_foreign_tasks(rows)
+
+        bulk = Task._get_collection().initialize_unordered_bulk_op()
+        # Line number of each operation in the bulk write
+        operations = []
+        task_list_ids = set()
+        for line_number, row in rows:
+            try:
+                document = self.build(row, users, foreign_tasks)
+            except (RowError, ValidationError) as exc:
+                self.error(line_number, unicode(exc))
+                continue
+            if '_id' in document:
+                update = version_update({
+                    '$set': dict(
+                        (k, v) for k, v in document.iteritems()
+                        if k != '_id' and k not in INSERT_ONLY_FIELDS
+                        and k not in VERSION_FIELDS
+                    ),
+                    '$setOnInsert': dict(
+                        (k, document[k]) for k in INSERT_ONLY_FIELDS
+                        if k in document
+                    ),
+                })
+                # The task lists in the query keep a task moved to another
+                # project since the check above from being updated; its id
+                # then fails the insert as a duplicate key
+                bulk.find(Task.objects(
+                    id=document['_id'],
+                    task_list__in=self.get_task_lists().values()
+                )._query).upsert().update_one(update)
+            else:
+                document['version'] = 1
+                document['updated_at'] = datetime.utcnow()
+                bulk.insert(document)
+            operations.append(line_number)
+            task_list_ids.add(ref_id(document['task_list']))
+
+        if not operations:
+            return
+        try:
+            result = bulk.execute()
+        except BulkWriteError as exc:
+            result = exc.details
+        self.created += result['nInserted'] + result['nUpserted']
+        self.updated += result['nMatched']
+        for error in result['writeErrors']:
+            self.error(operations[error['index']], error['errmsg'])
+
+        # Bulk writes do not send the document signals
+        TaskList._get_collection().update(
+            {'_id': {'$in': list(task_list_ids)}}, version_update(),
+            multi=True
+        )
+        get_dashboard_cache().invalidate(ref_id(self.project.organisation))
+
+    def result(self):
+        """
+        Return the summary of the import
+        """
+        return {
+            'created': self.created,
+            'updated': self.updated,
+            'failed': self.failed,
+            'errors': self.errors,
+        }
+
+
+def import_tasks(project, lines, batch_size=1000):
+    """
+    Import tasks into the project from an iterable of NDJSON lines and
+    return the summary of the import.
+    """
+    importer = TaskImporter(project, batch_size)
+    for line in lines:
+        if importer.feed(line):
+            importer.flush()
+    importer.flush()
+    return importer.result()
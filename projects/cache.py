@@ -0,0 +1,587 @@
+# -*- coding: utf-8 -*-
+"""
+    cache
+
+    In process caches used by the handlers.
+
+    Each process has its own caches, which the signals of the process keep
+    up to date. Changes made by other processes (see :mod:`titan.server`)
+    are caught by checking the versions stored in MongoDB: a cached
+    :class:`Membership` is only used while the versions of its
+    organisations are unchanged.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+from mongoengine import signals
+from tornado.options import define, options
+
+from .models import (Organisation, Team, Project, ProjectRole, ref_id,
+    membership_changed, RESERVED_ORGANISATION_SLUGS)
+
+
+define(
+    "membership_cache_size", default=10000, type=int,
+    help="Maximum number of users whose membership is cached"
+)
+define(
+    "membership_cache_ttl", default=300, type=int,
+    help="Seconds for which a cached membership is valid. Access granted "
+        "by another process may take this long to show up"
+)
+define(
+    "slug_index_ttl", default=60, type=int,
+    help="Seconds after which the slug index is reloaded. Slugs taken or "
+        "freed by another process may take this long to show up"
+)
+
+
+class LRUCache(object):
+    """
+    A thread safe least recently used cache whose entries also expire after
+    `ttl` seconds.
+
+    The cache is shared between the IOLoop and the database threads, hence
+    the lock. A value computed from the database while an invalidation
+    happens may already be stale, so :meth:`set` can be given the
+    :attr:`generation` read before computing it and drops the value if an
+    invalidation happened since::
+
+        generation = cache.generation
+        cache.set(key, compute(key), generation)
+
+    :param max_size: Maximum number of entries held
+    :param ttl: Seconds after which an entry is considered stale. None
+                disables expiry.
+    """
+
+    def __init__(self, max_size, ttl=None, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        #: Incremented by every invalidation
+        self.generation = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """
+        Return the value for `key` or `default` if it is missing or expired
+        """
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < self.clock():
+                self.misses += 1
+                self.evictions += 1
+                self._removed(key, value)
+                return default
+            # Reinsert to mark the key as the most recently used
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        """
+        Set the value of `key`, evicting the least recently used entries if
+        the cache is full. Returns False, without setting the value, if
+        `generation` is given and the cache was invalidated since.
+        """
+        expires = self.clock() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            self._pop(key)
+            self._data[key] = (expires, value)
+            self._added(key, value)
+            while len(self._data) > self.max_size:
+                key, (expires, value) = self._data.popitem(last=False)
+                self._removed(key, value)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, key):
+        """
+        Remove `key` from the cache if it exists
+        """
+        with self._lock:
+            self.generation += 1
+            if self._pop(key):
+                self.invalidations += 1
+
+    def invalidate_where(self, predicate):
+        """
+        Remove every entry whose value satisfies `predicate`
+        """
+        with self._lock:
+            self.generation += 1
+            keys = [
+                key for key, (expires, value) in self._data.iteritems()
+                if predicate(value)
+            ]
+            for key in keys:
+                self._pop(key)
+            self.invalidations += len(keys)
+
+    def _pop(self, key):
+        """
+        Remove the entry of `key`, with the lock held. Returns True if
+        there was one.
+        """
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return False
+        self._removed(key, entry[1])
+        return True
+
+    def _added(self, key, value):
+        """
+        Called with the lock held when an entry is added
+        """
+
+    def _removed(self, key, value):
+        """
+        Called with the lock held when an entry is removed
+        """
+
+    def values_where(self, predicate):
+        """
+        Return the values of the entries which satisfy `predicate`. The
+        entries are not marked as used.
+        """
+        with self._lock:
+            return [
+                value for expires, value in self._data.itervalues()
+                if predicate(value)
+            ]
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            for key, (expires, value) in self._data.iteritems():
+                self._removed(key, value)
+            self._data.clear()
+
+    def stats(self):
+        """
+        Return the counters of the cache as a dictionary
+        """
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+class MembershipCache(LRUCache):
+    """
+    The cache of :class:`Membership`, which also indexes the cached users
+    by their teams, projects and organisations. A change to one of those
+    invalidates the affected users without scanning the cache.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(MembershipCache, self).__init__(*args, **kwargs)
+        #: Tag (see :meth:`Membership.tags`) to the set of cached user ids
+        self._users = {}
+
+    def _added(self, key, value):
+        for tag in value.tags():
+            self._users.setdefault(tag, set()).add(key)
+
+    def _removed(self, key, value):
+        for tag in value.tags():
+            users = self._users.get(tag)
+            if users is not None:
+                users.discard(key)
+                if not users:
+                    del self._users[tag]
+
+    def invalidate_tagged(self, tags):
+        """
+        Remove the memberships which have any of the tags
+        """
+        with self._lock:
+            self.generation += 1
+            keys = set()
+            for tag in tags:
+                keys.update(self._users.get(tag, ()))
+            for key in keys:
+                self._pop(key)
+            self.invalidations += len(keys)
+
+
+class Membership(object):
+    """
+    The teams, organisations and project roles of a user
+    """
+    __slots__ = ('user_id', 'team_ids', 'organisations', 'project_roles',
+        'organisation_versions')
+
+    def __init__(self, user_id, team_ids, organisations, project_roles,
+            organisation_versions=None):
+        self.user_id = user_id
+
+        #: frozenset of the ids of the teams the user is a member of
+        self.team_ids = team_ids
+
+        #: dictionary of organisation slug to organisation id
+        self.organisations = organisations
+
+        #: dictionary of project id to the effective role of the user
+        self.project_roles = project_roles
+
+        #: dictionary of organisation id to its version when loaded
+        self.organisation_versions = organisation_versions or {}
+
+    @property
+    def organisation_ids(self):
+        return self.organisations.values()
+
+    def organisation_id(self, slug):
+        """
+        Return the id of the organisation with the `slug` if the user is
+        a member, else None
+        """
+        return self.organisations.get(slug)
+
+    def tags(self):
+        """
+        Return the keys under which :class:`MembershipCache` indexes the
+        membership
+        """
+        return [('team', team_id) for team_id in self.team_ids] + \
+            [('project', project_id) for project_id in self.project_roles] + \
+            [('organisation', organisation_id)
+                for organisation_id in self.organisations.itervalues()]
+
+    def is_current(self):
+        """
+        Return True if none of the organisations of the user changed since
+        the membership was loaded, in this process or any other. Changes to
+        the teams and projects of an organisation increment its version
+        once the project roles are rebuilt. One query on the `_id` index.
+        """
+        if not self.organisation_versions:
+            return True
+        versions = dict(
+            (organisation['_id'], organisation.get('version'))
+            for organisation in Organisation._get_collection().find(
+                {'_id': {'$in': self.organisation_versions.keys()}},
+                {'version': 1}
+            )
+        )
+        return versions == self.organisation_versions
+
+    @classmethod
+    def load(cls, user_id, attempts=3):
+        """
+        Build the membership of a user from the database. Only the fields
+        required are fetched. The project roles come from the precomputed
+        :class:`ProjectRole` collection.
+
+        The versions of the organisations are read after the teams, so a
+        team changed in between could leave a stale membership with the
+        new versions. The teams are read again at the end to detect this,
+        and the membership is loaded again if they changed.
+        """
+        team_query = Team.objects(members=user_id)._query
+        for attempt in xrange(attempts):
+            teams = list(Team._get_collection().find(
+                team_query, {'organisation': 1}
+            ))
+            team_ids = frozenset(team['_id'] for team in teams)
+            organisation_ids = list(set(
+                ref_id(team['organisation']) for team in teams
+            ))
+
+            organisations = {}
+            versions = {}
+            if organisation_ids:
+                for organisation in Organisation._get_collection().find(
+                        {'_id': {'$in': organisation_ids}},
+                        {'slug': 1, 'version': 1}):
+                    organisations[organisation['slug']] = organisation['_id']
+                    versions[organisation['_id']] = organisation.get(
+                        'version'
+                    )
+
+            project_roles = dict(
+                (row['project'], row['role'])
+                for row in ProjectRole._get_collection().find(
+                    {'user': user_id}, {'_id': 0, 'project': 1, 'role': 1}
+                )
+            )
+
+            if team_ids == frozenset(
+                    team['_id'] for team in Team._get_collection().find(
+                        team_query, {'_id': 1})):
+                break
+
+        return cls(user_id, team_ids, organisations, project_roles, versions)
+
+
+_membership_cache = None
+
+
+def get_membership_cache():
+    """
+    Return the process wide membership cache, creating it on first use
+    """
+    global _membership_cache
+    if _membership_cache is None:
+        _membership_cache = MembershipCache(
+            options.membership_cache_size, options.membership_cache_ttl
+        )
+    return _membership_cache
+
+
+def get_membership(user_id):
+    """
+    Return the :class:`Membership` of the user, from the cache if it is
+    still current (see :meth:`Membership.is_current`).
+
+    This queries the database and should be called through
+    :func:`titan.projects.db.run` from handlers.
+    """
+    cache = get_membership_cache()
+    membership = cache.get(user_id)
+    if membership is not None and membership.is_current():
+        return membership
+    generation = cache.generation
+    membership = Membership.load(user_id)
+    cache.set(user_id, membership, generation)
+    return membership
+
+
+class SlugIndex(object):
+    """
+    An in process index of the slugs of organisations and projects, which
+    answers the slug availability checks without a database round trip.
+
+    The index is loaded from the database and then updated by the save and
+    delete signals of this process. Slugs taken or freed by other
+    processes are seen when the index is reloaded, every `ttl` seconds.
+    This is acceptable because the check is only advisory; the unique
+    indexes decide when the document is saved.
+
+    The organisations and the projects are loaded separately, on the
+    first check of each after the index expired.
+    """
+
+    def __init__(self, ttl, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self._organisations = set()
+        self._projects = set()
+        #: Time each part was loaded at, by name
+        self._loaded_at = {}
+        #: Slugs added by signals while each part is being loaded
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def is_fresh(self, part):
+        loaded_at = self._loaded_at.get(part)
+        return loaded_at is not None and \
+            self.clock() - loaded_at < self.ttl
+
+    def _load(self, part, slugs):
+        """
+        Replace a part by the slugs read from the database, keeping the
+        ones added by signals while they were read
+        """
+        with self._lock:
+            slugs |= self._pending.pop(part, set())
+            setattr(self, '_' + part, slugs)
+            self._loaded_at[part] = self.clock()
+
+    def _begin_load(self, part):
+        with self._lock:
+            self._pending[part] = set()
+
+    def load_organisations(self):
+        """
+        Load the slugs of the organisations, with one query which the
+        unique index on the slug covers
+        """
+        self._begin_load('organisations')
+        self._load('organisations', set(
+            o['slug'] for o in Organisation._get_collection().find(
+                {}, {'_id': 0, 'slug': 1}
+            )
+        ))
+
+    def load_projects(self):
+        """
+        Load the slugs of the projects, with one query which the unique
+        index on (organisation, slug) covers
+        """
+        self._begin_load('projects')
+        self._load('projects', set(
+            (ref_id(p['organisation']), p['slug'])
+            for p in Project._get_collection().find(
+                {}, {'_id': 0, 'organisation': 1, 'slug': 1}
+            )
+        ))
+
+    def _add(self, part, value):
+        with self._lock:
+            getattr(self, '_' + part).add(value)
+            if part in self._pending:
+                self._pending[part].add(value)
+
+    def _discard(self, part, value):
+        with self._lock:
+            getattr(self, '_' + part).discard(value)
+            if part in self._pending:
+                self._pending[part].discard(value)
+
+    def add_organisation(self, slug):
+        self._add('organisations', slug)
+
+    def discard_organisation(self, slug):
+        self._discard('organisations', slug)
+
+    def add_project(self, organisation_id, slug):
+        self._add('projects', (organisation_id, slug))
+
+    def discard_project(self, organisation_id, slug):
+        self._discard('projects', (organisation_id, slug))
+
+    def has_organisation(self, slug):
+        return slug in self._organisations
+
+    def has_project(self, organisation_id, slug):
+        return (organisation_id, slug) in self._projects
+
+    def clear(self):
+        """
+        Forget the slugs, so that the next check loads them again
+        """
+        with self._lock:
+            self._organisations = set()
+            self._projects = set()
+            self._loaded_at.clear()
+
+
+_slug_index = None
+
+
+def get_slug_index():
+    """
+    Return the process wide slug index, creating it on first use
+    """
+    global _slug_index
+    if _slug_index is None:
+        _slug_index = SlugIndex(options.slug_index_ttl)
+    return _slug_index
+
+
+def organisation_slugs_available(slugs):
+    """
+    Returns a dictionary of each of the slugs to True if no organisation
+    uses it and it is not reserved, from the :class:`SlugIndex`.
+
+    This only queries the database when the index has expired and should
+    be called through :func:`titan.projects.db.run` in that case.
+    """
+    index = get_slug_index()
+    if not index.is_fresh('organisations'):
+        index.load_organisations()
+    return dict(
+        (slug, not index.has_organisation(slug) and
+            slug not in RESERVED_ORGANISATION_SLUGS)
+        for slug in slugs
+    )
+
+
+def project_slugs_available(organisation_id, slugs):
+    """
+    Returns a dictionary of each of the slugs to True if no project in the
+    organisation uses it. See :func:`organisation_slugs_available`.
+    """
+    index = get_slug_index()
+    if not index.is_fresh('projects'):
+        index.load_projects()
+    return dict(
+        (slug, not index.has_project(organisation_id, slug))
+        for slug in slugs
+    )
+
+
+# Invalidation hooks
+#
+# A change to a team affects its current members, and also the users who
+# were removed from it, which are found by the team id in their cached
+# membership.
+
+def team_changed(sender, document, **kwargs):
+    cache = get_membership_cache()
+    for member in document.members:
+        cache.invalidate(getattr(member, 'id', member))
+    cache.invalidate_tagged([('team', document.id)])
+
+
+def project_changed(sender, document, **kwargs):
+    get_membership_cache().invalidate_tagged(
+        [('project', document.id)] +
+        [('team', ref_id(acl.team)) for acl in document.acl]
+    )
+
+
+def organisation_changed(sender, document, **kwargs):
+    get_membership_cache().invalidate_tagged(
+        [('organisation', document.id)]
+    )
+
+
+# Teams and projects are invalidated once their project roles are rebuilt
+membership_changed.connect(team_changed, sender=Team)
+membership_changed.connect(project_changed, sender=Project)
+for signal in (signals.post_save, signals.post_delete):
+    signal.connect(organisation_changed, sender=Organisation)
+
+
+# Keeping the slug index up to date
+
+def organisation_saved(sender, document, **kwargs):
+    get_slug_index().add_organisation(document.slug)
+
+
+def organisation_deleted(sender, document, **kwargs):
+    get_slug_index().discard_organisation(document.slug)
+
+
+def project_saved(sender, document, **kwargs):
+    get_slug_index().add_project(ref_id(document.organisation), document.slug)
+
+
+def project_deleted(sender, document, **kwargs):
+    get_slug_index().discard_project(
+        ref_id(document.organisation), document.slug
+    )
+
+
+signals.post_save.connect(organisation_saved, sender=Organisation)
+signals.post_delete.connect(organisation_deleted, sender=Organisation)
+signals.post_save.connect(project_saved, sender=Project)
+signals.post_delete.connect(project_deleted, sender=Project)
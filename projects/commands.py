@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+    commands
+
+    Maintenance commands which can be run with titand::
+
+        titand ensure_indexes
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from gridfs import GridFS
+from mongoengine.connection import get_db
+
+from .models import (Organisation, Team, Project, TaskList, Task,
+    FollowUpRecord, ProjectRole)
+from .export import FORMATS, iter_export
+from .generate import Generator
+
+
+#: Registry of command name to the function implementing it
+COMMANDS = {}
+
+
+def command(func):
+    """
+    Register `func` as a titand command under its own name
+    """
+    COMMANDS[func.__name__] = func
+    return func
+
+
+def run_command(name, args):
+    """
+    Run the command `name` with the remaining command line arguments
+    """
+    try:
+        func = COMMANDS[name]
+    except KeyError:
+        sys.stderr.write(
+            "Unknown command %s. Available commands: %s\n" % (
+                name, ', '.join(sorted(COMMANDS))
+            )
+        )
+        return 1
+    return func(*args) or 0
+
+
+#: Models whose declared indexes are managed by ensure_indexes
+MODELS = [
+    Organisation, Team, Project, TaskList, Task, FollowUpRecord, ProjectRole
+]
+
+#: The query shapes used by the application. Each entry is a model, the
+#: keyword arguments of a representative query against it and optionally
+#: the sort of the query.
+QUERY_PATTERNS = [
+    (Organisation, {'slug': 'slug'}),
+    (Team, {'members': ObjectId()}),
+    (Team, {'organisation': ObjectId()}),
+    (Team, {'members': ObjectId(), 'organisation': ObjectId()}),
+    (Project, {'organisation': ObjectId(), 'slug': 'slug'}),
+    (Project, {'organisation': ObjectId()}),
+    (Project, {'organisation': ObjectId(), 'id__gt': ObjectId()}, '_id'),
+    (Project, {'acl__team__in': [ObjectId()]}),
+    (TaskList, {'project': ObjectId()}),
+    (TaskList, {'project': ObjectId(), 'id__gt': ObjectId()}, '_id'),
+    (Task, {'task_list': ObjectId()}),
+    (Task, {'task_list': ObjectId(), 'status': 'new'}),
+    (Task, {
+        'task_list__in': [ObjectId()], 'status__ne': 'resolved',
+        'due_date__lt': datetime.utcnow(),
+    }),
+    (Task, {'assigned_to': ObjectId()}),
+    (Task, {'status': 'new'}),
+    (FollowUpRecord, {'task': ObjectId()}),
+    (ProjectRole, {'user': ObjectId(), 'project': ObjectId()}),
+    (ProjectRole, {'user': ObjectId(), 'organisation': ObjectId()}),
+    (ProjectRole, {'project': ObjectId()}),
+]
+
+
+def is_collection_scan(plan):
+    """
+    Return True if the explain output of a query shows a collection scan.
+    Understands the output of both the legacy (`BasicCursor`) and the
+    query planner (`COLLSCAN`) formats.
+    """
+    if isinstance(plan, dict):
+        if plan.get('cursor') == 'BasicCursor' or \
+                plan.get('stage') == 'COLLSCAN':
+            return True
+        return any(is_collection_scan(value) for value in plan.values())
+    if isinstance(plan, (list, tuple)):
+        return any(is_collection_scan(value) for value in plan)
+    return False
+
+
+def is_sorted_in_memory(plan):
+    """
+    Return True if the explain output of a query shows that the results
+    are sorted in memory instead of read in the order of an index. Both
+    the legacy (`scanAndOrder`) and the query planner (`SORT`) formats are
+    understood.
+    """
+    if isinstance(plan, dict):
+        if plan.get('scanAndOrder') is True or plan.get('stage') == 'SORT':
+            return True
+        return any(is_sorted_in_memory(value) for value in plan.values())
+    if isinstance(plan, (list, tuple)):
+        return any(is_sorted_in_memory(value) for value in plan)
+    return False
+
+
+def collection_scans():
+    """
+    Explain every query in :data:`QUERY_PATTERNS` and return a list of
+    (model, query) which do not use an index, or do not use one for their
+    sort.
+    """
+    scans = []
+    for pattern in QUERY_PATTERNS:
+        model, kwargs = pattern[:2]
+        query = model.objects(**kwargs)._query
+        cursor = model._get_collection().find(query)
+        if len(pattern) > 2:
+            cursor = cursor.sort(pattern[2])
+        plan = cursor.explain()
+        if is_collection_scan(plan) or is_sorted_in_memory(plan):
+            scans.append((model, query))
+    return scans
+
+
+@command
+def ensure_indexes():
+    """
+    Build the indexes declared in the `meta` of every model, in the
+    background so that a deployment does not lock the collections, and
+    report the application queries which still scan a collection or sort
+    in memory.
+    """
+    for model in MODELS:
+        collection = model._get_collection()
+        for spec in model._meta['index_specs']:
+            spec = dict(spec)
+            fields = spec.pop('fields')
+            spec['background'] = True
+            name = collection.ensure_index(fields, **spec)
+            sys.stdout.write(
+                "%s: ensured index %s\n" % (collection.name, name)
+            )
+
+    scans = collection_scans()
+    for model, query in scans:
+        sys.stdout.write(
+            "%s: collection scan or in memory sort for %r\n" % (
+                model._get_collection().name, query
+            )
+        )
+    if not scans:
+        sys.stdout.write("No collection scans\n")
+    return 0
+
+
+@command
+def rebuild_project_roles():
+    """
+    Recompute the effective roles of the users in every project. Needed
+    once for projects created before the roles were maintained.
+    """
+    count = 0
+    for project in Project._get_collection().find({}, {'_id': 1}):
+        ProjectRole.rebuild(project['_id'])
+        count += 1
+    sys.stdout.write("Rebuilt the roles of %d projects\n" % count)
+    return 0
+
+
+@command
+def record_follow_ups():
+    """
+    Copy the embedded follow ups of the tasks created before the history
+    of follow ups was kept to that history. Tasks are otherwise recorded
+    when a follow up is first added to them.
+    """
+    tasks = count = 0
+    for task in Task._get_collection().find(
+            {'follow_ups_recorded': {'$ne': True}}, {'_id': 1}):
+        count += Task.record_follow_ups(task['_id'])
+        tasks += 1
+    sys.stdout.write(
+        "Recorded %d follow ups of %d tasks\n" % (count, tasks)
+    )
+    return 0
+
+
+@command
+def remove_orphan_attachments(hours='24'):
+    """
+    Remove the files uploaded to projects more than `hours` ago which are
+    not attached to any follow up, such as uploads whose follow up was
+    never written::
+
+        titand remove_orphan_attachments 48
+    """
+    referenced = set()
+    for record in FollowUpRecord._get_collection().find(
+            {'follow_up.attachments.0': {'$exists': True}},
+            {'follow_up.attachments': 1}):
+        referenced.update(record['follow_up']['attachments'])
+    for task in Task._get_collection().find(
+            {'follow_ups.attachments.0': {'$exists': True}},
+            {'follow_ups.attachments': 1}):
+        for follow_up in task['follow_ups']:
+            referenced.update(follow_up.get('attachments', []))
+
+    grid_fs = GridFS(get_db(), collection='fs')
+    cutoff = datetime.utcnow() - timedelta(hours=int(hours))
+    count = 0
+    for grid_file in get_db()['fs.files'].find(
+            {'project': {'$exists': True}, 'uploadDate': {'$lt': cutoff}},
+            {'_id': 1}):
+        if grid_file['_id'] not in referenced:
+            grid_fs.delete(grid_file['_id'])
+            count += 1
+    sys.stdout.write("Removed %d orphan attachments\n" % count)
+    return 0
+
+
+@command
+def export(organisation_slug, format='ndjson'):
+    """
+    Write the export of every project of an organisation to stdout::
+
+        titand export openlabs csv > openlabs.csv
+    """
+    if format not in FORMATS:
+        sys.stderr.write("Unknown format %s\n" % format)
+        return 1
+    organisation = Organisation.objects(slug=organisation_slug).first()
+    if organisation is None:
+        sys.stderr.write("No organisation %s\n" % organisation_slug)
+        return 1
+    for part in iter_export(organisation.id, format):
+        sys.stdout.write(part)
+    return 0
+
+
+@command
+def generate(organisations, tasks, seed='0'):
+    """
+    Generate synthetic organisations with `tasks` tasks in total, for
+    benchmarks and capacity tests. The same seed generates the same data::
+
+        titand --database=titan_capacity generate 5000 10000000 42
+    """
+    counts = Generator(
+        int(organisations), int(tasks), seed=int(seed),
+        log=lambda message: sys.stdout.write(message + '\n')
+    ).run()
+    for name, count in sorted(counts.iteritems()):
+        sys.stdout.write("%s: %d\n" % (name, count))
+    return 0
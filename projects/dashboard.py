@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+    dashboard
+
+    Overview of the projects and tasks of an organisation.
+
+    The task counts are computed by a single aggregation pipeline over the
+    tasks of the organisation, and the result is cached. Status changes
+    made with :meth:`~titan.projects.models.Task.change_status` are applied
+    to the cached dashboards; any other change to a task invalidates them.
+
+    Whether a task is overdue changes with the time alone, so the overdue
+    tasks are not cached but counted when the dashboard is read.
+
+    Every change to the tasks of a task list increments the version of the
+    task list, and changes to the projects increment the version of the
+    organisation. A cached dashboard is only used while these versions are
+    the ones it was computed from, so changes made by other processes are
+    seen on the next request.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import threading
+from datetime import datetime
+
+from mongoengine import signals
+from tornado.options import define, options
+
+from .models import (Organisation, Project, TaskList, Task, STATUS_CHOICES,
+    aggregate, ref_id, task_status_changed)
+from .cache import LRUCache
+
+
+define(
+    "dashboard_cache_size", default=1000, type=int,
+    help="Maximum number of organisation dashboards cached"
+)
+define(
+    "dashboard_cache_ttl", default=60, type=int,
+    help="Seconds for which a cached dashboard is valid"
+)
+
+#: The status of tasks which are closed. Every other status is open.
+CLOSED_STATUS = 'resolved'
+
+
+class Dashboard(object):
+    """
+    Task counts of an organisation
+    """
+
+    def __init__(self, organisation_id, projects, task_lists,
+            organisation_version=None, task_list_versions=None):
+        self.organisation_id = organisation_id
+
+        #: The version of the organisation the dashboard was computed from
+        self.organisation_version = organisation_version
+
+        #: Dictionary of task list id to the version it was computed from
+        self.task_list_versions = task_list_versions or {}
+
+        #: List of (id, name, slug) of the projects
+        self.projects = projects
+
+        #: Dictionary of task list id to project id
+        self.task_lists = task_lists
+
+        #: Number of tasks in each status
+        self.status = dict((status, 0) for status, _ in STATUS_CHOICES)
+
+        #: Number of tasks in each status, by project id
+        self.project_status = dict(
+            (project_id, dict(self.status)) for project_id, _, _ in projects
+        )
+
+        #: Number of open tasks by the id of the user they are assigned to
+        self.assignees = {}
+
+        self._lock = threading.Lock()
+
+    def add(self, task_list_id, status, assigned_to, count):
+        """
+        Add `count` (which may be negative) tasks to the counters
+        """
+        project_id = self.task_lists.get(task_list_id)
+        if project_id is None:
+            return
+        self.status[status] = self.status.get(status, 0) + count
+        project_status = self.project_status[project_id]
+        project_status[status] = project_status.get(status, 0) + count
+        if status != CLOSED_STATUS:
+            self.assignees[assigned_to] = \
+                self.assignees.get(assigned_to, 0) + count
+            if not self.assignees[assigned_to]:
+                del self.assignees[assigned_to]
+
+    def change_status(self, previous, status, task_list_version):
+        """
+        Move a task from its previous status to `status`. The change is
+        only applied if the dashboard has the version of the task list
+        which precedes it, otherwise the dashboard is left to be found
+        stale by :meth:`is_current`.
+
+        :param previous: The raw document of the task before the change
+        :param task_list_version: The version of the task list after the
+                                  change
+        """
+        task_list_id = ref_id(previous['task_list'])
+        assigned_to = ref_id(previous['assigned_to'])
+        with self._lock:
+            if task_list_version is None or \
+                    self.task_list_versions.get(task_list_id) != \
+                    task_list_version - 1:
+                return
+            self.task_list_versions[task_list_id] = task_list_version
+            self.add(task_list_id, previous['status'], assigned_to, -1)
+            self.add(task_list_id, status, assigned_to, 1)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'projects': [
+                    {
+                        'id': project_id,
+                        'name': name,
+                        'slug': slug,
+                        'status': dict(self.project_status[project_id]),
+                    } for project_id, name, slug in self.projects
+                ],
+                'status': dict(self.status),
+                'assignees': [
+                    {'id': user_id, 'open': count}
+                    for user_id, count in sorted(
+                        self.assignees.iteritems(), key=lambda i: -i[1]
+                    )
+                ],
+            }
+
+    def count_overdue(self, now=None):
+        """
+        Return the number of open tasks past their due date, with one
+        count query on the index of the due dates of the task lists
+        """
+        if not self.task_lists:
+            return 0
+        return Task._get_collection().find(Task.objects(
+            task_list__in=self.task_lists.keys(),
+            status__ne=CLOSED_STATUS,
+            due_date__lt=now or datetime.utcnow(),
+        )._query).count()
+
+    def is_current(self):
+        """
+        Return True if neither the organisation nor the task lists of its
+        projects changed since the dashboard was computed, in this process
+        or any other. Two queries returning only the versions.
+        """
+        organisation = Organisation._get_collection().find_one(
+            {'_id': self.organisation_id}, {'version': 1}
+        )
+        if organisation is None or \
+                organisation.get('version') != self.organisation_version:
+            return False
+        if not self.projects:
+            return True
+        versions = dict(
+            (t['_id'], t.get('version'))
+            for t in TaskList._get_collection().find(
+                TaskList.objects(
+                    project__in=[p[0] for p in self.projects]
+                )._query,
+                {'version': 1}
+            )
+        )
+        with self._lock:
+            return versions == self.task_list_versions
+
+    @classmethod
+    def load(cls, organisation_id):
+        """
+        Compute the dashboard of an organisation. The projects and task
+        lists are read with projected queries and the tasks are counted by
+        one aggregation pipeline, grouped by task list, status and
+        assignee.
+        """
+        # The versions are read before the data they cover, so that a
+        # change made while loading makes the dashboard stale
+        organisation = Organisation._get_collection().find_one(
+            {'_id': organisation_id}, {'version': 1}
+        )
+        projects = [
+            (p['_id'], p['name'], p['slug'])
+            for p in Project._get_collection().find(
+                Project.objects(organisation=organisation_id)._query,
+                {'name': 1, 'slug': 1}
+            ).sort('name')
+        ]
+        task_lists, task_list_versions = {}, {}
+        for task_list in TaskList._get_collection().find(
+                TaskList.objects(
+                    project__in=[p[0] for p in projects]
+                )._query,
+                {'project': 1, 'version': 1}):
+            task_lists[task_list['_id']] = ref_id(task_list['project'])
+            task_list_versions[task_list['_id']] = task_list.get('version')
+        dashboard = cls(
+            organisation_id, projects, task_lists,
+            organisation and organisation.get('version'), task_list_versions
+        )
+        if not task_lists:
+            return dashboard
+
+        pipeline = [
+            {'$match': Task.objects(
+                task_list__in=task_lists.keys()
+            )._query},
+            {'$group': {
+                '_id': {
+                    'task_list': '$task_list',
+                    'status': '$status',
+                    'assigned_to': '$assigned_to',
+                },
+                'count': {'$sum': 1},
+            }},
+        ]
+        for row in aggregate(Task, pipeline):
+            key = row['_id']
+            dashboard.add(
+                ref_id(key['task_list']), key['status'],
+                ref_id(key['assigned_to']), row['count']
+            )
+        return dashboard
+
+
+_dashboard_cache = None
+
+
+def get_dashboard_cache():
+    """
+    Return the process wide dashboard cache, creating it on first use
+    """
+    global _dashboard_cache
+    if _dashboard_cache is None:
+        _dashboard_cache = LRUCache(
+            options.dashboard_cache_size, options.dashboard_cache_ttl
+        )
+    return _dashboard_cache
+
+
+def get_dashboard(organisation_id):
+    """
+    Return the :class:`Dashboard` of the organisation, from the cache if it
+    is still current (see :meth:`Dashboard.is_current`). This queries the
+    database and should be called through :func:`titan.projects.db.run`
+    from handlers.
+    """
+    cache = get_dashboard_cache()
+    dashboard = cache.get(organisation_id)
+    if dashboard is not None and dashboard.is_current():
+        return dashboard
+    generation = cache.generation
+    dashboard = Dashboard.load(organisation_id)
+    cache.set(organisation_id, dashboard, generation)
+    return dashboard
+
+
+def get_dashboard_summary(organisation_id, now=None):
+    """
+    Return the counts of the dashboard of the organisation as a dictionary,
+    with the number of overdue tasks at `now`. This queries the database
+    and should be called through :func:`titan.projects.db.run` from
+    handlers.
+    """
+    dashboard = get_dashboard(organisation_id)
+    summary = dashboard.as_dict()
+    summary['overdue'] = dashboard.count_overdue(now)
+    return summary
+
+
+# Keeping the cached dashboards up to date
+
+def status_changed(task, previous, task_list_version=None, **kwargs):
+    task_list_id = ref_id(previous['task_list'])
+    for dashboard in get_dashboard_cache().values_where(
+            lambda d: task_list_id in d.task_lists):
+        dashboard.change_status(previous, task.status, task_list_version)
+
+
+def task_changed(sender, document, **kwargs):
+    task_list_id = ref_id(document.task_list)
+    get_dashboard_cache().invalidate_where(
+        lambda d: task_list_id in d.task_lists
+    )
+
+
+def project_changed(sender, document, **kwargs):
+    get_dashboard_cache().invalidate(ref_id(document.organisation))
+
+
+def task_list_changed(sender, document, **kwargs):
+    get_dashboard_cache().invalidate_where(
+        lambda d: ref_id(document.project) in d.project_status
+    )
+
+
+task_status_changed.connect(status_changed)
+for signal in (signals.post_save, signals.post_delete):
+    signal.connect(task_changed, sender=Task)
+    signal.connect(project_changed, sender=Project)
+    signal.connect(task_list_changed, sender=TaskList)
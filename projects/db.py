@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+    db
+
+    Run blocking mongoengine calls off the IOLoop.
+
+    mongoengine (and pymongo under it) is synchronous, so a query issued
+    from a handler blocks every other connection served by the process.
+    The helpers here push such calls to a bounded pool of threads and hand
+    back a future which a `tornado.gen.coroutine` handler can yield on.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from functools import partial, wraps
+
+from concurrent.futures import ThreadPoolExecutor, Future
+from tornado.options import define, options
+
+from .instrumentation import get_current_stats, run_with_stats
+
+
+define(
+    "db_workers", default=10, type=int,
+    help="Number of threads used for database access. 0 runs queries "
+        "inline on the IOLoop"
+)
+
+_executor = None
+
+
+def get_executor():
+    """
+    Return the process wide executor used for database access, creating it
+    on first use. Returns None when `db_workers` is 0.
+    """
+    global _executor
+    if options.db_workers <= 0:
+        return None
+    if _executor is None:
+        _executor = ThreadPoolExecutor(options.db_workers)
+    return _executor
+
+
+def shutdown_executor(wait=True):
+    """
+    Shutdown the executor (if any). A new one is created by the next call
+    to :func:`get_executor`, which is what forked workers rely on.
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait)
+        _executor = None
+
+
+def backlog():
+    """
+    Return the number of calls waiting for a database thread, or None when
+    queries run inline
+    """
+    if _executor is None:
+        return None
+    return _executor._work_queue.qsize()
+
+
+def run(func, *args, **kwargs):
+    """
+    Run `func` with the given arguments in the database thread pool and
+    return a future for the result.
+
+    The callable should return fully evaluated data (lists, documents) and
+    not lazy querysets, since those would hit the database when iterated
+    on the IOLoop::
+
+        projects = yield db.run(
+            lambda: list(Project.objects(organisation=organisation))
+        )
+
+    The queries are recorded in the stats of the current request (see
+    :mod:`titan.projects.instrumentation`).
+
+    :param func: The callable which does the blocking work
+    :return: A `concurrent.futures.Future`
+    """
+    executor = get_executor()
+    if executor is not None:
+        stats = get_current_stats()
+        if stats is not None:
+            return executor.submit(
+                run_with_stats, stats, func, *args, **kwargs
+            )
+        return executor.submit(func, *args, **kwargs)
+
+    # Inline mode, keeps the old behaviour around for benchmarks and
+    # debugging.
+    future = Future()
+    try:
+        future.set_result(func(*args, **kwargs))
+    except Exception as exc:
+        future.set_exception(exc)
+    return future
+
+
+def wrap(func):
+    """
+    Decorator form of :func:`run`. Calling the decorated function returns a
+    future instead of the result::
+
+        @db.wrap
+        def get_project(organisation, slug):
+            return Project.objects(organisation=organisation, slug=slug).first()
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return run(partial(func, *args, **kwargs))
+    return wrapper
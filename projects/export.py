@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+    export
+
+    Export the projects, task lists, tasks and follow ups of an
+    organisation as NDJSON or CSV.
+
+    The documents are read as raw documents with server side cursors and
+    written out one record at a time, so memory use does not depend on the
+    size of the organisation. References are written as ids and are never
+    dereferenced.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import csv
+from cStringIO import StringIO
+
+from .models import Project, TaskList, Task, FollowUpRecord
+from .serialise import clean, dumps
+
+
+#: Supported formats and their content types
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+#: Columns of the CSV export. Every record type uses the columns which
+#: apply to it.
+CSV_COLUMNS = [
+    'type', 'id', 'parent', 'name', 'slug', 'status', 'assigned_to',
+    'due_date', 'time_spent', 'message',
+]
+
+#: Number of tasks whose follow ups are read with one query
+FOLLOW_UP_BATCH = 1000
+
+
+def iter_follow_ups(task_ids):
+    """
+    Yield the follow up history of the tasks as follow up records
+    """
+    if not task_ids:
+        return
+    query = FollowUpRecord.objects(task__in=task_ids)._query
+    records = FollowUpRecord._get_collection().find(query)
+    for record in records:
+        yield 'follow_up', dict(
+            record['follow_up'], _id=record['_id'], task=record['task']
+        )
+
+
+def iter_records(organisation_id, project_ids=None):
+    """
+    Yield (type, raw document) for every project of the organisation and
+    everything under it, parents before children.
+
+    :param organisation_id: Id of the organisation to export
+    :param project_ids: Optionally restrict the export to these projects
+    """
+    query = Project.objects(organisation=organisation_id)._query
+    if project_ids is not None:
+        query['_id'] = {'$in': list(project_ids)}
+    projects = Project._get_collection().find(query)
+    for project in projects:
+        yield 'project', project
+        task_lists = TaskList._get_collection().find(
+            TaskList.objects(project=project['_id'])._query
+        )
+        for task_list in task_lists:
+            yield 'task_list', task_list
+            task_ids = []
+            tasks = Task._get_collection().find(
+                Task.objects(task_list=task_list['_id'])._query
+            )
+            for task in tasks:
+                follow_ups = task.pop('follow_ups', [])
+                recorded = task.pop('follow_ups_recorded', False)
+                yield 'task', task
+                if not Task.MAX_EMBEDDED_FOLLOW_UPS or not recorded:
+                    # Every follow up is embedded, or the task predates
+                    # the history and its embedded follow ups are all it
+                    # has
+                    for follow_up in follow_ups:
+                        yield 'follow_up', dict(follow_up, task=task['_id'])
+                    continue
+                task_ids.append(task['_id'])
+                if len(task_ids) >= FOLLOW_UP_BATCH:
+                    for record in iter_follow_ups(task_ids):
+                        yield record
+                    task_ids = []
+            for record in iter_follow_ups(task_ids):
+                yield record
+
+
+def to_ndjson(record_type, document):
+    document = clean(document)
+    document['type'] = record_type
+    return dumps(document) + '\n'
+
+
+def to_csv_row(record_type, document):
+    """
+    Map a record to the :data:`CSV_COLUMNS`
+    """
+    document = clean(document)
+    if record_type == 'project':
+        parent = document.get('organisation')
+    elif record_type == 'task_list':
+        parent = document.get('project')
+    elif record_type == 'task':
+        parent = document.get('task_list')
+    else:
+        parent = document.get('task')
+    return [
+        record_type,
+        document.get('id'),
+        parent,
+        document.get('name', document.get('title')),
+        document.get('slug'),
+        document.get('status', document.get('to_status')),
+        document.get('assigned_to'),
+        document.get('due_date', document.get('to_due_date')),
+        document.get('time_spent'),
+        document.get('message'),
+    ]
+
+
+def iter_export(organisation_id, format='ndjson', project_ids=None):
+    """
+    Yield the export of the organisation as strings of encoded text, one
+    record at a time (plus the header for CSV).
+    """
+    if format not in FORMATS:
+        raise ValueError("Unknown format %s" % format)
+    records = iter_records(organisation_id, project_ids)
+    if format == 'ndjson':
+        for record_type, document in records:
+            yield to_ndjson(record_type, document)
+        return
+
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+
+    def encode(row):
+        writer.writerow([
+            value.encode('utf-8') if isinstance(value, unicode) else value
+            for value in row
+        ])
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+
+    yield encode(CSV_COLUMNS)
+    for record_type, document in records:
+        yield encode(to_csv_row(record_type, document))
+
+
+def read_chunk(iterator, size=64 * 1024):
+    """
+    Return at least `size` bytes (unless the export ends) from an iterator
+    returned by :func:`iter_export`. An empty string marks the end.
+    """
+    parts = []
+    length = 0
+    for part in iterator:
+        parts.append(part)
+        length += len(part)
+        if length >= size:
+            break
+    return ''.join(parts)
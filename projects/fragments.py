@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+    fragments
+
+    Cache of rendered template fragments.
+
+    A fragment is rendered in a template with the `Fragment` UI module::
+
+        {% module Fragment('projects/fragments/project.html', project) %}
+
+    The rendered fragment is cached under the template, the id and version
+    of the document, the role of the user, the locale and any other
+    arguments of the fragment. Any change to the document increments its
+    version (see :class:`~titan.projects.models.VersionedDocument`), so
+    entries never need to be invalidated and stale ones simply age out.
+
+    The entries are held in an in process LRU cache by default. With
+    `--fragment_cache_backend=redis` they are kept in Redis (or any server
+    speaking its protocol), which is shared by the worker processes. This
+    needs the redis package.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+
+import tornado.web
+from tornado.options import define, options
+
+from .cache import LRUCache
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+define(
+    "fragment_cache_backend", default="memory", type=str,
+    help="Where rendered fragments are cached: memory or redis"
+)
+define(
+    "fragment_cache_size", default=10000, type=int,
+    help="Maximum number of fragments cached in memory"
+)
+define(
+    "fragment_cache_ttl", default=3600, type=int,
+    help="Seconds for which a cached fragment is kept"
+)
+define(
+    "fragment_cache_redis_host", default="localhost", type=str,
+    help="Host of the redis server of the fragment cache"
+)
+define(
+    "fragment_cache_redis_port", default=6379, type=int,
+    help="Port of the redis server of the fragment cache"
+)
+
+
+class MemoryBackend(object):
+    """
+    Keeps the fragments in an :class:`~titan.projects.cache.LRUCache`
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.cache = LRUCache(max_size, ttl)
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class RedisBackend(object):
+    """
+    Keeps the fragments in redis, with an expiry of `ttl` seconds
+
+    :param client: A redis client
+    :param prefix: Prefix of the keys, so that the fragments can share a
+                   database with other data
+    """
+
+    def __init__(self, client, ttl=None, prefix='titan:fragment:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value):
+        if self.ttl:
+            self.client.setex(self.prefix + key, self.ttl, value)
+        else:
+            self.client.set(self.prefix + key, value)
+
+    def clear(self):
+        keys = self.client.keys(self.prefix + '*')
+        if keys:
+            self.client.delete(*keys)
+
+
+class FragmentCache(object):
+    """
+    Returns rendered fragments from a backend, rendering and storing the
+    missing ones, and keeps the counters of hits, misses and render time.
+
+    :param backend: An object with `get`, `set` and `clear`, like
+                    :class:`MemoryBackend` or :class:`RedisBackend`
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        #: Total seconds spent rendering the fragments which were missing
+        self.render_time = 0.0
+
+    def get_or_render(self, key, render):
+        """
+        Return the fragment cached under `key` or the result of calling
+        `render`, which is then cached.
+        """
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        start = time.time()
+        value = render()
+        self.render_time += time.time() - start
+        self.backend.set(key, value)
+        return value
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        """
+        Return the counters of the cache as a dictionary
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+            'render_time': self.render_time,
+            'mean_render_time':
+                self.render_time / self.misses if self.misses else 0.0,
+        }
+
+
+_fragment_cache = None
+
+
+def get_fragment_cache():
+    """
+    Return the process wide fragment cache, creating it with the backend
+    in `options.fragment_cache_backend` on first use
+    """
+    global _fragment_cache
+    if _fragment_cache is None:
+        if options.fragment_cache_backend == 'memory':
+            backend = MemoryBackend(
+                options.fragment_cache_size, options.fragment_cache_ttl
+            )
+        elif options.fragment_cache_backend == 'redis':
+            if redis is None:
+                raise RuntimeError(
+                    "The redis package is needed for the redis backend"
+                )
+            backend = RedisBackend(
+                redis.StrictRedis(
+                    options.fragment_cache_redis_host,
+                    options.fragment_cache_redis_port
+                ),
+                options.fragment_cache_ttl
+            )
+        else:
+            raise ValueError(
+                "Unknown fragment cache backend %s" %
+                options.fragment_cache_backend
+            )
+        _fragment_cache = FragmentCache(backend)
+    return _fragment_cache
+
+
+def fragment_key(template_name, document, role=None, locale=None,
+        **kwargs):
+    """
+    Return the cache key of a fragment of the document. Documents without
+    a version are keyed by their id alone. The keyword arguments are the
+    other arguments of the fragment, which should be simple values.
+    """
+    key = '%s:%s:%s:%s:%s' % (
+        template_name, document.id, getattr(document, 'version', None),
+        role, locale
+    )
+    if kwargs:
+        key += ':' + ':'.join(
+            '%s=%s' % item for item in sorted(kwargs.iteritems())
+        )
+    return key
+
+
+class Fragment(tornado.web.UIModule):
+    """
+    Render a template with a document, the role of the user and any other
+    arguments, through the fragment cache
+    """
+
+    def render(self, template_name, document, role=None, **kwargs):
+        key = fragment_key(
+            template_name, document, role, self.locale and self.locale.code,
+            **kwargs
+        )
+        return get_fragment_cache().get_or_render(
+            key, lambda: self.render_string(
+                template_name, document=document, role=role, **kwargs
+            )
+        )
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+    generate
+
+    Generate synthetic tenants for benchmarks and capacity tests.
+
+    The data is shaped like production: the sizes of teams, projects and
+    follow up histories follow heavy tailed distributions, projects give
+    access to several teams, and some follow ups have GridFS attachments.
+    The output is fully determined by the seed, the ids included, so two
+    runs with the same arguments produce the same database.
+
+    The documents are built as raw documents and written with bulk inserts,
+    without the mongoengine documents or their signals. The denormalised
+    roles of the users (:class:`~titan.projects.models.ProjectRole`) are
+    computed by the generator itself. Generate into an empty database and
+    build the indexes afterwards with `titand ensure_indexes`, which is
+    faster than maintaining them during the inserts.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import struct
+import random
+import calendar
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from gridfs import GridFS
+from mongoengine.connection import get_db
+
+from .models import (User, Organisation, Team, Project, TaskList, Task,
+    FollowUpRecord, ProjectRole, AccessControlList, STATUS_CHOICES,
+    ROLE_CHOICES, ROLE_PRECEDENCE, to_reference)
+
+
+#: Words the names, titles and messages are made of
+WORDS = [
+    'design', 'review', 'deploy', 'database', 'index', 'login', 'page',
+    'report', 'invoice', 'customer', 'export', 'import', 'search', 'cache',
+    'release', 'bug', 'crash', 'upgrade', 'migrate', 'test', 'server',
+    'email', 'template', 'settings', 'mobile', 'layout', 'payment', 'api',
+]
+
+#: Date of the first generated document
+EPOCH = datetime(2012, 1, 1)
+
+
+class IdSequence(object):
+    """
+    Deterministic ObjectIds: the time of :data:`EPOCH` plus one second
+    for every 10000 ids, followed by a counter. The ids sort in the order
+    they are generated.
+    """
+
+    def __init__(self):
+        self.counter = 0
+        self.epoch = calendar.timegm(EPOCH.utctimetuple())
+
+    def next(self):
+        self.counter += 1
+        return ObjectId(struct.pack(
+            '>IQ', self.epoch + self.counter // 10000, self.counter
+        ))
+
+
+class Generator(object):
+    """
+    Generate organisations with their users, teams, projects, task lists,
+    tasks, follow ups and attachments.
+
+    :param organisations: Number of organisations
+    :param tasks: Total number of tasks, spread unevenly over the projects
+    :param seed: Seed of the random generator
+    :param projects: Mean number of projects in an organisation
+    :param users: Mean number of users in an organisation
+    :param follow_ups: Mean number of follow ups of a task
+    :param attachment_ratio: Fraction of the follow ups with an attachment
+    :param batch_size: Number of documents inserted with one query
+    :param log: Optional function called with progress messages
+    """
+
+    def __init__(self, organisations, tasks, seed=0, projects=5, users=20,
+            follow_ups=3, attachment_ratio=0.001, batch_size=5000,
+            log=None):
+        self.organisations = organisations
+        self.tasks = tasks
+        self.projects = projects
+        self.users = users
+        self.follow_ups = follow_ups
+        self.attachment_ratio = attachment_ratio
+        self.batch_size = batch_size
+        self.log = log or (lambda message: None)
+        self.random = random.Random(seed)
+        self.ids = IdSequence()
+        self.counts = dict.fromkeys([
+            'users', 'organisations', 'teams', 'projects', 'task_lists',
+            'tasks', 'follow_ups', 'attachments', 'project_roles',
+        ], 0)
+        self._batches = {}
+
+    def skewed(self, mean, maximum=None):
+        """
+        Return a heavy tailed (Pareto) integer of at least 1 with about the
+        given mean
+        """
+        alpha = 1.5
+        value = int(self.random.paretovariate(alpha) * mean * (alpha - 1) /
+            alpha) or 1
+        return min(value, maximum) if maximum else value
+
+    def words(self, count):
+        return ' '.join(self.random.choice(WORDS) for _ in xrange(count))
+
+    def insert(self, document_class, document):
+        """
+        Queue a raw document, inserting the queue of the model when it is
+        full
+        """
+        batch = self._batches.setdefault(document_class, [])
+        batch.append(document)
+        if len(batch) >= self.batch_size:
+            self.flush(document_class)
+
+    def flush(self, document_class=None):
+        """
+        Insert the queued documents of the model, or of every model
+        """
+        for klass in ([document_class] if document_class else
+                list(self._batches)):
+            batch = self._batches.pop(klass, [])
+            if batch:
+                klass._get_collection().insert(batch)
+
+    def run(self):
+        """
+        Generate the data and return the number of documents of each kind
+        """
+        # Every user gets the same password, which is hashed once
+        template = User(name="template", email="template@example.com")
+        template.set_password("password")
+        user_template = template.to_mongo()
+        user_template.pop('_id', None)
+
+        projects = []
+        for index in xrange(self.organisations):
+            projects.extend(self.organisation(index, user_template))
+        self.flush()
+        self.log("Generated %(organisations)d organisations, %(users)d "
+            "users and %(projects)d projects" % self.counts)
+
+        # Tasks are spread over the projects by a heavy tailed weight
+        weights = [self.random.paretovariate(1.2) for _ in projects]
+        total = sum(weights)
+        remaining = self.tasks
+        for index, (project, weight) in enumerate(zip(projects, weights)):
+            if index == len(projects) - 1:
+                count = remaining
+            else:
+                count = min(
+                    int(round(self.tasks * weight / total)), remaining
+                )
+            remaining -= count
+            self.project_tasks(project, count)
+            if index % 100 == 0:
+                self.log("Generated %(tasks)d tasks" % self.counts)
+        self.flush()
+        self.log("Generated %(tasks)d tasks" % self.counts)
+        return self.counts
+
+    def organisation(self, index, user_template):
+        """
+        Generate an organisation with its users, teams and projects, and
+        return a list of (project id, task list ids, member ids) of the
+        projects
+        """
+        organisation_id = self.ids.next()
+        self.insert(Organisation, {
+            '_id': organisation_id,
+            'name': "Organisation %d" % index,
+            'slug': "organisation-%d" % index,
+            'version': 1,
+            'updated_at': EPOCH,
+        })
+        self.counts['organisations'] += 1
+
+        user_ids = []
+        for user_index in xrange(self.skewed(self.users, 10000)):
+            user_id = self.ids.next()
+            self.insert(User, dict(
+                user_template, _id=user_id,
+                name="User %d.%d" % (index, user_index),
+                email="user-%d-%d@example.com" % (index, user_index),
+            ))
+            user_ids.append(user_id)
+        self.counts['users'] += len(user_ids)
+
+        # Team sizes are skewed: most teams are small, a few have most of
+        # the users of the organisation.
+        teams = []
+        for team_index in xrange(self.skewed(3, 50)):
+            team_id = self.ids.next()
+            members = self.random.sample(
+                user_ids, self.skewed(5, len(user_ids))
+            )
+            self.insert(Team, {
+                '_id': team_id,
+                'name': "Team %d" % team_index,
+                'organisation': to_reference(
+                    Team, 'organisation', organisation_id
+                ),
+                'members': [
+                    to_reference(Team, 'members', user_id)
+                    for user_id in members
+                ],
+            })
+            teams.append((team_id, members))
+        self.counts['teams'] += len(teams)
+
+        projects = []
+        for project_index in xrange(self.skewed(self.projects, 1000)):
+            project_id = self.ids.next()
+            acl = [
+                (team_id, members, self.random.choice(ROLE_CHOICES)[0])
+                for team_id, members in self.random.sample(
+                    teams, min(len(teams), self.skewed(2, 10))
+                )
+            ]
+            self.insert(Project, {
+                '_id': project_id,
+                'name': "Project %d" % project_index,
+                'slug': "project-%d" % project_index,
+                'organisation': to_reference(
+                    Project, 'organisation', organisation_id
+                ),
+                'acl': [
+                    {
+                        'team': to_reference(
+                            AccessControlList, 'team', team_id
+                        ),
+                        'role': role,
+                    } for team_id, _, role in acl
+                ],
+                'version': 1,
+                'updated_at': EPOCH,
+            })
+            self.counts['projects'] += 1
+
+            roles = {}
+            for _, members, role in acl:
+                for user_id in members:
+                    if ROLE_PRECEDENCE[role] > \
+                            ROLE_PRECEDENCE.get(roles.get(user_id), 0):
+                        roles[user_id] = role
+            for user_id, role in roles.iteritems():
+                self.insert(ProjectRole, {
+                    '_id': self.ids.next(),
+                    'user': user_id,
+                    'project': project_id,
+                    'organisation': organisation_id,
+                    'role': role,
+                })
+            self.counts['project_roles'] += len(roles)
+
+            task_list_ids = []
+            for task_list_index in xrange(self.skewed(3, 20)):
+                task_list_id = self.ids.next()
+                self.insert(TaskList, {
+                    '_id': task_list_id,
+                    'name': "Version %d" % task_list_index,
+                    'project': to_reference(TaskList, 'project', project_id),
+                    'version': 1,
+                    'updated_at': EPOCH,
+                })
+                task_list_ids.append(task_list_id)
+            self.counts['task_lists'] += len(task_list_ids)
+            projects.append(
+                (project_id, task_list_ids, roles.keys() or user_ids)
+            )
+        return projects
+
+    def project_tasks(self, project, count):
+        """
+        Generate `count` tasks in the task lists of the project
+        """
+        project_id, task_list_ids, member_ids = project
+        statuses = [status for status, _ in STATUS_CHOICES]
+        limit = Task.MAX_EMBEDDED_FOLLOW_UPS
+        for _ in xrange(count):
+            task_id = self.ids.next()
+            created = EPOCH + timedelta(seconds=self.ids.counter)
+            follow_ups = [
+                self.follow_up(project_id, created, statuses, index)
+                for index in xrange(self.skewed(self.follow_ups, 1000) - 1)
+            ]
+            task = {
+                '_id': task_id,
+                'title': self.words(self.random.randint(3, 8)),
+                'status': self.random.choice(statuses),
+                'due_date': created + timedelta(
+                    days=self.random.randint(1, 90)
+                ),
+                'assigned_to': to_reference(
+                    Task, 'assigned_to', self.random.choice(member_ids)
+                ),
+                'watchers': [
+                    to_reference(Task, 'watchers', user_id)
+                    for user_id in self.random.sample(
+                        member_ids, min(len(member_ids), 3)
+                    )
+                ],
+                'task_list': to_reference(
+                    Task, 'task_list', self.random.choice(task_list_ids)
+                ),
+                'follow_ups': follow_ups[-limit:] if limit else follow_ups,
+                'time_spent': sum(f['time_spent'] for f in follow_ups),
+                'follow_ups_recorded': bool(limit),
+                'version': len(follow_ups) + 1,
+                'updated_at': created,
+            }
+            self.insert(Task, task)
+            if limit:
+                for follow_up in follow_ups:
+                    self.insert(FollowUpRecord, {
+                        '_id': self.ids.next(),
+                        'task': to_reference(FollowUpRecord, 'task', task_id),
+                        'follow_up': follow_up,
+                    })
+            self.counts['follow_ups'] += len(follow_ups)
+        self.counts['tasks'] += count
+
+    def follow_up(self, project_id, created, statuses, index):
+        """
+        Return the raw document of a follow up, with an attachment for
+        `attachment_ratio` of them
+        """
+        follow_up = {
+            'message': self.words(self.random.randint(5, 30)),
+            'from_status': self.random.choice(statuses),
+            'to_status': self.random.choice(statuses),
+            'time_spent': self.random.choice([0, 0, 900, 1800, 3600]),
+            'attachments': [],
+        }
+        if self.random.random() < self.attachment_ratio:
+            file_id = self.ids.next()
+            GridFS(get_db(), collection='fs').put(
+                self.words(self.random.randint(100, 10000)),
+                _id=file_id, filename="attachment-%d.txt" % index,
+                content_type='text/plain', project=project_id,
+                uploadDate=created,
+            )
+            follow_up['attachments'].append(file_id)
+            self.counts['attachments'] += 1
+        return follow_up
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+    instrumentation
+
+    Count the MongoDB commands of each request and the time spent in them.
+
+    A command listener registered with the pymongo monitoring API records
+    every command in the :class:`QueryStats` of the request being served
+    by the thread. The handlers install the stats of their request with
+    :class:`RequestContext`, which follows the request across the yields
+    of a coroutine, and :func:`titan.projects.db.run` carries it over to
+    the database threads.
+
+    The listener only sees the clients created after this module is
+    imported, which the import of the views ensures for the application.
+    With pymongo older than 3.1, which has no monitoring API, nothing is
+    recorded.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import logging
+import threading
+
+from tornado.options import define, options
+
+try:
+    from pymongo import monitoring
+except ImportError:
+    monitoring = None
+
+
+define(
+    "slow_request_threshold", default=500, type=int,
+    help="Requests taking longer than this many milliseconds are logged "
+        "with their slowest queries. 0 disables the log"
+)
+define(
+    "slow_statements", default=5, type=int,
+    help="Number of the slowest queries of a request which are kept"
+)
+
+#: Logger of the requests slower than `slow_request_threshold`
+slow_log = logging.getLogger('titan.slow')
+
+_local = threading.local()
+
+#: Stats which record every command of the process, whichever request it
+#: is made for. See :func:`titan.projects.testing.record_queries`.
+global_stats = []
+
+
+def get_current_stats():
+    """
+    Return the :class:`QueryStats` of the request being served by this
+    thread, or None
+    """
+    return getattr(_local, 'stats', None)
+
+
+def run_with_stats(stats, func, *args, **kwargs):
+    """
+    Call `func` with the commands it runs recorded in `stats`. Used to
+    carry the stats of a request over to another thread.
+    """
+    previous, _local.stats = get_current_stats(), stats
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _local.stats = previous
+
+
+def fingerprint(command_name, command):
+    """
+    Return the shape of a command: its name, collection, the fields of its
+    filter without the values and the fields it projects. Commands which
+    differ only in the values they look up have the same fingerprint.
+    """
+    if command_name == 'getMore':
+        collection = command.get('collection')
+    else:
+        collection = command.get(command_name)
+    query = command.get('filter', command.get('query'))
+    if query is None and command_name in ('update', 'delete'):
+        statements = command.get('updates') or command.get('deletes') or []
+        query = statements and statements[0].get('q')
+    result = '%s %s %s' % (command_name, collection, shape(query))
+    projection = command.get('projection', command.get('fields'))
+    if projection:
+        result += ' -> %s' % ', '.join(sorted(projection))
+    return result
+
+
+def shape(value):
+    """
+    Return the structure of a query with the values replaced by `?`
+    """
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join(
+            '%s: %s' % (key, shape(value[key]) if key.startswith('$') or
+                isinstance(value[key], dict) else '?')
+            for key in sorted(value)
+        )
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join(sorted(set(shape(v) for v in value)))
+    return '?'
+
+
+class QueryStats(object):
+    """
+    The commands run while serving a request
+
+    :param keep: Number of the slowest commands kept in :attr:`slowest`
+    """
+
+    def __init__(self, keep=5):
+        self.keep = keep
+        #: Number of commands
+        self.count = 0
+        #: Total seconds spent in the commands
+        self.time = 0.0
+        #: List of (seconds, fingerprint) of the slowest commands
+        self.slowest = []
+        #: List of the fingerprints of every command, in order
+        self.commands = []
+        self._lock = threading.Lock()
+
+    def add(self, fingerprint, duration):
+        with self._lock:
+            self.count += 1
+            self.time += duration
+            self.commands.append(fingerprint)
+            if len(self.slowest) < self.keep or \
+                    duration > self.slowest[-1][0]:
+                self.slowest.append((duration, fingerprint))
+                self.slowest.sort(reverse=True)
+                del self.slowest[self.keep:]
+
+
+def log_slow_request(request, stats):
+    """
+    Log the request with its queries, if it took longer than the threshold
+    """
+    threshold = options.slow_request_threshold
+    elapsed = request.request_time() * 1000
+    if not threshold or elapsed < threshold:
+        return
+    slow_log.warning(
+        "%s %s took %.0fms, %d queries in %.0fms. Slowest: %s",
+        request.method, request.uri, elapsed, stats.count,
+        stats.time * 1000, '; '.join(
+            '%.1fms %s' % (duration * 1000, command)
+            for duration, command in stats.slowest
+        )
+    )
+
+
+def server_timing(request, stats):
+    """
+    Return the value of the Server-Timing header of the request
+    """
+    return 'db;dur=%.1f;desc="%d queries", total;dur=%.1f' % (
+        stats.time * 1000, stats.count, request.request_time() * 1000
+    )
+
+
+class RequestContext(object):
+    """
+    Context manager which makes `stats` the current stats of the thread.
+    Used as a tornado StackContext, it is entered whenever a callback of
+    the request runs.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __enter__(self):
+        self.previous, _local.stats = get_current_stats(), self.stats
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.stats = self.previous
+
+
+if monitoring is not None:
+
+    class CommandListener(monitoring.CommandListener):
+        """
+        Records the commands in the current stats of the thread they run
+        in. The events of a command are published in the thread which
+        runs it.
+        """
+
+        def started(self, event):
+            targets = list(global_stats)
+            stats = get_current_stats()
+            if stats is not None:
+                targets.append(stats)
+            if not targets:
+                return
+            pending = getattr(_local, 'pending', None)
+            if pending is None:
+                pending = _local.pending = {}
+            pending[event.request_id] = (
+                targets, fingerprint(event.command_name, event.command)
+            )
+
+        def succeeded(self, event):
+            pending = getattr(_local, 'pending', None)
+            if pending is None:
+                return
+            try:
+                targets, command = pending.pop(event.request_id)
+            except KeyError:
+                return
+            for stats in targets:
+                stats.add(command, event.duration_micros / 1e6)
+
+        failed = succeeded
+
+    monitoring.register(CommandListener())
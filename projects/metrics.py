@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+    metrics
+
+    Process metrics in the Prometheus text format, served at `/metrics`:
+
+    * the requests, their latency and queries, per URL name and method
+    * the requests in flight
+    * the lag of the IOLoop, how late its callbacks run
+    * the connections of the MongoDB pool and the backlog of the database
+      threads
+    * the counters of the caches
+
+    The metrics are plain integers and floats updated without locks. The
+    request metrics are only updated on the IOLoop thread. The pool
+    events are published in the threads which run the queries, so each
+    thread counts in its own slot of a :class:`ThreadCounter` and the
+    slots are added up when the metrics are read.
+
+    With several workers (see :mod:`titan.server`) every process has its
+    own metrics and a scrape reaches one of them.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import time
+import thread
+from bisect import bisect_left
+
+from tornado import ioloop
+from tornado.options import define, options
+
+try:
+    from pymongo import monitoring
+except ImportError:
+    monitoring = None
+
+
+define(
+    "metrics_hosts", default=['127.0.0.1', '::1'], type=str, multiple=True,
+    help="Addresses allowed to read /metrics"
+)
+define(
+    "ioloop_lag_interval", default=1000, type=int,
+    help="Milliseconds between two measures of the IOLoop lag. 0 disables "
+        "the measure"
+)
+
+#: Upper bounds in seconds of the buckets of the latency histograms
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+#: Upper bounds of the buckets of the histogram of queries per request
+QUERY_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+class Histogram(object):
+    """
+    Counts of observations in buckets, as in a Prometheus histogram. The
+    counts are not cumulative until exported.
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        """
+        Yield the lines of the histogram
+        """
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield sample(
+                name + '_bucket', dict(labels, le=bound), cumulative
+            )
+        yield sample(name + '_sum', labels, self.sum)
+        yield sample(name + '_count', labels, self.count)
+
+
+class ThreadCounter(object):
+    """
+    A counter incremented from several threads without a lock. Every
+    thread adds to its own slot, so no increment is lost.
+    """
+
+    def __init__(self):
+        self._slots = {}
+
+    def incr(self, value=1):
+        ident = thread.get_ident()
+        self._slots[ident] = self._slots.get(ident, 0) + value
+
+    @property
+    def value(self):
+        return sum(self._slots.values())
+
+
+class RouteMetrics(object):
+    """
+    The metrics of the requests to one URL with one method
+    """
+    __slots__ = ('codes', 'latency', 'queries', 'query_time')
+
+    def __init__(self):
+        #: Status code to the number of responses
+        self.codes = {}
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        #: Seconds spent in queries
+        self.query_time = 0.0
+
+
+class Metrics(object):
+    """
+    The metrics of the process
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        #: (URL name, method) to :class:`RouteMetrics`
+        self.routes = {}
+        self.in_flight = 0
+        self.ioloop_lag = Histogram(LATENCY_BUCKETS)
+        #: Lag of the last measure in seconds
+        self.last_ioloop_lag = 0.0
+        self.pool_created = ThreadCounter()
+        self.pool_closed = ThreadCounter()
+        self.pool_checked_out = ThreadCounter()
+        self.pool_checked_in = ThreadCounter()
+        self.pool_checkout_failures = ThreadCounter()
+        self._lag_monitor = None
+
+    def request_started(self):
+        self.in_flight += 1
+
+    def request_finished(self, route, method, code, duration, stats=None):
+        """
+        Record a finished request
+
+        :param route: Name of the URLSpec of the request
+        :param stats: The :class:`~titan.projects.instrumentation.QueryStats`
+                      of the request
+        """
+        self.in_flight -= 1
+        key = (route, method)
+        metrics = self.routes.get(key)
+        if metrics is None:
+            metrics = self.routes[key] = RouteMetrics()
+        metrics.codes[code] = metrics.codes.get(code, 0) + 1
+        metrics.latency.observe(duration)
+        if stats is not None:
+            metrics.queries.observe(stats.count)
+            metrics.query_time += stats.time
+
+    def start_lag_monitor(self, io_loop=None):
+        """
+        Measure how late the callbacks of the IOLoop run every
+        `ioloop_lag_interval` milliseconds. Called on the first request,
+        so that forked workers measure their own loop.
+        """
+        if self._lag_monitor is not None or not options.ioloop_lag_interval:
+            return
+        io_loop = io_loop or ioloop.IOLoop.instance()
+
+        def measure(scheduled):
+            self.last_ioloop_lag = time.time() - scheduled
+            self.ioloop_lag.observe(self.last_ioloop_lag)
+
+        self._lag_monitor = ioloop.PeriodicCallback(
+            lambda: io_loop.add_callback(measure, time.time()),
+            options.ioloop_lag_interval, io_loop
+        )
+        self._lag_monitor.start()
+
+    def samples(self, caches=None, db_backlog=None):
+        """
+        Yield the lines of the metrics in the Prometheus text format
+
+        :param caches: Dictionary of name to the stats of a cache
+        :param db_backlog: Number of database calls waiting for a thread
+        """
+        yield '# TYPE titan_http_requests_total counter'
+        for (route, method), metrics in sorted(self.routes.iteritems()):
+            for code, count in sorted(metrics.codes.iteritems()):
+                yield sample('titan_http_requests_total', {
+                    'route': route, 'method': method, 'code': code,
+                }, count)
+        yield '# TYPE titan_http_request_duration_seconds histogram'
+        for (route, method), metrics in sorted(self.routes.iteritems()):
+            for line in metrics.latency.samples(
+                    'titan_http_request_duration_seconds',
+                    {'route': route, 'method': method}):
+                yield line
+        yield '# TYPE titan_http_request_queries histogram'
+        for (route, method), metrics in sorted(self.routes.iteritems()):
+            for line in metrics.queries.samples(
+                    'titan_http_request_queries',
+                    {'route': route, 'method': method}):
+                yield line
+        yield '# TYPE titan_http_request_query_seconds_total counter'
+        for (route, method), metrics in sorted(self.routes.iteritems()):
+            yield sample('titan_http_request_query_seconds_total', {
+                'route': route, 'method': method,
+            }, metrics.query_time)
+        yield '# TYPE titan_http_requests_in_flight gauge'
+        yield sample('titan_http_requests_in_flight', {}, self.in_flight)
+
+        yield '# TYPE titan_ioloop_lag_last_seconds gauge'
+        yield sample(
+            'titan_ioloop_lag_last_seconds', {}, self.last_ioloop_lag
+        )
+        yield '# TYPE titan_ioloop_lag_seconds histogram'
+        for line in self.ioloop_lag.samples('titan_ioloop_lag_seconds', {}):
+            yield line
+
+        if monitoring is not None and \
+                hasattr(monitoring, 'ConnectionPoolListener'):
+            yield '# TYPE titan_mongo_pool_connections gauge'
+            yield sample(
+                'titan_mongo_pool_connections', {},
+                self.pool_created.value - self.pool_closed.value
+            )
+            yield '# TYPE titan_mongo_pool_connections_in_use gauge'
+            yield sample(
+                'titan_mongo_pool_connections_in_use', {},
+                self.pool_checked_out.value - self.pool_checked_in.value
+            )
+            yield '# TYPE titan_mongo_pool_checkouts_total counter'
+            yield sample(
+                'titan_mongo_pool_checkouts_total', {},
+                self.pool_checked_out.value
+            )
+            yield '# TYPE titan_mongo_pool_checkout_failures_total counter'
+            yield sample(
+                'titan_mongo_pool_checkout_failures_total', {},
+                self.pool_checkout_failures.value
+            )
+        if db_backlog is not None:
+            yield '# TYPE titan_db_backlog gauge'
+            yield sample('titan_db_backlog', {}, db_backlog)
+
+        for name, kind in CACHE_METRICS:
+            lines = [
+                sample('titan_cache_%s' % name, {'cache': cache}, stats[name])
+                for cache, stats in sorted((caches or {}).iteritems())
+                if name in stats
+            ]
+            if lines:
+                yield '# TYPE titan_cache_%s %s' % (name, kind)
+                for line in lines:
+                    yield line
+
+        yield '# TYPE titan_process_start_time_seconds gauge'
+        yield sample('titan_process_start_time_seconds', {
+            'pid': os.getpid(),
+        }, self.started_at)
+
+
+#: The keys of the stats of the caches which are exported, with their
+#: metric type
+CACHE_METRICS = [
+    ('size', 'gauge'),
+    ('max_size', 'gauge'),
+    ('hits', 'counter'),
+    ('misses', 'counter'),
+    ('evictions', 'counter'),
+    ('invalidations', 'counter'),
+    ('render_time', 'counter'),
+]
+
+
+def sample(name, labels, value):
+    """
+    Return the line of a sample in the Prometheus text format
+    """
+    if labels:
+        name += '{%s}' % ','.join(
+            '%s="%s"' % (key, escape(labels[key])) for key in sorted(labels)
+        )
+    if isinstance(value, float):
+        return '%s %r' % (name, value)
+    return '%s %s' % (name, value)
+
+
+def escape(value):
+    """
+    Escape the value of a label
+    """
+    return unicode(value).replace('\\', r'\\').replace('"', r'\"') \
+        .replace('\n', r'\n')
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    """
+    Return the metrics of the process
+    """
+    return _metrics
+
+
+if monitoring is not None and hasattr(monitoring, 'ConnectionPoolListener'):
+
+    class PoolListener(monitoring.ConnectionPoolListener):
+        """
+        Counts the connections of the pools of the process
+        """
+
+        def pool_created(self, event):
+            pass
+
+        def pool_cleared(self, event):
+            pass
+
+        def pool_closed(self, event):
+            pass
+
+        def connection_created(self, event):
+            _metrics.pool_created.incr()
+
+        def connection_ready(self, event):
+            pass
+
+        def connection_closed(self, event):
+            _metrics.pool_closed.incr()
+
+        def connection_check_out_started(self, event):
+            pass
+
+        def connection_check_out_failed(self, event):
+            _metrics.pool_checkout_failures.incr()
+
+        def connection_checked_out(self, event):
+            _metrics.pool_checked_out.incr()
+
+        def connection_checked_in(self, event):
+            _metrics.pool_checked_in.incr()
+
+    monitoring.register(PoolListener())
+
+
+#: Handler class to a list of (regex, name) of its named URLSpecs
+_routes = {}
+
+
+def route_name(application, handler_class, path):
+    """
+    Return the name of the URLSpec of the application which routes `path`
+    to `handler_class`. The path is only matched for handlers served at
+    several URLs.
+    """
+    routes = _routes.get(handler_class)
+    if routes is None:
+        routes = _routes[handler_class] = [
+            (spec.regex, name)
+            for name, spec in application.named_handlers.iteritems()
+            if spec.handler_class is handler_class
+        ]
+    if len(routes) == 1:
+        return routes[0][1]
+    for regex, name in routes:
+        if regex.match(path):
+            return name
+    return handler_class.__name__
@@ -6,9 +6,22 @@
     :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) LTD
     :license: BSD, see LICENSE for more details.
 """
-from mongoengine import Document, EmbeddedDocument, ValidationError
+from datetime import datetime, timedelta
+
+from blinker import Namespace
+from gridfs import GridFS
+from pymongo.errors import OperationFailure
+from mongoengine import (Document, EmbeddedDocument, ValidationError,
+    OperationError, signals)
+try:
+    from mongoengine import NotUniqueError
+except ImportError:
+    # mongoengine < 0.8
+    NotUniqueError = None
 from mongoengine import (StringField, ReferenceField, ListField, FileField,
-    DateTimeField, EmbeddedDocumentField)
+    DateTimeField, EmbeddedDocumentField, IntField, ObjectIdField,
+    BooleanField)
+from mongoengine.connection import get_db
 from monstor.utils.i18n import _
 from monstor.contrib.auth.models import User as MonstorUser
 
@@ -20,8 +33,151 @@ STATUS_CHOICES = [
     ('resolved', 'Resolved'),
 ]
 
+ROLE_CHOICES = [
+    ('admin', _('Admin.Invite users to project and delete comments')),
+    ('participant', _('Participants can do everything except invite')),
+    ('observer', _('Read only access to the project')),
+]
+
+#: Precedence of roles when a user reaches a project through several teams
+ROLE_PRECEDENCE = {
+    'admin': 3,
+    'participant': 2,
+    'observer': 1,
+}
+
+#: Slugs which organisations cannot use, as the URLs of the organisations
+#: would be those of other pages of the application
+RESERVED_ORGANISATION_SLUGS = frozenset([
+    'metrics', 'my-organisations', 'login', 'logout', 'static',
+])
+
+#: Error codes of the server for the violation of a unique index
+DUPLICATE_KEY_CODES = (11000, 11001)
+
+_signals = Namespace()
+
+#: Sent by :meth:`Task.change_status` with the task as the sender, the
+#: task as it was before the change (raw document) as `previous` and the
+#: version of its task list after the change as `task_list_version`
+task_status_changed = _signals.signal('task_status_changed')
+
+#: Sent after a team or project was saved or deleted, once the project
+#: roles are rebuilt and the version of the organisation is incremented.
+#: The sender is the class of the document, given as `document`.
+membership_changed = _signals.signal('membership_changed')
+
+
+def is_duplicate_key_error(exc):
+    """
+    Returns True if the error raised on save is due to the violation of a
+    unique index: the NotUniqueError of mongoengine, or an error of pymongo
+    with one of the :data:`DUPLICATE_KEY_CODES`. Older versions of
+    mongoengine raise an OperationError without the code, for which this
+    returns False.
+    """
+    if NotUniqueError is not None and isinstance(exc, NotUniqueError):
+        return True
+    return isinstance(exc, OperationFailure) and \
+        exc.code in DUPLICATE_KEY_CODES
+
+
+def ref_id(ref):
+    """
+    Returns the id from a reference as stored in the database, which could
+    be either a DBRef or just the id.
+    """
+    return getattr(ref, 'id', ref)
+
+
+def to_reference(document_class, field_name, value):
+    """
+    Returns the id `value` as the reference field `field_name` of the
+    document class stores it: a DBRef, or just the id with mongoengine 0.8
+    and later. For a list of references, the reference of an item. This is
+    the inverse of :func:`ref_id`, for raw documents written without the
+    models.
+    """
+    field = document_class._fields[field_name]
+    # The field of the items of a list
+    field = getattr(field, 'field', field)
+    return field.to_mongo(value)
+
+
+def aggregate(document_class, pipeline):
+    """
+    Run an aggregation pipeline on the collection of the document class and
+    return the resulting list of raw documents.
+    """
+    result = document_class._get_collection().aggregate(pipeline)
+    if isinstance(result, dict):
+        # pymongo < 3 returns the command response
+        return result['result']
+    return list(result)
+
 
-class Organisation(Document):
+class VersionedDocument(Document):
+    """
+    A document with a version which is incremented, and the time it was
+    updated, on every save. Atomic updates of the document which bypass
+    :meth:`save` should do the same with :func:`version_update`.
+
+    The version is only ever incremented by `$inc` in the database, never
+    written from the copy in memory, so that a stale copy saved after an
+    atomic update, or two concurrent saves, cannot issue a version twice.
+    """
+
+    #: Incremented on every change of the document
+    version = IntField(default=0, verbose_name=_("Version"))
+
+    #: Time of the last change of the document
+    updated_at = DateTimeField(verbose_name=_("Updated At"))
+
+    meta = {
+        'abstract': True,
+    }
+
+    def save(self, *args, **kwargs):
+        """
+        Save the document. A new document is inserted with the version 1.
+        The version of an existing one is incremented after the save, by
+        an atomic update which reads the new version back.
+        """
+        if self.pk is None:
+            self.version = 1
+            self.updated_at = datetime.utcnow()
+            return super(VersionedDocument, self).save(*args, **kwargs)
+        rv = super(VersionedDocument, self).save(*args, **kwargs)
+        document = self._get_collection().find_and_modify(
+            {'_id': self.pk}, version_update(),
+            fields={'version': 1, 'updated_at': 1}, new=True
+        )
+        if document is not None:
+            self.set_version(document)
+        return rv
+
+    def set_version(self, document):
+        """
+        Set the version and update time from a raw document read back from
+        the database. They are not marked as changed, so that the next
+        save does not write them back.
+        """
+        self._data['version'] = document.get('version')
+        self._data['updated_at'] = document.get('updated_at')
+
+
+def version_update(update=None):
+    """
+    Add the increment of the version and the update time to a raw update
+    of a :class:`VersionedDocument` and return it.
+    """
+    update = update if update is not None else {}
+    update.setdefault('$inc', {})['version'] = 1
+    update.setdefault('$set', {})['updated_at'] = datetime.utcnow()
+    return update
+
+
+class Organisation(VersionedDocument):
     """
     Model for Organisation
     """
@@ -37,6 +193,21 @@ class Organisation(Document):
     #: Short identifier for the organisation, used in url
     slug = StringField(verbose_name=_("Slug"), required=True, unique=True)
 
+    meta = {
+        'index_background': True,
+    }
+
+    def validate(self, *args, **kwargs):
+        """
+        Validate the organisation, whose slug must not be one of the
+        :data:`RESERVED_ORGANISATION_SLUGS`
+        """
+        if self.slug in RESERVED_ORGANISATION_SLUGS:
+            raise ValidationError(
+                "Reserved %s: %s" % ("slug", self.slug), field_name="slug"
+            )
+        return super(Organisation, self).validate(*args, **kwargs)
+
     @property
     def teams(self):
         return Team.objects(organisation=self).all()
@@ -47,12 +218,46 @@ class User(MonstorUser):
     Extend users to make it a part of Organisation
     """
 
+    @property
+    def organisation_ids(self):
+        """
+        Returns the ids of the organisations the user belongs to.
+
+        Only the organisation field of the user's teams is read, and the
+        de-duplication happens on the server.
+        """
+        query = Team.objects(members=self)._query
+        return [
+            ref_id(ref) for ref in
+            Team._get_collection().distinct('organisation', query)
+        ]
+
     @property
     def organisations(self):
         """
         Returns a list of organisations the user belongs to.
+
+        This costs two queries irrespective of the number of teams: one for
+        the organisation ids and one `$in` query to load them.
+        """
+        return list(Organisation.objects(id__in=self.organisation_ids))
+
+    def organisation_by_slug(self, slug):
+        """
+        Returns the organisation with the given slug if the user is a member
+        of it, else None.
+
+        :param slug: Slug of the organisation
         """
-        return set([t.organisation for t in Team.objects(members=self)])
+        organisation = Organisation.objects(slug=slug).first()
+        if organisation is None:
+            return None
+        membership = Team.objects(
+            members=self, organisation=organisation
+        ).only('id').first()
+        if membership is None:
+            return None
+        return organisation
 
 
 class Team(Document):
@@ -74,6 +279,11 @@ class Team(Document):
         ReferenceField(User), verbose_name=_("Members")
     )
 
+    meta = {
+        'indexes': ['members', 'organisation'],
+        'index_background': True,
+    }
+
 
 class AccessControlList(EmbeddedDocument):
     """
@@ -84,16 +294,11 @@ class AccessControlList(EmbeddedDocument):
     #: If the user is a project admin, the user can invite more users to the
     #: project.
     role = StringField(
-        verbose_name=_("Role"), choices=[
-            ('admin', _('Admin.Invite users to project and delete comments')),
-            ('participant', _('Participants can do everything except invite')),
-            ('observer', _('Read only access to the project')),
-        ],
-        required=True
+        verbose_name=_("Role"), choices=ROLE_CHOICES, required=True
     )
 
 
-class Project(Document):
+class Project(VersionedDocument):
     """
     Model for project
     """
@@ -115,23 +320,80 @@ class Project(Document):
         Organisation, verbose_name=_("Organisation"), required=True
     )
 
-    def validate(self):
+    meta = {
+        'indexes': [
+            {'fields': ['organisation', 'slug'], 'unique': True},
+            # The pages of the projects of an organisation, in id order
+            ('organisation', 'id'),
+            'acl.team',
+        ],
+        'index_background': True,
+    }
+
+    def role_for(self, user):
         """
-        Whenever we create a new project or update an existing project object,
-        validates the slug field to ensure that the slug is unique under the
-        current organisation. If the slug is already existing raise a
-        validation error.
+        Returns the effective role of the user in the project, or None if
+        the user has no access. This is a single lookup on the unique index
+        of :class:`ProjectRole`, independent of the size of the teams.
+
+        :param user: A user or the id of one
         """
-        super(Project, self).validate()
-        duplicate = Project.objects(
-            organisation=self.organisation,
-            slug=self.slug,
+        role = ProjectRole._get_collection().find_one(
+            {'user': ref_id(user), 'project': self.id}, {'_id': 0, 'role': 1}
         )
-        if (len(duplicate) > 1) or (duplicate and duplicate[0].id != self.id):
+        return role and role['role']
+
+    @classmethod
+    def visible_to(cls, user, organisation=None):
+        """
+        Returns a queryset of the projects the user has a role in.
+
+        :param user: A user or the id of one
+        :param organisation: Optionally restrict to an organisation
+        """
+        query = {'user': ref_id(user)}
+        if organisation is not None:
+            query['organisation'] = ref_id(organisation)
+        project_ids = [
+            role['project'] for role in ProjectRole._get_collection().find(
+                query, {'_id': 0, 'project': 1}
+            )
+        ]
+        return cls.objects(id__in=project_ids)
+
+    def save(self, *args, **kwargs):
+        """
+        Save the project. The slug must be unique under the organisation,
+        which is enforced atomically by the unique index on
+        (organisation, slug). A duplicate raises a validation error on the
+        slug field instead of the operation error from the database.
+
+        When the error does not tell whether it is a duplicate (mongoengine
+        older than 0.8), the slug is looked up on the unique index.
+        """
+        try:
+            return super(Project, self).save(*args, **kwargs)
+        except OperationError as exc:
+            if not is_duplicate_key_error(exc) and (
+                    NotUniqueError is not None or
+                    not self._slug_taken()):
+                raise
             raise ValidationError(
-                "Duplicate %s: %s" % ("slug", self.slug)
+                "Duplicate %s: %s" % ("slug", self.slug), field_name="slug"
             )
 
+    def _slug_taken(self):
+        """
+        Returns True if another project of the organisation has the slug
+        """
+        query = Project.objects(
+            organisation=self.organisation, slug=self.slug
+        )._query
+        if self.id is not None:
+            query['_id'] = {'$ne': self.id}
+        return Project._get_collection().find_one(query, {'_id': 1}) \
+            is not None
+
 
 class FollowUp(EmbeddedDocument):
     """
@@ -158,13 +420,18 @@ class FollowUp(EmbeddedDocument):
     #: The new due date
     to_due_date = DateTimeField(verbose_name=_("To Due Date"))
 
+    #: Time spent on the task in this update, in seconds
+    time_spent = IntField(
+        verbose_name=_("Time Spent"), min_value=0, default=0
+    )
+
     #: File fields are stored in GridFS and only a reference to them is 
     #: held here. See 
     #: http://mongoengine-odm.readthedocs.org/en/latest/guide/gridfs.html
     attachments = ListField(FileField(), verbose_name=_("Attachments"))
 
 
-class TaskList(Document):
+class TaskList(VersionedDocument):
     """
     A model for Task list
     """
@@ -175,8 +442,18 @@ class TaskList(Document):
     #: The name of the project, under which this task list exist
     project = ReferenceField(Project, required=True, verbose_name=_("Project"))
 
+    meta = {
+        # The id in the index covers the queries for the ids of the task
+        # lists of projects
+        'indexes': [('project', 'id')],
+        'index_background': True,
+    }
+
+    #: Key of the index on (project, id), to hint covered queries
+    PROJECT_INDEX = [('project', 1), ('_id', 1)]
+
 
-class Task(Document):
+class Task(VersionedDocument):
     """
     A model for Tasks
     """
@@ -200,14 +477,455 @@ class Task(Document):
 
     #: The reference to the task list
     task_list = ReferenceField(TaskList, required=True)
+
+    #: The most recent follow ups. When :attr:`MAX_EMBEDDED_FOLLOW_UPS` is
+    #: set, only that many are kept here and the complete history is in
+    #: :class:`FollowUpRecord`.
     follow_ups = ListField(EmbeddedDocumentField(FollowUp))
 
+    #: Total of the time spent in the follow ups in seconds. This is
+    #: maintained by :meth:`add_follow_up` so that reading it does not need
+    #: the follow ups.
+    time_spent = IntField(
+        verbose_name=_("Time Spent"), min_value=0, default=0
+    )
+
+    #: True once every follow up of the task is in :class:`FollowUpRecord`.
+    #: Tasks created before the history was kept have their embedded
+    #: follow ups copied there by :meth:`record_follow_ups`.
+    follow_ups_recorded = BooleanField(default=False)
+
+    meta = {
+        'indexes': [
+            ('task_list', 'status'),
+            ('task_list', 'due_date'),
+            ('assigned_to', 'status'),
+            'status',
+            {
+                'fields': ['$title', '$follow_ups.message'],
+                'weights': {'title': 5, 'follow_ups.message': 1},
+            },
+        ],
+        'index_background': True,
+    }
+
+    #: Number of recent follow ups embedded in the task. Every follow up is
+    #: also written to the :class:`FollowUpRecord` collection, which is
+    #: read through :meth:`follow_up_history`. Set to None to embed all the
+    #: follow ups and not keep a separate history.
+    MAX_EMBEDDED_FOLLOW_UPS = 20
+
     @property
     def hours(self):
         """
         A property to sum up all the time from every followups and return a
         timedelta object.
+        """
+        return timedelta(seconds=self.time_spent or 0)
+
+    def save(self, *args, **kwargs):
+        """
+        A new task gets the total of the time in the follow ups it is
+        created with, and its follow ups are recorded in the history.
+        """
+        created = self.id is None
+        if created:
+            self.time_spent = sum(
+                follow_up.time_spent or 0 for follow_up in self.follow_ups
+            )
+            limit = self.MAX_EMBEDDED_FOLLOW_UPS
+            history, self.follow_ups = self.follow_ups, (
+                self.follow_ups[-limit:] if limit else self.follow_ups
+            )
+            self.follow_ups_recorded = bool(limit)
+        rv = super(Task, self).save(*args, **kwargs)
+        if created and self.MAX_EMBEDDED_FOLLOW_UPS and history:
+            FollowUpRecord.objects.insert([
+                FollowUpRecord(task=self, follow_up=follow_up)
+                for follow_up in history
+            ])
+        return rv
+
+    def change_status(self, status):
+        """
+        Set the status of the task with an atomic update, without saving
+        the rest of the document, and send :data:`task_status_changed`.
+
+        :param status: One of the values in :data:`STATUS_CHOICES`
+        """
+        if status not in dict(STATUS_CHOICES):
+            raise ValidationError("Invalid status: %s" % status)
+        update = version_update({'$set': {'status': status}})
+        previous = Task._get_collection().find_and_modify(
+            {'_id': self.id}, update,
+            fields={'status': 1, 'due_date': 1, 'assigned_to': 1,
+                'task_list': 1, 'version': 1}
+        )
+        self.status = status
+        if previous is not None:
+            self.set_version({
+                'version': (previous.get('version') or 0) + 1,
+                'updated_at': update['$set']['updated_at'],
+            })
+        if previous is not None and previous['status'] != status:
+            # The task counts of the task list changed
+            task_list = TaskList._get_collection().find_and_modify(
+                {'_id': ref_id(previous['task_list'])}, version_update(),
+                fields={'version': 1}, new=True
+            )
+            task_status_changed.send(
+                self, previous=previous,
+                task_list_version=task_list and task_list.get('version')
+            )
+
+    def add_follow_up(self, follow_up):
+        """
+        Append a follow up to the task, incrementing the time spent in the
+        same atomic update. Only the new follow up is sent to the database,
+        the rest of the document is not rewritten.
+
+        When :attr:`MAX_EMBEDDED_FOLLOW_UPS` is set, the follow up is also
+        inserted in the history and the embedded list is trimmed to the
+        most recent ones by the same update.
+
+        A task which is not saved yet is saved with the follow up.
+
+        :param follow_up: A :class:`FollowUp` instance
+        """
+        follow_up.validate()
+        if self.id is None:
+            self.follow_ups.append(follow_up)
+            self.save()
+            return
+        time_spent = follow_up.time_spent or 0
+        limit = self.MAX_EMBEDDED_FOLLOW_UPS
+        if not limit:
+            push = {'$push': {'follow_ups': follow_up.to_mongo()}}
+            self.follow_ups.append(follow_up)
+        else:
+            if not self.follow_ups_recorded:
+                # Keep the follow ups the slice below would drop
+                Task.record_follow_ups(self.id)
+                self.follow_ups_recorded = True
+            FollowUpRecord(task=self, follow_up=follow_up).save()
+            push = {'$push': {'follow_ups': {
+                '$each': [follow_up.to_mongo()],
+                '$slice': -limit,
+            }}}
+            self.follow_ups = (self.follow_ups + [follow_up])[-limit:]
+        update = version_update(push)
+        update['$inc']['time_spent'] = time_spent
+        document = Task._get_collection().find_and_modify(
+            {'_id': self.id}, update,
+            fields={'version': 1, 'updated_at': 1}, new=True
+        )
+        self.time_spent = (self.time_spent or 0) + time_spent
+        if document is not None:
+            self.set_version(document)
+
+    @classmethod
+    def record_follow_ups(cls, task_id):
+        """
+        Copy the embedded follow ups of a task which predates the history
+        to :class:`FollowUpRecord`, and mark the task as recorded. The mark
+        is set and the follow ups are read by one atomic update, so they
+        are copied once even when called concurrently. Returns the number
+        of follow ups copied.
+
+        :param task_id: Id of the task
+        """
+        task = cls._get_collection().find_and_modify(
+            {'_id': task_id, 'follow_ups_recorded': {'$ne': True}},
+            {'$set': {'follow_ups_recorded': True}},
+            fields={'follow_ups': 1}
+        )
+        follow_ups = task and task.get('follow_ups')
+        if not follow_ups:
+            return 0
+        task_ref = FollowUpRecord(task=task_id).to_mongo()['task']
+        try:
+            FollowUpRecord._get_collection().insert([
+                {'task': task_ref, 'follow_up': follow_up}
+                for follow_up in follow_ups
+            ])
+        except Exception:
+            cls._get_collection().update(
+                {'_id': task_id}, {'$set': {'follow_ups_recorded': False}}
+            )
+            raise
+        return len(follow_ups)
+
+    def follow_up_history(self, before=None, limit=20):
+        """
+        Returns a page of the history of follow ups, newest first, and the
+        cursor for the next page (None on the last page).
+
+        :param before: The cursor returned with the previous page
+        :param limit: Maximum number of follow ups in the page
+        :return: A tuple of a list of :class:`FollowUp` and the cursor
+        """
+        if self.MAX_EMBEDDED_FOLLOW_UPS and not self.follow_ups_recorded:
+            Task.record_follow_ups(self.id)
+            self.follow_ups_recorded = True
+        query = FollowUpRecord.objects(task=self)
+        if before is not None:
+            query = query.filter(id__lt=before)
+        records = list(query.order_by('-id').limit(limit + 1))
+        cursor = None
+        if len(records) > limit:
+            records = records[:limit]
+            cursor = unicode(records[-1].id)
+        return [record.follow_up for record in records], cursor
+
+    @classmethod
+    def time_by_user(cls, project=None):
+        """
+        Returns a dictionary of the id of the assigned user to the total
+        time (in seconds) spent on their tasks. The totals are computed by
+        the database and no task is loaded.
+
+        :param project: Optionally restrict the report to a project
+        """
+        pipeline = []
+        if project is not None:
+            task_lists = TaskList._get_collection().find(
+                TaskList.objects(project=project)._query, {'_id': 1}
+            )
+            pipeline.append({'$match': cls.objects(
+                task_list__in=[t['_id'] for t in task_lists]
+            )._query})
+        pipeline.append({'$group': {
+            '_id': '$assigned_to',
+            'time_spent': {'$sum': '$time_spent'},
+        }})
+        return dict(
+            (ref_id(row['_id']), row['time_spent'])
+            for row in aggregate(cls, pipeline)
+        )
+
+    @classmethod
+    def time_by_project(cls, organisation=None):
+        """
+        Returns a dictionary of project id to the total time (in seconds)
+        spent on the tasks of the project. The time is summed up per task
+        list by the database and then added up per project. The project of
+        each task list is read from the (project, id) index alone, without
+        loading the task lists.
+
+        :param organisation: Optionally restrict the report to the projects
+                             of an organisation
+        """
+        task_list_query = {}
+        if organisation is not None:
+            projects = Project._get_collection().find(
+                Project.objects(organisation=organisation)._query, {'_id': 1}
+            )
+            task_list_query = TaskList.objects(
+                project__in=[p['_id'] for p in projects]
+            )._query
+        projects = dict(
+            (t['_id'], ref_id(t['project']))
+            for t in TaskList._get_collection().find(
+                task_list_query, {'project': 1}
+            ).hint(TaskList.PROJECT_INDEX)
+        )
+
+        pipeline = []
+        if organisation is not None:
+            pipeline.append({'$match': cls.objects(
+                task_list__in=projects.keys()
+            )._query})
+        pipeline.append({'$group': {
+            '_id': '$task_list',
+            'time_spent': {'$sum': '$time_spent'},
+        }})
+        result = {}
+        for row in aggregate(cls, pipeline):
+            project_id = projects.get(ref_id(row['_id']))
+            if project_id is None:
+                continue
+            result[project_id] = result.get(project_id, 0) + \
+                row['time_spent']
+        return result
+
+
+class FollowUpRecord(Document):
+    """
+    The history of follow ups of a task, one document per follow up. It is
+    only appended to.
+    """
+
+    #: The task the follow up belongs to
+    task = ReferenceField(Task, required=True, verbose_name=_("Task"))
 
-        #: TODO
+    #: The follow up
+    follow_up = EmbeddedDocumentField(FollowUp, required=True)
+
+    meta = {
+        'collection': 'follow_up',
+        'indexes': [
+            ('task', '-id'),
+        ],
+        'index_background': True,
+    }
+
+
+class ProjectRole(Document):
+    """
+    The effective role of a user in a project.
+
+    Access to a project is granted to teams by the ACL of the project, so
+    the role of a user would otherwise require loading every team in the
+    ACL. This collection holds the result for every (user, project) and is
+    kept up to date by the save and delete signals of Team and Project.
+    It is only read and written as raw documents.
+    """
+
+    user = ObjectIdField(required=True)
+    project = ObjectIdField(required=True)
+    organisation = ObjectIdField(required=True)
+    role = StringField(required=True, choices=ROLE_CHOICES)
+
+    meta = {
+        'collection': 'project_role',
+        'allow_inheritance': False,
+        'indexes': [
+            {'fields': ['user', 'project'], 'unique': True},
+            'project',
+        ],
+        'index_background': True,
+    }
+
+    @classmethod
+    def rebuild(cls, project_id):
         """
-        return 0
+        Recompute the roles of every user in the project and apply the
+        difference: one upsert for every new or changed role and one
+        removal for the users who lost their access.
+
+        A concurrent rebuild of the same project may write the same rows,
+        so the rows are upserted by their unique (user, project) and an
+        upsert which loses the race to an insert is retried as an update.
+
+        :param project_id: Id of the project
+        """
+        collection = cls._get_collection()
+        project = Project._get_collection().find_one(
+            {'_id': project_id}, {'acl': 1, 'organisation': 1}
+        )
+        if project is None:
+            collection.remove({'project': project_id})
+            return
+
+        team_roles = {}
+        for acl in project.get('acl', []):
+            team_id = ref_id(acl['team'])
+            current = team_roles.get(team_id)
+            if current is None or \
+                    ROLE_PRECEDENCE[acl['role']] > ROLE_PRECEDENCE[current]:
+                team_roles[team_id] = acl['role']
+
+        roles = {}
+        if team_roles:
+            teams = Team._get_collection().find(
+                {'_id': {'$in': team_roles.keys()}}, {'members': 1}
+            )
+            for team in teams:
+                role = team_roles[team['_id']]
+                for member in team.get('members', []):
+                    user_id = ref_id(member)
+                    current = roles.get(user_id)
+                    if current is None or \
+                            ROLE_PRECEDENCE[role] > ROLE_PRECEDENCE[current]:
+                        roles[user_id] = role
+
+        existing = dict(
+            (row['user'], row['role']) for row in collection.find(
+                {'project': project_id}, {'_id': 0, 'user': 1, 'role': 1}
+            )
+        )
+        organisation_id = ref_id(project['organisation'])
+        for user_id, role in roles.iteritems():
+            if existing.get(user_id) == role:
+                continue
+            spec = {'user': user_id, 'project': project_id}
+            update = {
+                '$set': {'organisation': organisation_id, 'role': role}
+            }
+            try:
+                collection.update(spec, update, upsert=True)
+            except OperationFailure as exc:
+                if not is_duplicate_key_error(exc):
+                    raise
+                collection.update(spec, update)
+        removed = [
+            user_id for user_id in existing if user_id not in roles
+        ]
+        if removed:
+            collection.remove(
+                {'project': project_id, 'user': {'$in': removed}}
+            )
+
+    @classmethod
+    def rebuild_team(cls, team_id):
+        """
+        Recompute the roles in every project whose ACL has the team
+        """
+        projects = Project._get_collection().find(
+            Project.objects(acl__team=team_id)._query, {'_id': 1}
+        )
+        for project in projects:
+            cls.rebuild(project['_id'])
+
+
+def follow_ups_on_task_delete(sender, document, **kwargs):
+    """
+    Remove the history of follow ups of a deleted task and the files
+    attached to its follow ups
+    """
+    file_ids = set()
+    for follow_up in document.follow_ups:
+        file_ids.update(
+            getattr(attachment, 'grid_id', attachment)
+            for attachment in follow_up.attachments
+        )
+    collection = FollowUpRecord._get_collection()
+    query = FollowUpRecord.objects(task=document.id)._query
+    for record in collection.find(query, {'follow_up.attachments': 1}):
+        file_ids.update(record['follow_up'].get('attachments', []))
+    collection.remove(query)
+    grid_fs = GridFS(get_db(), collection='fs')
+    for file_id in file_ids:
+        if file_id is not None:
+            grid_fs.delete(file_id)
+
+
+def task_list_version_on_task_change(sender, document, **kwargs):
+    # The task counts of the task list are shown on the dashboard
+    TaskList._get_collection().update(
+        {'_id': ref_id(document.task_list)}, version_update()
+    )
+
+
+def membership_on_change(sender, document, **kwargs):
+    """
+    Rebuild the project roles of a changed team or project, then increment
+    the version of its organisation, whose pages show the projects and
+    teams, and finally send :data:`membership_changed`. A single receiver
+    does the three in order, as blinker does not order receivers.
+    """
+    if sender is Project:
+        ProjectRole.rebuild(document.id)
+    else:
+        ProjectRole.rebuild_team(document.id)
+    Organisation._get_collection().update(
+        {'_id': ref_id(document.organisation)}, version_update()
+    )
+    membership_changed.send(sender, document=document)
+
+
+for signal in (signals.post_save, signals.post_delete):
+    signal.connect(membership_on_change, sender=Project)
+    signal.connect(membership_on_change, sender=Team)
+    signal.connect(task_list_version_on_task_change, sender=Task)
+signals.post_delete.connect(follow_ups_on_task_delete, sender=Task)
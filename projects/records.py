@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+    records
+
+    Lightweight read only records of the models.
+
+    Listings only read a few fields of many documents, and building a
+    mongoengine document for each of them (with its field descriptors,
+    change tracking and lazy references) costs far more than the query. A
+    record is built straight from the raw document, holds only the
+    projected fields in its slots and keeps references as ids.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from bson import ObjectId
+
+from .models import Organisation, Project, TaskList, Task, ref_id
+
+
+def find_page(document_class, query, projection, after=None, limit=None):
+    """
+    Returns the raw documents matching the query in the order of ids and
+    the cursor for the next page, which is None on the last page.
+
+    The page is selected with a range on the id (keyset pagination), so
+    the cost of a page does not depend on how deep it is.
+
+    :param document_class: The model to query
+    :param query: A raw query, like the `_query` of a queryset
+    :param projection: The fields to read
+    :param after: Id of the last document in the previous page, or None
+    :param limit: Maximum number of documents in the page, or None for all
+    """
+    if after is not None:
+        after = {'_id': {'$gt': ObjectId(after)}}
+        # The query may have its own condition on the id, such as the ids
+        # of the documents the user can see, which must be kept
+        query = {'$and': [query, after]} if '_id' in query else \
+            dict(query, **after)
+    cursor = document_class._get_collection().find(
+        query, projection
+    ).sort('_id')
+    if limit is None:
+        return list(cursor), None
+    documents = list(cursor.limit(limit + 1))
+    if len(documents) > limit:
+        documents = documents[:limit]
+        return documents, unicode(documents[-1]['_id'])
+    return documents, None
+
+
+class Record(object):
+    """
+    Base class of the records. Subclasses list the fields they read in
+    `__slots__`, with the names of the fields of the model.
+    """
+    __slots__ = ('id', )
+
+    #: The model of the record
+    document_class = None
+
+    #: Fields holding references, which are stored as ids
+    references = ()
+
+    def __init__(self, **kwargs):
+        for name in self.fields():
+            setattr(self, name, kwargs.get(name))
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.id)
+
+    @classmethod
+    def fields(cls):
+        """
+        Names of the fields of the record, the id included
+        """
+        if '_fields' not in cls.__dict__:
+            names = []
+            for klass in reversed(cls.__mro__):
+                names.extend(getattr(klass, '__slots__', ()))
+            cls._fields = tuple(names)
+        return cls._fields
+
+    @classmethod
+    def projection(cls):
+        """
+        The projection of a query which reads the fields of the record
+        """
+        if '_projection' not in cls.__dict__:
+            cls._projection = dict(
+                (cls.document_class._fields[name].db_field, 1)
+                for name in cls.fields() if name != 'id'
+            )
+        return cls._projection
+
+    @classmethod
+    def from_mongo(cls, document):
+        """
+        Build a record from a raw document
+        """
+        record = cls.__new__(cls)
+        record.id = document['_id']
+        fields = cls.document_class._fields
+        for name in cls.__slots__:
+            value = document.get(fields[name].db_field)
+            if name in cls.references:
+                value = ref_id(value)
+            setattr(record, name, value)
+        return record
+
+    @classmethod
+    def find(cls, query, after=None, limit=None):
+        """
+        Returns the records of the documents matching the raw query and the
+        cursor for the next page. See :func:`find_page`.
+        """
+        documents, next_cursor = find_page(
+            cls.document_class, query, cls.projection(), after, limit
+        )
+        return [cls.from_mongo(d) for d in documents], next_cursor
+
+
+class OrganisationRecord(Record):
+    __slots__ = ('name', 'slug', 'version')
+    document_class = Organisation
+
+
+class ProjectRecord(Record):
+    __slots__ = ('name', 'slug', 'organisation', 'version')
+    document_class = Project
+    references = ('organisation', )
+
+
+class TaskListRecord(Record):
+    __slots__ = ('name', 'project', 'version')
+    document_class = TaskList
+    references = ('project', )
+
+
+class TaskRecord(Record):
+    __slots__ = ('title', 'status', 'due_date', 'assigned_to', 'task_list',
+        'time_spent', 'version')
+    document_class = Task
+    references = ('assigned_to', 'task_list')
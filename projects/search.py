@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+    search
+
+    Full text search of tasks.
+
+    The search uses the text index of the task collection, which covers the
+    title of the task and the messages of the follow ups embedded in it
+    (the most recent ones, see `Task.MAX_EMBEDDED_FOLLOW_UPS`). Results are
+    ranked by the text score and can be filtered on status, assignee and
+    due date.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from .models import Project, TaskList, Task
+from .serialise import TASK
+
+
+def get_task_list_ids(project_ids):
+    """
+    Return the ids of the task lists of the projects
+    """
+    return [
+        task_list['_id'] for task_list in TaskList._get_collection().find(
+            TaskList.objects(project__in=list(project_ids))._query,
+            {'_id': 1}
+        )
+    ]
+
+
+def get_project_ids(organisation_id, project_ids):
+    """
+    Return the ids of those projects which are in the organisation
+    """
+    query = Project.objects(organisation=organisation_id)._query
+    query['_id'] = {'$in': list(project_ids)}
+    return [
+        project['_id']
+        for project in Project._get_collection().find(query, {'_id': 1})
+    ]
+
+
+def search_tasks(task_list_ids, text, status=None, assigned_to=None,
+        due_before=None, due_after=None, offset=0, limit=20,
+        serialiser=TASK):
+    """
+    Search the tasks in the task lists and return a page of results, best
+    match first, and whether there are more results.
+
+    :param task_list_ids: Ids of the task lists to search in
+    :param text: The text to search for
+    :param status: Optional list of statuses the task must be in
+    :param assigned_to: Optional id of the user the task is assigned to
+    :param due_before: Optional datetime the task is due before
+    :param due_after: Optional datetime the task is due on or after
+    :param offset: Number of results to skip
+    :param limit: Maximum number of results
+    :param serialiser: The :class:`~titan.projects.serialise.Serialiser`
+                       of the fields of the task in the results
+    :return: A tuple of a list of records and a boolean
+    """
+    filters = {'task_list__in': task_list_ids}
+    if status:
+        filters['status__in'] = status
+    if assigned_to is not None:
+        filters['assigned_to'] = assigned_to
+    if due_before is not None:
+        filters['due_date__lt'] = due_before
+    if due_after is not None:
+        filters['due_date__gte'] = due_after
+    query = Task.objects(**filters)._query
+    query['$text'] = {'$search': text}
+
+    projection = serialiser.projection
+    projection['score'] = {'$meta': 'textScore'}
+    cursor = Task._get_collection().find(query, projection).sort(
+        [('score', {'$meta': 'textScore'})]
+    ).skip(offset).limit(limit + 1)
+
+    results = []
+    for task in cursor:
+        record = serialiser.record(task)
+        record['score'] = task['score']
+        results.append(record)
+    return results[:limit], len(results) > limit
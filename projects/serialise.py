@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+    serialise
+
+    JSON serialisation of the models straight from raw documents.
+
+    The documents are read with pymongo, with a projection of only the
+    fields the response needs, and are turned into JSON without building
+    mongoengine documents. References are written as ids and are never
+    dereferenced.
+
+    ujson or simplejson are used for encoding when installed, else the
+    json module of the standard library.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from datetime import datetime
+
+from bson import ObjectId, DBRef
+
+from .models import Organisation, Project, TaskList, Task, ref_id
+from .records import find_page
+
+try:
+    import ujson
+
+    def dumps(value):
+        """
+        Encode a value made of the basic types as compact JSON. Forward
+        slashes are escaped, so the output is safe to embed in HTML.
+        """
+        return ujson.dumps(value)
+
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        import json
+
+    def dumps(value):
+        """
+        Encode a value made of the basic types as compact JSON. Forward
+        slashes are escaped, so the output is safe to embed in HTML.
+        """
+        # Every slash, as ujson does, and not only those in "</"
+        return json.dumps(value, separators=(',', ':')).replace('/', '\\/')
+
+
+def clean(value):
+    """
+    Convert a raw value from the database to one which can be serialised
+    """
+    if isinstance(value, (ObjectId, DBRef)):
+        return unicode(ref_id(value))
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return dict(
+            ('id' if k == '_id' else k, clean(v))
+            for k, v in value.iteritems() if k not in ('_cls', '_types')
+        )
+    if isinstance(value, (list, tuple)):
+        return [clean(v) for v in value]
+    return value
+
+
+class Serialiser(object):
+    """
+    Serialises the raw documents of a model to dictionaries of the selected
+    fields. The id is always included.
+
+    :param document_class: The model
+    :param fields: Names of the fields which can be selected
+    :param default_fields: Names of the fields used when none are selected.
+                           Defaults to all the fields.
+    """
+
+    def __init__(self, document_class, fields, default_fields=None):
+        self.document_class = document_class
+        self.fields = tuple(fields)
+        self.default_fields = tuple(default_fields or fields)
+        # (name, database field) of the default fields
+        self._db_fields = [
+            (name, document_class._fields[name].db_field)
+            for name in self.default_fields
+        ]
+
+    def select(self, names=None):
+        """
+        Return a serialiser of those of the named fields which can be
+        selected, in the order of :attr:`fields`. Unknown names are
+        ignored and the default fields are used if none are left.
+        """
+        names = [name for name in self.fields if name in set(names or [])]
+        if not names or tuple(names) == self.default_fields:
+            return self
+        return Serialiser(self.document_class, self.fields, names)
+
+    @property
+    def projection(self):
+        """
+        The projection of a query which reads the selected fields
+        """
+        return dict((db_field, 1) for _, db_field in self._db_fields)
+
+    def record(self, document):
+        """
+        Return the dictionary of the selected fields of a raw document
+        """
+        record = {'id': unicode(document['_id'])}
+        for name, db_field in self._db_fields:
+            if db_field in document:
+                record[name] = clean(document[db_field])
+        return record
+
+    def find(self, query, after=None, limit=None):
+        """
+        Return the records of the documents matching the raw query and the
+        cursor for the next page. See
+        :func:`~titan.projects.records.find_page`.
+        """
+        documents, next_cursor = find_page(
+            self.document_class, query, self.projection, after, limit
+        )
+        return [self.record(d) for d in documents], next_cursor
+
+
+ORGANISATION = Serialiser(Organisation, ['name', 'slug'], ['name'])
+
+PROJECT = Serialiser(Project, ['name', 'slug', 'organisation'], ['name'])
+
+TASK_LIST = Serialiser(TaskList, ['name', 'project'])
+
+TASK = Serialiser(
+    Task,
+    ['title', 'status', 'assigned_to', 'due_date', 'task_list', 'watchers',
+        'time_spent'],
+    ['title', 'status', 'assigned_to', 'due_date', 'task_list']
+)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+    testing
+
+    Helpers to put query budgets on code under test and to catch N+1
+    queries, which show up as the same query shape repeated with different
+    values::
+
+        class TestProjects(QueryAssertionsMixin, testing.AsyncHTTPTestCase):
+
+            def test_projects(self):
+                with self.assertQueryBudget(6):
+                    self.fetch('/openlabs/projects/')
+
+    Every MongoDB command of the process is counted while the block runs,
+    including those of the database threads. The counts are only available
+    with pymongo 3.1 or later (see :mod:`titan.projects.instrumentation`).
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from collections import Counter
+from contextlib import contextmanager
+
+from .instrumentation import QueryStats, global_stats
+
+
+#: Commands which are not counted as repeated queries. mongoengine and
+#: GridFS create the indexes of a collection the first time it is used.
+IGNORED_REPEATS = ('createIndexes', 'listIndexes')
+
+
+@contextmanager
+def record_queries():
+    """
+    Record the commands run inside the block in the
+    :class:`~titan.projects.instrumentation.QueryStats` which is returned
+    """
+    stats = QueryStats()
+    global_stats.append(stats)
+    try:
+        yield stats
+    finally:
+        global_stats.remove(stats)
+
+
+def repeated_queries(stats, max_repeats=1):
+    """
+    Return a dictionary of the fingerprint of every query which was run
+    more than `max_repeats` times to the number of times it was run
+    """
+    counts = Counter(
+        command for command in stats.commands
+        if command.split(' ', 1)[0] not in IGNORED_REPEATS
+    )
+    return dict(
+        (command, count) for command, count in counts.iteritems()
+        if count > max_repeats
+    )
+
+
+class QueryAssertionsMixin(object):
+    """
+    Assertions on the queries run by a block, for unittest test cases
+    """
+
+    def assertNoRepeatedQueries(self, stats, max_repeats=1):
+        """
+        Fail if any query shape was run more than `max_repeats` times
+        """
+        repeated = repeated_queries(stats, max_repeats)
+        if repeated:
+            self.fail("Repeated queries (N+1?):\n%s" % '\n'.join(
+                '%d x %s' % (count, command)
+                for command, count in sorted(repeated.iteritems())
+            ))
+
+    def assertQueryCount(self, stats, budget):
+        """
+        Fail if more than `budget` queries were run
+        """
+        if stats.count > budget:
+            self.fail("%d queries run, the budget is %d:\n%s" % (
+                stats.count, budget, '\n'.join(stats.commands)
+            ))
+
+    @contextmanager
+    def assertQueryBudget(self, budget, max_repeats=1):
+        """
+        Fail if the block runs more than `budget` queries or repeats a
+        query shape more than `max_repeats` times
+        """
+        with record_queries() as stats:
+            yield stats
+        self.assertQueryCount(stats, budget)
+        self.assertNoRepeatedQueries(stats, max_repeats)
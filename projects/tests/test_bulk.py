@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+    test_bulk
+
+    Test the bulk import of tasks
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import json
+from datetime import datetime
+
+import unittest2 as unittest
+from mongoengine import connect
+from mongoengine.connection import _get_connection
+
+from titan.projects.models import (Team, Organisation, User, Project,
+    AccessControlList, TaskList, Task, ProjectRole)
+from titan.projects.bulk import import_tasks
+from monstor.utils.web import slugify
+
+
+class TestBulkImport(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        connect("test_bulk")
+
+    def setUp(self):
+        self.user = User(name="Test User", email="test@example.com")
+        self.user.set_password("password")
+        self.user.save()
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        team = Team(
+            name="Developers", organisation=organisation,
+            members=[self.user]
+        ).save()
+        self.project = Project(
+            name="Titan", slug="titan", organisation=organisation,
+            acl=[AccessControlList(team=team, role="admin")]
+        ).save()
+
+    def tearDown(self):
+        for model in (User, Organisation, Team, Project, TaskList, Task,
+                ProjectRole):
+            model.drop_collection()
+
+    def test_0010_import(self):
+        """
+        Import valid and invalid rows in several batches
+        """
+        rows = [
+            {
+                'title': 'Task %d' % index, 'task_list': 'Version 0.1',
+                'assigned_to': 'test@example.com', 'due_date': '2012-12-31',
+            } for index in xrange(5)
+        ]
+        lines = [json.dumps(row) for row in rows]
+        lines.insert(2, '{not json')
+        lines.append(json.dumps({
+            'title': 'Task', 'task_list': 'Version 0.1',
+            'assigned_to': 'nobody@example.com',
+        }))
+        lines.append(json.dumps({
+            'task_list': 'Version 0.2', 'assigned_to': unicode(self.user.id),
+        }))
+
+        result = import_tasks(self.project, lines, batch_size=2)
+        self.assertEqual(result['created'], 5)
+        self.assertEqual(result['failed'], 3)
+        self.assertEqual(
+            [error['line'] for error in result['errors']], [3, 7, 8]
+        )
+        self.assertEqual(Task.objects.count(), 5)
+        # The task list of the invalid row is not created
+        self.assertEqual(TaskList.objects(project=self.project).count(), 1)
+        task = Task.objects.first()
+        self.assertEqual(task.due_date, datetime(2012, 12, 31))
+        self.assertEqual(task.assigned_to, self.user)
+
+    def test_0020_update(self):
+        """
+        Rows with an id update the existing task
+        """
+        import_tasks(self.project, [json.dumps({
+            'title': 'Task', 'task_list': 'Version 0.1',
+            'assigned_to': 'test@example.com',
+        })])
+        task = Task.objects.first()
+
+        result = import_tasks(self.project, [json.dumps({
+            'id': unicode(task.id), 'title': 'Renamed',
+            'task_list': 'Version 0.1', 'assigned_to': 'test@example.com',
+            'status': 'resolved',
+        })])
+        self.assertEqual(result['created'], 0)
+        self.assertEqual(result['updated'], 1)
+        task = Task.objects.with_id(task.id)
+        self.assertEqual(task.title, 'Renamed')
+        self.assertEqual(task.status, 'resolved')
+        self.assertEqual(Task.objects.count(), 1)
+
+    def test_0030_task_of_other_project(self):
+        """
+        Rows with the id of a task of another project are rejected
+        """
+        other = Project(
+            name="Monstor", slug="monstor",
+            organisation=self.project.organisation,
+            acl=self.project.acl
+        ).save()
+        import_tasks(other, [json.dumps({
+            'title': 'Task', 'task_list': 'Version 0.1',
+            'assigned_to': 'test@example.com',
+        })])
+        task = Task.objects.first()
+
+        result = import_tasks(self.project, [json.dumps({
+            'id': unicode(task.id), 'title': 'Renamed',
+            'task_list': 'Version 0.1', 'assigned_to': 'test@example.com',
+        })])
+        self.assertEqual(result['failed'], 1)
+        self.assertEqual(result['updated'], 0)
+        self.assertEqual(Task.objects.with_id(task.id).title, 'Task')
+        self.assertEqual(TaskList.objects(project=self.project).count(), 0)
+
+    @classmethod
+    def tearDownClass(cls):
+        c = _get_connection()
+        c.drop_database('test_bulk')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""
+    test_cache
+
+    Test the caches used by the handlers
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import unittest2 as unittest
+from mongoengine import connect
+from mongoengine.connection import _get_connection
+
+from titan.projects.models import (Team, Organisation, User, Project,
+    AccessControlList, ProjectRole, version_update)
+from titan.projects.cache import (LRUCache, SlugIndex, get_membership,
+    get_membership_cache)
+from titan.projects.fragments import (FragmentCache, MemoryBackend,
+    fragment_key)
+from titan.projects.records import ProjectRecord
+from monstor.utils.web import slugify
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000
+        self.cache = LRUCache(2, ttl=10, clock=lambda: self.now)
+
+    def test_0010_get_set(self):
+        """
+        Values which are set can be retrieved and misses are counted
+        """
+        self.assertEqual(self.cache.get('a'), None)
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_0020_lru_eviction(self):
+        """
+        The least recently used key is evicted when the cache is full
+        """
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('c'), 3)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_0030_ttl(self):
+        """
+        Entries expire after the ttl
+        """
+        self.cache.set('a', 1)
+        self.now += 11
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_0040_invalidate(self):
+        """
+        Invalidate by key and by predicate
+        """
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.invalidate('a')
+        self.assertEqual(self.cache.get('a'), None)
+        self.cache.invalidate_where(lambda value: value == 2)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.stats()['invalidations'], 2)
+
+    def test_0050_generation(self):
+        """
+        A value computed before an invalidation is not stored
+        """
+        generation = self.cache.generation
+        self.cache.invalidate('a')
+        self.assertFalse(self.cache.set('a', 1, generation))
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertTrue(self.cache.set('a', 1, self.cache.generation))
+        self.assertEqual(self.cache.get('a'), 1)
+
+
+class TestFragmentCache(unittest.TestCase):
+
+    def test_0010_get_or_render(self):
+        """
+        Fragments are rendered once per key and the hits are counted
+        """
+        cache = FragmentCache(MemoryBackend(10))
+        rendered = []
+
+        def render():
+            rendered.append(1)
+            return '<div>Titan</div>'
+
+        for _ in xrange(3):
+            self.assertEqual(
+                cache.get_or_render('key', render), '<div>Titan</div>'
+            )
+        self.assertEqual(len(rendered), 1)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_0020_key(self):
+        """
+        The key changes with the version of the document and the role
+        """
+        project = ProjectRecord(id=1, name="Titan", version=1)
+        key = fragment_key('project.html', project, 'admin')
+        self.assertEqual(key, fragment_key('project.html', project, 'admin'))
+        self.assertNotEqual(
+            key, fragment_key('project.html', project, 'observer')
+        )
+        project.version = 2
+        self.assertNotEqual(
+            key, fragment_key('project.html', project, 'admin')
+        )
+
+
+class TestMembershipCache(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        connect("test_cache")
+
+    def setUp(self):
+        get_membership_cache().clear()
+        self.user = User(name="Test User", email="test@example.com")
+        self.user.set_password("password")
+        self.user.save()
+        self.organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        self.organisation.save()
+
+    def tearDown(self):
+        User.drop_collection()
+        Organisation.drop_collection()
+        Team.drop_collection()
+        Project.drop_collection()
+        ProjectRole.drop_collection()
+
+    def test_0010_membership(self):
+        """
+        Membership holds the teams, organisations and project roles
+        """
+        admins = Team(
+            name="Admins", organisation=self.organisation,
+            members=[self.user]
+        ).save()
+        observers = Team(
+            name="Observers", organisation=self.organisation,
+            members=[self.user]
+        ).save()
+        project = Project(
+            name="Titan", slug="titan", organisation=self.organisation,
+            acl=[
+                AccessControlList(team=observers, role="observer"),
+                AccessControlList(team=admins, role="admin"),
+            ]
+        ).save()
+
+        membership = get_membership(self.user.id)
+        self.assertEqual(membership.team_ids, set([admins.id, observers.id]))
+        self.assertEqual(
+            membership.organisation_id(self.organisation.slug),
+            self.organisation.id
+        )
+        self.assertEqual(membership.project_roles, {project.id: 'admin'})
+
+        # Served from the cache the second time
+        hits = get_membership_cache().hits
+        self.assertTrue(get_membership(self.user.id) is membership)
+        self.assertEqual(get_membership_cache().hits, hits + 1)
+
+    def test_0020_invalidate_on_team_change(self):
+        """
+        Adding and removing members of a team invalidates the cache
+        """
+        team = Team(
+            name="Developers", organisation=self.organisation, members=[]
+        ).save()
+        self.assertEqual(get_membership(self.user.id).organisations, {})
+
+        team.members = [self.user]
+        team.save()
+        self.assertEqual(
+            get_membership(self.user.id).organisation_ids,
+            [self.organisation.id]
+        )
+
+        team.members = []
+        team.save()
+        self.assertEqual(get_membership(self.user.id).organisations, {})
+
+    def test_0030_invalidate_on_project_change(self):
+        """
+        Changing the ACL of a project invalidates the cache
+        """
+        team = Team(
+            name="Developers", organisation=self.organisation,
+            members=[self.user]
+        ).save()
+        project = Project(
+            name="Titan", slug="titan", organisation=self.organisation,
+            acl=[AccessControlList(team=team, role="observer")]
+        ).save()
+        self.assertEqual(
+            get_membership(self.user.id).project_roles,
+            {project.id: 'observer'}
+        )
+
+        project.acl[0].role = 'participant'
+        project.save()
+        self.assertEqual(
+            get_membership(self.user.id).project_roles,
+            {project.id: 'participant'}
+        )
+
+        project.delete()
+        self.assertEqual(get_membership(self.user.id).project_roles, {})
+
+    def test_0040_change_in_other_process(self):
+        """
+        A change made by another process, which does not invalidate the
+        cache of this one, is seen through the organisation version
+        """
+        team = Team(
+            name="Developers", organisation=self.organisation,
+            members=[self.user]
+        ).save()
+        project = Project(
+            name="Titan", slug="titan", organisation=self.organisation,
+            acl=[AccessControlList(team=team, role="observer")]
+        ).save()
+        membership = get_membership(self.user.id)
+        self.assertEqual(membership.project_roles, {project.id: 'observer'})
+
+        # What another process does when the user leaves the team
+        Team._get_collection().update(
+            {'_id': team.id}, {'$set': {'members': []}}
+        )
+        ProjectRole.rebuild(project.id)
+        self.assertTrue(get_membership(self.user.id) is membership)
+        Organisation._get_collection().update(
+            {'_id': self.organisation.id}, version_update()
+        )
+        membership = get_membership(self.user.id)
+        self.assertEqual(membership.organisations, {})
+        self.assertEqual(membership.project_roles, {})
+
+    def test_0050_tags(self):
+        """
+        Only the memberships tagged with a changed document are removed
+        """
+        team = Team(
+            name="Developers", organisation=self.organisation,
+            members=[self.user]
+        ).save()
+        other = User(name="Other User", email="other@example.com")
+        other.set_password("password")
+        other.save()
+        get_membership(self.user.id)
+        get_membership(other.id)
+        cache = get_membership_cache()
+        self.assertEqual(len(cache), 2)
+        cache.invalidate_tagged([('team', team.id)])
+        self.assertEqual(len(cache), 1)
+        self.assertTrue(cache.get(other.id) is not None)
+
+    @classmethod
+    def tearDownClass(cls):
+        c = _get_connection()
+        c.drop_database('test_cache')
+
+
+class TestSlugIndex(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        connect("test_cache")
+
+    def setUp(self):
+        self.now = 1000
+        self.index = SlugIndex(60, clock=lambda: self.now)
+
+    def tearDown(self):
+        Organisation.drop_collection()
+
+    def test_0010_reload(self):
+        """
+        The index answers from memory until it expires, then is reloaded
+        with the slugs taken or freed by other processes
+        """
+        Organisation(name="open labs", slug="open-labs").save()
+        self.assertFalse(self.index.is_fresh('organisations'))
+        self.index.load_organisations()
+        self.assertTrue(self.index.has_organisation('open-labs'))
+
+        # Another process
+        Organisation._get_collection().insert({
+            'name': "titan", 'slug': "titan",
+        })
+        Organisation._get_collection().remove({'slug': "open-labs"})
+        self.assertTrue(self.index.is_fresh('organisations'))
+        self.assertFalse(self.index.has_organisation('titan'))
+
+        self.now += 60
+        self.assertFalse(self.index.is_fresh('organisations'))
+        self.index.load_organisations()
+        self.assertTrue(self.index.has_organisation('titan'))
+        self.assertFalse(self.index.has_organisation('open-labs'))
+
+    @classmethod
+    def tearDownClass(cls):
+        c = _get_connection()
+        c.drop_database('test_cache')
+
+
+if __name__ == '__main__':
+    unittest.main()
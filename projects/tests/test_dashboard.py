@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+    test_dashboard
+
+    Test the organisation dashboard
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from datetime import datetime, timedelta
+
+import unittest2 as unittest
+from mongoengine import connect
+from mongoengine.connection import _get_connection
+
+from titan.projects.models import (Team, Organisation, User, Project,
+    AccessControlList, TaskList, Task, ProjectRole, version_update)
+from titan.projects.dashboard import (get_dashboard, get_dashboard_cache,
+    get_dashboard_summary)
+from monstor.utils.web import slugify
+
+
+class TestDashboard(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        connect("test_dashboard")
+
+    def setUp(self):
+        get_dashboard_cache().clear()
+        self.user = User(name="Test User", email="test@example.com")
+        self.user.set_password("password")
+        self.user.save()
+        self.organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        self.organisation.save()
+        team = Team(
+            name="Developers", organisation=self.organisation,
+            members=[self.user]
+        ).save()
+        self.project = Project(
+            name="Titan", slug="titan", organisation=self.organisation,
+            acl=[AccessControlList(team=team, role="admin")]
+        ).save()
+        self.task_list = TaskList(
+            name="Version 0.1", project=self.project
+        ).save()
+
+    def tearDown(self):
+        for model in (User, Organisation, Team, Project, TaskList, Task,
+                ProjectRole):
+            model.drop_collection()
+
+    def create_task(self, status, due_date=None):
+        return Task(
+            title="Task", status=status, due_date=due_date,
+            assigned_to=self.user, task_list=self.task_list
+        ).save()
+
+    def test_0010_dashboard(self):
+        """
+        Count the tasks of the organisation
+        """
+        yesterday = datetime.utcnow() - timedelta(days=1)
+        self.create_task("new", yesterday)
+        self.create_task("new")
+        self.create_task("in-progress")
+        self.create_task("resolved", yesterday)
+
+        dashboard = get_dashboard_summary(self.organisation.id)
+        self.assertEqual(dashboard['status'], {
+            'new': 2, 'in-progress': 1, 'hold': 0, 'resolved': 1,
+        })
+        self.assertEqual(dashboard['overdue'], 1)
+        self.assertEqual(
+            dashboard['assignees'], [{'id': self.user.id, 'open': 3}]
+        )
+        self.assertEqual(dashboard['projects'][0]['id'], self.project.id)
+        self.assertEqual(dashboard['projects'][0]['status']['new'], 2)
+
+    def test_0020_status_change(self):
+        """
+        Status changes update the cached dashboard in place
+        """
+        yesterday = datetime.utcnow() - timedelta(days=1)
+        task = self.create_task("new", yesterday)
+        cached = get_dashboard(self.organisation.id)
+
+        task.change_status("resolved")
+        dashboard = get_dashboard(self.organisation.id)
+        self.assertTrue(dashboard is cached)
+        self.assertEqual(dashboard.status['new'], 0)
+        self.assertEqual(dashboard.status['resolved'], 1)
+        self.assertEqual(dashboard.count_overdue(), 0)
+        self.assertEqual(dashboard.assignees, {})
+
+        # Other changes invalidate the cache
+        self.create_task("hold")
+        dashboard = get_dashboard(self.organisation.id)
+        self.assertFalse(dashboard is cached)
+        self.assertEqual(dashboard.status['hold'], 1)
+
+    def test_0025_overdue_at_read_time(self):
+        """
+        Tasks become overdue without any change, so the cached dashboard
+        does not hold the overdue count
+        """
+        tomorrow = datetime.utcnow() + timedelta(days=1)
+        task = self.create_task("new", tomorrow)
+        summary = get_dashboard_summary(self.organisation.id)
+        self.assertEqual(summary['overdue'], 0)
+
+        later = tomorrow + timedelta(days=1)
+        summary = get_dashboard_summary(self.organisation.id, later)
+        self.assertEqual(summary['overdue'], 1)
+
+        task.change_status("resolved")
+        summary = get_dashboard_summary(self.organisation.id, later)
+        self.assertEqual(summary['overdue'], 0)
+
+    def test_0030_change_in_other_process(self):
+        """
+        A cached dashboard is reloaded when another process changes the
+        tasks, which the signals of this process do not see
+        """
+        task = self.create_task("new")
+        cached = get_dashboard(self.organisation.id)
+        self.assertTrue(get_dashboard(self.organisation.id) is cached)
+
+        # What change_status does in another process
+        Task._get_collection().update(
+            {'_id': task.id}, version_update({'$set': {'status': 'hold'}})
+        )
+        TaskList._get_collection().update(
+            {'_id': self.task_list.id}, version_update()
+        )
+        dashboard = get_dashboard(self.organisation.id)
+        self.assertFalse(dashboard is cached)
+        self.assertEqual(dashboard.status['new'], 0)
+        self.assertEqual(dashboard.status['hold'], 1)
+
+        # A new project is seen through the version of the organisation
+        Project(
+            name="Monstor", slug="monstor", organisation=self.organisation,
+            acl=self.project.acl
+        ).save()
+        self.assertEqual(len(get_dashboard(self.organisation.id).projects), 2)
+
+    @classmethod
+    def tearDownClass(cls):
+        c = _get_connection()
+        c.drop_database('test_dashboard')
+
+
+if __name__ == '__main__':
+    unittest.main()
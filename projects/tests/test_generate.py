@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+    test_generate
+
+    Test the synthetic data generator
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import unittest2 as unittest
+from mongoengine import connect
+from mongoengine.connection import _get_connection
+
+from titan.projects.models import (User, Organisation, Team, Project,
+    TaskList, Task, FollowUpRecord, ProjectRole)
+from titan.projects.generate import Generator
+from titan.projects.cache import Membership
+from titan.projects.dashboard import get_dashboard_cache, get_dashboard_summary
+from titan.projects.search import (search_tasks, get_task_list_ids,
+    get_project_ids)
+
+MODELS = [
+    User, Organisation, Team, Project, TaskList, Task, FollowUpRecord,
+    ProjectRole,
+]
+
+
+class TestGenerator(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        connect("test_generate")
+
+    def tearDown(self):
+        for model in MODELS:
+            model.drop_collection()
+
+    def generate(self):
+        counts = Generator(3, 200, seed=42, attachment_ratio=0).run()
+        snapshot = dict(
+            (model.__name__, sorted(
+                model._get_collection().find().distinct('_id')
+            )) for model in MODELS
+        )
+        self.tearDown()
+        return counts, snapshot
+
+    def test_0010_generate(self):
+        """
+        Generate the requested number of documents, and the same ones for
+        the same seed
+        """
+        counts, snapshot = self.generate()
+        self.assertEqual(counts['organisations'], 3)
+        self.assertEqual(counts['tasks'], 200)
+        self.assertEqual(len(snapshot['Task']), 200)
+        self.assertEqual(
+            len(snapshot['FollowUpRecord']), counts['follow_ups']
+        )
+        self.assertEqual(
+            len(snapshot['ProjectRole']), counts['project_roles']
+        )
+        self.assertEqual(self.generate(), (counts, snapshot))
+
+    def test_0020_queries_of_the_app(self):
+        """
+        The references are stored as the models store them, so the queries
+        of the application find the generated tenants
+        """
+        Generator(3, 200, seed=42, attachment_ratio=0).run()
+        Task.ensure_indexes()
+        get_dashboard_cache().clear()
+        role = ProjectRole._get_collection().find_one()
+        user_id, organisation_id = role['user'], role['organisation']
+
+        membership = Membership.load(user_id)
+        self.assertTrue(organisation_id in membership.organisation_ids)
+        self.assertTrue(role['project'] in membership.project_roles)
+
+        summary = get_dashboard_summary(organisation_id)
+        self.assertTrue(summary['projects'])
+        self.assertTrue(sum(summary['status'].values()))
+
+        task_list_ids = get_task_list_ids(
+            get_project_ids(organisation_id, membership.project_roles.keys())
+        )
+        self.assertTrue(task_list_ids)
+        task = Task._get_collection().find_one(Task.objects(
+            task_list__in=task_list_ids
+        )._query)
+        results, more = search_tasks(task_list_ids, task['title'])
+        self.assertTrue(results)
+
+    @classmethod
+    def tearDownClass(cls):
+        c = _get_connection()
+        c.drop_database('test_generate')
+
+
+if __name__ == '__main__':
+    unittest.main()
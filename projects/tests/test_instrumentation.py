@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+    test_instrumentation
+
+    Test the counting of the queries of requests
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import unittest2 as unittest
+from bson import ObjectId
+from mongoengine import connect
+from mongoengine.connection import _get_connection
+
+from titan.projects.instrumentation import (QueryStats, fingerprint,
+    run_with_stats)
+from titan.projects.testing import record_queries, repeated_queries
+from titan.projects.models import Organisation
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        connect("test_instrumentation")
+
+    def tearDown(self):
+        Organisation.drop_collection()
+
+    def test_0010_fingerprint(self):
+        """
+        Commands which differ only in their values have the same
+        fingerprint
+        """
+        first = fingerprint('find', {
+            'find': 'task', 'filter': {
+                'task_list': {'$in': [ObjectId(), ObjectId()]},
+                'status': 'new',
+            },
+        })
+        second = fingerprint('find', {
+            'find': 'task', 'filter': {
+                'status': 'resolved',
+                'task_list': {'$in': [ObjectId()]},
+            },
+        })
+        self.assertEqual(first, second)
+        self.assertEqual(first, 'find task {status: ?, task_list: {$in: [?]}}')
+        self.assertNotEqual(first, fingerprint('find', {
+            'find': 'task', 'filter': {'status': 'new'},
+        }))
+
+    def test_0020_slowest(self):
+        """
+        Only the slowest commands are kept
+        """
+        stats = QueryStats(keep=2)
+        for duration in (0.1, 0.3, 0.2, 0.05):
+            stats.add('find %s' % duration, duration)
+        self.assertEqual(stats.count, 4)
+        self.assertAlmostEqual(stats.time, 0.65)
+        self.assertEqual(
+            stats.slowest, [(0.3, 'find 0.3'), (0.2, 'find 0.2')]
+        )
+
+    def test_0030_count_queries(self):
+        """
+        The queries run with the stats are counted
+        """
+        Organisation(name="open labs", slug="open-labs").save()
+        stats = QueryStats()
+        run_with_stats(
+            stats, lambda: Organisation.objects(slug="open-labs").first()
+        )
+        self.assertEqual(stats.count, 1)
+        self.assertTrue(stats.commands[0].startswith('find organisation'))
+
+    def test_0040_repeated_queries(self):
+        """
+        The queries of a block are recorded and repeated shapes are found
+        """
+        for index in xrange(3):
+            Organisation(name="org %d" % index, slug="org-%d" % index).save()
+        with record_queries() as stats:
+            for index in xrange(3):
+                Organisation.objects(slug="org-%d" % index).first()
+            Organisation.objects.only('slug').first()
+        self.assertEqual(stats.count, 4)
+        repeated = repeated_queries(stats)
+        self.assertEqual(repeated.values(), [3])
+        self.assertTrue(repeated.keys()[0].startswith(
+            'find organisation {slug: ?}'
+        ))
+        self.assertEqual(repeated_queries(stats, max_repeats=3), {})
+
+    @classmethod
+    def tearDownClass(cls):
+        c = _get_connection()
+        c.drop_database('test_instrumentation')
+
+
+if __name__ == '__main__':
+    unittest.main()
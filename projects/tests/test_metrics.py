@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+    test_metrics
+
+    Test the metrics endpoint
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import unittest
+
+from tornado import testing, options, httputil
+from monstor.app import make_app
+from mongoengine.connection import get_connection
+
+from titan.projects.metrics import Histogram, Metrics, sample, get_metrics
+from titan.projects.views import HomePageHandler
+from titan.settings import SETTINGS
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_0010_sample(self):
+        """
+        Samples are formatted with sorted and escaped labels
+        """
+        self.assertEqual(sample('titan_up', {}, 1), 'titan_up 1')
+        self.assertEqual(
+            sample('titan_x', {'route': 'home', 'code': 200}, 0.5),
+            'titan_x{code="200",route="home"} 0.5'
+        )
+        self.assertEqual(
+            sample('titan_x', {'name': 'a "b"'}, 1),
+            r'titan_x{name="a \"b\""} 1'
+        )
+
+    def test_0020_histogram(self):
+        """
+        The buckets are cumulative when exported and include their bound
+        """
+        histogram = Histogram((0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        self.assertEqual(list(histogram.samples('h', {})), [
+            'h_bucket{le="0.1"} 2',
+            'h_bucket{le="1.0"} 3',
+            'h_bucket{le="+Inf"} 4',
+            'h_sum 2.65',
+            'h_count 4',
+        ])
+
+    def test_0030_requests(self):
+        """
+        Requests are counted by route, method and status
+        """
+        metrics = Metrics()
+        for code in (200, 200, 404):
+            metrics.request_started()
+            metrics.request_finished('projects.project', 'GET', code, 0.02)
+        metrics.request_started()
+        lines = list(metrics.samples())
+        self.assertIn(
+            'titan_http_requests_total{code="200",method="GET",'
+            'route="projects.project"} 2', lines
+        )
+        self.assertIn(
+            'titan_http_requests_total{code="404",method="GET",'
+            'route="projects.project"} 1', lines
+        )
+        self.assertIn('titan_http_requests_in_flight 1', lines)
+
+
+class FakeConnection(object):
+    """
+    The connection of a request which is never served
+    """
+
+    def set_close_callback(self, callback):
+        pass
+
+
+class TestMetricsHandler(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        options.options.database = 'test_metrics'
+        SETTINGS['xsrf_cookies'] = False
+        return make_app(**SETTINGS)
+
+    def test_0010_metrics(self):
+        """
+        The metrics include the requests served before
+        """
+        self.fetch('/')
+        response = self.fetch('/metrics')
+        self.assertEqual(response.code, 200)
+        self.assertTrue(
+            response.headers['Content-Type'].startswith('text/plain')
+        )
+        self.assertIn(
+            'titan_http_requests_total{code="200",method="GET",'
+            'route="home"}', response.body
+        )
+        self.assertIn('titan_cache_hits{cache="membership"}', response.body)
+
+    def test_0020_closed_connection(self):
+        """
+        A request whose client went away is no longer in flight, and is
+        counted once even if it finishes later
+        """
+        metrics = get_metrics()
+        handler = HomePageHandler(self._app, httputil.HTTPServerRequest(
+            'GET', '/', connection=FakeConnection()
+        ))
+        handler.query_stats = None
+        handler._in_flight = True
+        metrics.request_started()
+        in_flight = metrics.in_flight
+
+        handler.on_connection_close()
+        self.assertEqual(metrics.in_flight, in_flight - 1)
+        handler.record_request(200)
+        self.assertEqual(metrics.in_flight, in_flight - 1)
+        self.assertEqual(metrics.routes[('home', 'GET')].codes.get(499), 1)
+
+    def tearDown(self):
+        get_connection().drop_database('test_metrics')
+        super(TestMetricsHandler, self).tearDown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,12 +7,18 @@
     :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import threading
+from datetime import timedelta
+
 import unittest2 as unittest
 from mongoengine import connect, ValidationError, OperationError
 from mongoengine.connection import _get_connection
+from pymongo.errors import DuplicateKeyError, OperationFailure
 
 from titan.projects.models import(Team, Organisation, User, Project,
-    AccessControlList, FollowUp, TaskList, Task)
+    AccessControlList, FollowUp, TaskList, Task, FollowUpRecord, ProjectRole,
+    is_duplicate_key_error, version_update)
+from titan.projects.records import OrganisationRecord, ProjectRecord
 from monstor.utils.web import slugify
 
 
@@ -68,6 +74,8 @@ class TestModel(unittest.TestCase):
         Project.drop_collection()
         Task.drop_collection()
         TaskList.drop_collection()
+        FollowUpRecord.drop_collection()
+        ProjectRole.drop_collection()
 
     def test_0010_create_organisation(self):
         """
@@ -183,6 +191,51 @@ class TestModel(unittest.TestCase):
         )
         self.assertRaises(ValidationError, project.save)
 
+    def test_0085_update_project(self):
+        """
+        Saving an existing project again must not be seen as a duplicate,
+        and a duplicate slug is reported on the slug field
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        project = create_project(
+            self.user, "New Titan", "titan projects", organisation
+        )
+        project.save()
+        project.name = "Titan"
+        project.save()
+        self.assertEqual(Project.objects().count(), 1)
+
+        project = create_project(
+            self.user, "New Titan", "titan projects", organisation
+        )
+        try:
+            project.save()
+        except ValidationError as exc:
+            self.assertEqual(exc.field_name, "slug")
+        else:
+            self.fail("Duplicate slug saved")
+        self.assertEqual(Project.objects().count(), 1)
+
+    def test_0087_duplicate_key_error(self):
+        """
+        Duplicates are recognised by the error code, not the message
+        """
+        self.assertTrue(is_duplicate_key_error(
+            DuplicateKeyError("E11000 index violation", 11000)
+        ))
+        self.assertTrue(is_duplicate_key_error(
+            OperationFailure("clé dupliquée", 11001)
+        ))
+        self.assertFalse(is_duplicate_key_error(
+            OperationFailure("duplicate field name", 2)
+        ))
+        self.assertFalse(is_duplicate_key_error(
+            OperationError("Could not save document (duplicate)")
+        ))
+
     def test_0090_same_slug(self):
         """
         We can use same project "slug" under different organisations
@@ -354,6 +407,140 @@ class TestModel(unittest.TestCase):
         )
         self.assertRaises(ValidationError, task.save)
 
+    def test_0145_task_time_spent(self):
+        """
+        The time spent in follow ups is totalled on the task
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        project = create_project(
+            self.user, 'Titan', 'titan project', organisation
+        )
+        project.save()
+        task_list = TaskList(name="Version 0.1", project=project)
+        task_list.save()
+        task = Task(
+            title="Create model design", status="new",
+            assigned_to=self.user, task_list=task_list,
+            follow_ups=[FollowUp(message="Started", time_spent=1800)]
+        )
+        task.save()
+        self.assertEqual(task.hours, timedelta(minutes=30))
+
+        task.add_follow_up(
+            FollowUp(message="Done", to_status="resolved", time_spent=3600)
+        )
+        self.assertEqual(task.hours, timedelta(minutes=90))
+
+        task = Task.objects.with_id(task.id)
+        self.assertEqual(len(task.follow_ups), 2)
+        self.assertEqual(task.hours, timedelta(minutes=90))
+
+        self.assertEqual(Task.time_by_user(), {self.user.id: 5400})
+        self.assertEqual(
+            Task.time_by_user(project=project), {self.user.id: 5400}
+        )
+        self.assertEqual(Task.time_by_project(), {project.id: 5400})
+        self.assertEqual(
+            Task.time_by_project(organisation=organisation),
+            {project.id: 5400}
+        )
+
+        # A follow up added to a new task saves the task with it
+        task = Task(
+            title="Review model design", status="new",
+            assigned_to=self.user, task_list=task_list
+        )
+        task.add_follow_up(FollowUp(message="Reviewed", time_spent=600))
+        self.assertTrue(task.id is not None)
+        task = Task.objects.with_id(task.id)
+        self.assertEqual(len(task.follow_ups), 1)
+        self.assertEqual(task.time_spent, 600)
+
+    def test_0146_task_follow_up_history(self):
+        """
+        Only the recent follow ups are embedded and the history can be
+        paginated
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        project = create_project(
+            self.user, 'Titan', 'titan project', organisation
+        )
+        project.save()
+        task_list = TaskList(name="Version 0.1", project=project)
+        task_list.save()
+        task = Task(
+            title="Create model design", status="new",
+            assigned_to=self.user, task_list=task_list,
+            follow_ups=[FollowUp(message="0")]
+        )
+        task.save()
+        limit = Task.MAX_EMBEDDED_FOLLOW_UPS
+        for index in xrange(1, limit + 5):
+            task.add_follow_up(FollowUp(message=unicode(index)))
+
+        self.assertEqual(len(task.follow_ups), limit)
+        task = Task.objects.with_id(task.id)
+        self.assertEqual(len(task.follow_ups), limit)
+        self.assertEqual(task.follow_ups[-1].message, unicode(limit + 4))
+        self.assertEqual(task.follow_ups[0].message, u"5")
+
+        messages = []
+        cursor = None
+        while True:
+            follow_ups, cursor = task.follow_up_history(cursor, limit=10)
+            messages.extend(f.message for f in follow_ups)
+            if cursor is None:
+                break
+        self.assertEqual(
+            messages, [unicode(i) for i in reversed(xrange(limit + 5))]
+        )
+
+    def test_0147_legacy_follow_ups(self):
+        """
+        The embedded follow ups of a task created before the history are
+        copied to it before any is trimmed
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        project = create_project(
+            self.user, 'Titan', 'titan project', organisation
+        )
+        project.save()
+        task_list = TaskList(name="Version 0.1", project=project)
+        task_list.save()
+        limit = Task.MAX_EMBEDDED_FOLLOW_UPS
+        task = Task(
+            title="Create model design", status="new",
+            assigned_to=self.user, task_list=task_list,
+        )
+        task.save()
+        # As the task was stored before the history was kept
+        Task._get_collection().update({'_id': task.id}, {
+            '$set': {'follow_ups': [
+                FollowUp(message=unicode(index)).to_mongo()
+                for index in xrange(limit)
+            ]},
+            '$unset': {'follow_ups_recorded': 1},
+        })
+        task = Task.objects.with_id(task.id)
+        self.assertFalse(task.follow_ups_recorded)
+
+        task.add_follow_up(FollowUp(message=unicode(limit)))
+        follow_ups, cursor = task.follow_up_history(limit=limit + 1)
+        self.assertEqual(
+            [f.message for f in follow_ups],
+            [unicode(i) for i in reversed(xrange(limit + 1))]
+        )
+        self.assertEqual(Task.record_follow_ups(task.id), 0)
+
     def test_0150_user_organisation(self):
         """
         Test the organisation property of user
@@ -389,6 +576,250 @@ class TestModel(unittest.TestCase):
         self.assertEqual(len(self.user.organisations), 2)
         self.assertEqual(len(user_2.organisations), 1)
 
+    def test_0160_user_organisation_by_slug(self):
+        """
+        Test looking up one of the user's organisations by slug
+        """
+        user_2 = User(
+            name="test-user",
+            email="test@sample.com",
+        )
+        user_2.set_password("openlabs")
+        user_2.save()
+
+        organisation_1 = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation_1.save()
+        organisation_2 = Organisation(
+            name="new organisation", slug=slugify("new organisation")
+        )
+        organisation_2.save()
+
+        # Multiple teams in the same organisation
+        Team(
+            name="Developers", organisation=organisation_1,
+            members=[self.user, user_2]
+        ).save()
+        Team(
+            name="Admins", organisation=organisation_1, members=[self.user]
+        ).save()
+        Team(
+            name="Paricipants", organisation=organisation_2,
+            members=[self.user]
+        ).save()
+
+        self.assertEqual(len(self.user.organisations), 2)
+        self.assertEqual(
+            self.user.organisation_by_slug(organisation_1.slug),
+            organisation_1
+        )
+        self.assertEqual(
+            user_2.organisation_by_slug(organisation_1.slug), organisation_1
+        )
+        # Not a member
+        self.assertEqual(
+            user_2.organisation_by_slug(organisation_2.slug), None
+        )
+        # Does not exist
+        self.assertEqual(self.user.organisation_by_slug("invalid"), None)
+
+    def test_0170_project_roles(self):
+        """
+        The effective role of users follow the teams and ACL of the project
+        """
+        user_2 = User(name="test-user", email="test@sample.com")
+        user_2.set_password("openlabs")
+        user_2.save()
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        admins = Team(
+            name="Admins", organisation=organisation, members=[self.user]
+        ).save()
+        observers = Team(
+            name="Observers", organisation=organisation,
+            members=[self.user, user_2]
+        ).save()
+        project = Project(
+            name="Titan", slug="titan", organisation=organisation,
+            acl=[
+                AccessControlList(team=admins, role="admin"),
+                AccessControlList(team=observers, role="observer"),
+            ]
+        )
+        project.save()
+        self.assertEqual(project.role_for(self.user), "admin")
+        self.assertEqual(project.role_for(user_2), "observer")
+        self.assertEqual(
+            list(Project.visible_to(user_2, organisation)), [project]
+        )
+
+        # Adding to a team
+        admins.members.append(user_2)
+        admins.save()
+        self.assertEqual(project.role_for(user_2), "admin")
+
+        # Removing from the teams
+        admins.members = [self.user]
+        admins.save()
+        observers.members = [self.user]
+        observers.save()
+        self.assertEqual(project.role_for(user_2), None)
+        self.assertEqual(list(Project.visible_to(user_2)), [])
+
+        # Changing the ACL
+        project.acl = [AccessControlList(team=admins, role="participant")]
+        project.save()
+        self.assertEqual(project.role_for(self.user), "participant")
+
+        project.delete()
+        self.assertEqual(ProjectRole.objects.count(), 0)
+
+    def test_0175_concurrent_project_role_rebuilds(self):
+        """
+        Concurrent rebuilds of the roles of a project upsert the same rows
+        without failing on the unique index
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        team = Team(
+            name="Admins", organisation=organisation, members=[self.user]
+        ).save()
+        project = Project(
+            name="Titan", slug="titan", organisation=organisation,
+            acl=[AccessControlList(team=team, role="admin")]
+        )
+        project.save()
+        # Removing the rows keeps the unique index
+        ProjectRole._get_collection().remove({})
+
+        errors = []
+
+        def rebuild():
+            try:
+                ProjectRole.rebuild(project.id)
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=rebuild) for _ in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(ProjectRole.objects.count(), 1)
+        self.assertEqual(project.role_for(self.user), "admin")
+
+    def test_0180_records(self):
+        """
+        Read pages of records from the raw documents
+        """
+        organisations = []
+        for index in xrange(3):
+            organisation = Organisation(
+                name="Organisation %d" % index, slug="org-%d" % index
+            )
+            organisation.save()
+            organisations.append(organisation)
+        project = create_project(
+            self.user, 'Titan', 'titan', organisations[0]
+        )
+        project.save()
+
+        records, cursor = OrganisationRecord.find({}, limit=2)
+        self.assertEqual(
+            [(r.id, r.name, r.slug) for r in records],
+            [(o.id, o.name, o.slug) for o in organisations[:2]]
+        )
+        records, cursor = OrganisationRecord.find({}, cursor, limit=2)
+        self.assertEqual([r.id for r in records], [organisations[2].id])
+        self.assertEqual(cursor, None)
+
+        # The pages keep the condition of the query on the ids
+        query = Organisation.objects(
+            id__in=[organisations[0].id, organisations[2].id]
+        )._query
+        records, cursor = OrganisationRecord.find(
+            query, unicode(organisations[0].id), limit=2
+        )
+        self.assertEqual([r.id for r in records], [organisations[2].id])
+
+        records, cursor = ProjectRecord.find(
+            Project.objects(organisation=organisations[0])._query
+        )
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].slug, 'titan')
+        self.assertEqual(records[0].organisation, organisations[0].id)
+        self.assertRaises(AttributeError, setattr, records[0], 'acl', [])
+
+    def test_0190_versions(self):
+        """
+        Every change increments the version of the document
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        self.assertEqual(organisation.version, 1)
+        self.assertTrue(organisation.updated_at is not None)
+
+        # Projects change the version of their organisation
+        project = create_project(
+            self.user, 'Titan', 'titan project', organisation
+        )
+        project.save()
+        organisation.reload()
+        self.assertTrue(organisation.version > 1)
+
+        task_list = TaskList(name="Version 0.1", project=project)
+        task_list.save()
+        task = Task(
+            title="Create model design", status="new",
+            assigned_to=self.user, task_list=task_list
+        )
+        task.save()
+        self.assertEqual(task.version, 1)
+
+        # Atomic updates increment the version too
+        task.change_status("in-progress")
+        task.add_follow_up(FollowUp(message="Started", time_spent=60))
+        self.assertEqual(task.version, 3)
+        self.assertEqual(Task.objects.with_id(task.id).version, 3)
+
+    def test_0195_save_stale_version(self):
+        """
+        Saving a copy loaded before an atomic update still increments the
+        version stored in the database
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        stored_version = lambda: Organisation._get_collection().find_one(
+            {'_id': organisation.id}
+        )['version']
+        stale = Organisation.objects.with_id(organisation.id)
+        Organisation._get_collection().update(
+            {'_id': organisation.id}, version_update()
+        )
+        self.assertEqual(stored_version(), 2)
+
+        stale.name = "Open Labs"
+        stale.save()
+        self.assertEqual(stale.version, 3)
+        self.assertEqual(stored_version(), 3)
+
+        # Saves of two copies never issue the same version
+        organisation.name = "Openlabs"
+        organisation.save()
+        stale.save()
+        self.assertEqual(organisation.version, 4)
+        self.assertEqual(stale.version, 5)
+        self.assertEqual(stored_version(), 5)
 
     @classmethod
     def tearDownClass(cls):
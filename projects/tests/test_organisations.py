@@ -12,8 +12,10 @@ import json
 from urllib import urlencode
 
 from tornado import testing, options
+from mongoengine import ValidationError
 from monstor.app import make_app
-from titan.projects.models import User, Organisation
+from titan.projects.models import User, Organisation, Team
+from titan.projects.cache import get_slug_index
 from titan.settings import SETTINGS
 from monstor.utils.web import slugify
 
@@ -31,6 +33,7 @@ class TestOrganisations(testing.AsyncHTTPTestCase):
         user = User(name="Test User", email="test@example.com", active=True)
         user.set_password("password")
         user.save(safe=True)
+        self.user = user
 
     def get_login_cookie(self):
         response = self.fetch(
@@ -67,6 +70,76 @@ class TestOrganisations(testing.AsyncHTTPTestCase):
         )
         self.assertEqual(response.code, 302)
 
+    def create_organisations(self):
+        """
+        Create four organisations and return the two of them the user is
+        a member of
+        """
+        organisations = []
+        for index in xrange(4):
+            organisation = Organisation(
+                name="Organisation %d" % index, slug="org-%d" % index
+            )
+            organisation.save()
+            organisations.append(organisation)
+        for organisation in organisations[1::2]:
+            Team(
+                name="Developers", organisation=organisation,
+                members=[self.user]
+            ).save()
+        return organisations[1::2]
+
+    def test_0035_paginate_organisations(self):
+        """
+        The pages after the first one only have the organisations of the
+        user
+        """
+        member_of = self.create_organisations()
+        cookies = self.get_login_cookie()
+        headers = {
+            'Cookie': cookies, 'X-Requested-With': 'XMLHttpRequest',
+        }
+
+        response = self.fetch(
+            '/my-organisations/?limit=1', follow_redirects=False,
+            headers=headers
+        )
+        self.assertEqual(response.code, 200)
+        page = json.loads(response.body)
+        self.assertEqual(
+            [o['slug'] for o in page['result']], [member_of[0].slug]
+        )
+
+        response = self.fetch(
+            '/my-organisations/?' + urlencode({
+                'after': page['next'], 'limit': 1
+            }), follow_redirects=False, headers=headers
+        )
+        page = json.loads(response.body)
+        self.assertEqual(
+            [o['slug'] for o in page['result']], [member_of[1].slug]
+        )
+        self.assertEqual(page['next'], None)
+
+    def test_0036_paginate_organisations_html(self):
+        """
+        The HTML pages after the first one only have the organisations of
+        the user
+        """
+        member_of = self.create_organisations()
+        cookies = self.get_login_cookie()
+
+        response = self.fetch(
+            '/my-organisations/?' + urlencode({
+                'after': str(member_of[0].id), 'limit': 1
+            }), follow_redirects=False, headers={'Cookie': cookies}
+        )
+        self.assertEqual(response.code, 200)
+        self.assertTrue(
+            'organisation-%s' % member_of[1].id in response.body
+        )
+        self.assertEqual(response.body.count('class="organisation"'), 1)
+
     def test_0040_get_invalid_organisation(self):
         """
         Try to GET and org which doesnt exist and look for 302 when not logged
@@ -128,6 +201,95 @@ class TestOrganisations(testing.AsyncHTTPTestCase):
         response = json.loads(response.body)
         self.assertEqual(response, False)
 
+    def test_0065_batch_slug_verification(self):
+        """
+        Verify several slugs at once
+        """
+        organisation = Organisation(
+            name="openlabs", slug=slugify("new organisation")
+        )
+        organisation.save()
+        response = self.fetch(
+            '/+slug-check/batch', method="POST",
+            follow_redirects=False,
+            headers={
+                'Cookie': self.get_login_cookie()
+            },
+            body=urlencode([
+                ("slug", slugify("new organisation")),
+                ("slug", slugify("another organisation")),
+            ])
+        )
+        self.assertEqual(response.code, 200)
+        response = json.loads(response.body)
+        self.assertEqual(response['result'], {
+            slugify("new organisation"): False,
+            slugify("another organisation"): True,
+        })
+
+        # Deleted organisations free the slug
+        organisation.delete()
+        response = self.fetch(
+            '/+slug-check', method="POST",
+            follow_redirects=False,
+            headers={
+                'Cookie': self.get_login_cookie()
+            },
+            body=urlencode({
+                "slug": slugify("new organisation")
+            })
+        )
+        self.assertEqual(json.loads(response.body), True)
+
+    def test_0067_slug_taken_elsewhere(self):
+        """
+        A slug taken without the signals of this process, as by another
+        worker, is not available once the slug index is reloaded
+        """
+        cookies = self.get_login_cookie()
+
+        def check():
+            response = self.fetch(
+                '/+slug-check', method="POST", follow_redirects=False,
+                headers={'Cookie': cookies},
+                body=urlencode({"slug": slugify("new organisation")})
+            )
+            return json.loads(response.body)
+
+        self.assertEqual(check(), True)
+        Organisation._get_collection().insert({
+            'name': "openlabs", 'slug': slugify("new organisation"),
+        })
+        # The index answers until it expires
+        self.assertEqual(check(), True)
+        get_slug_index().clear()
+        self.assertEqual(check(), False)
+
+    def test_0068_reserved_slugs(self):
+        """
+        The paths of the application cannot be used as slugs
+        """
+        cookies = self.get_login_cookie()
+        response = self.fetch(
+            '/+slug-check/batch', method="POST",
+            follow_redirects=False, headers={'Cookie': cookies},
+            body=urlencode([("slug", "metrics"), ("slug", "my-organisations")])
+        )
+        self.assertEqual(json.loads(response.body)['result'], {
+            'metrics': False, 'my-organisations': False,
+        })
+        self.assertRaises(
+            ValidationError, Organisation(name="Metrics", slug="metrics").save
+        )
+
+        response = self.fetch(
+            '/my-organisations/', method="POST", follow_redirects=False,
+            headers={'Cookie': cookies},
+            body=urlencode({'name': 'Metrics', 'slug': 'metrics'})
+        )
+        self.assertEqual(response.code, 200)
+        self.assertEqual(Organisation.objects(slug='metrics').count(), 0)
+
     def test_0070_create_organisation_1(self):
         """
         Test for creating an organisation which is does not exists
@@ -189,6 +351,7 @@ class TestOrganisations(testing.AsyncHTTPTestCase):
         """
         from mongoengine.connection import get_connection
         get_connection().drop_database('test_titan')
+        get_slug_index().clear()
 
 
 if __name__ == '__main__':
@@ -14,7 +14,8 @@ from urllib import urlencode
 from tornado import testing, options
 from monstor.app import make_app
 from titan.projects.models import (User, Project, Organisation, Team,
-    AccessControlList)
+    AccessControlList, TaskList, Task, FollowUp)
+from titan.projects.cache import get_slug_index
 from titan.settings import SETTINGS
 from monstor.utils.web import slugify
 
@@ -225,6 +226,77 @@ class TestOrganisations(testing.AsyncHTTPTestCase):
         )
         self.assertEqual(response.code, 200)
 
+    def test_0075_projecthandler_etag(self):
+        """
+        Unchanged project pages are answered with a 304
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        team = Team(
+            name="Developers", organisation=organisation,
+            members=[self.user]
+        )
+        team.save()
+        admins = Team(name="Admins", organisation=organisation).save()
+        project = Project(
+            name="titan", organisation=organisation,
+            acl=[
+                AccessControlList(team=team, role="participant"),
+                AccessControlList(team=admins, role="admin"),
+            ],
+            slug=slugify('titan project')
+        )
+        project.save()
+        cookies = self.get_login_cookie()
+        url = '/%s/%s' % (organisation.slug, project.slug)
+
+        response = self.fetch(
+            url, method="GET", follow_redirects=False,
+            headers={'Cookie': cookies}
+        )
+        self.assertEqual(response.code, 200)
+        etag = response.headers['Etag']
+
+        response = self.fetch(
+            url, method="GET", follow_redirects=False,
+            headers={'Cookie': cookies, 'If-None-Match': etag}
+        )
+        self.assertEqual(response.code, 304)
+        self.assertEqual(response.body, '')
+
+        # The XHR response has a different ETag
+        response = self.fetch(
+            url, method="GET", follow_redirects=False,
+            headers={
+                'Cookie': cookies, 'If-None-Match': etag,
+                'X-Requested-With': 'XMLHttpRequest',
+            }
+        )
+        self.assertEqual(response.code, 200)
+
+        # A change of the project changes the ETag
+        project.name = "Titan"
+        project.save()
+        response = self.fetch(
+            url, method="GET", follow_redirects=False,
+            headers={'Cookie': cookies, 'If-None-Match': etag}
+        )
+        self.assertEqual(response.code, 200)
+        self.assertNotEqual(response.headers['Etag'], etag)
+        etag = response.headers['Etag']
+
+        # So does a change of the role of the user, which the page shows
+        admins.members = [self.user]
+        admins.save()
+        response = self.fetch(
+            url, method="GET", follow_redirects=False,
+            headers={'Cookie': cookies, 'If-None-Match': etag}
+        )
+        self.assertEqual(response.code, 200)
+        self.assertTrue('<span class="role">admin</span>' in response.body)
+
     def test_0080_projecthandler_2(self):
         """
         Test project page which does not exist
@@ -246,12 +318,279 @@ class TestOrganisations(testing.AsyncHTTPTestCase):
         )
         self.assertEqual(response.code, 404)
 
+    def test_0090_projectshandler_pagination(self):
+        """
+        Page through the projects of an organisation with the XHR API
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        team = Team(
+            name="Developers", organisation=organisation,
+            members=[self.user]
+        )
+        team.save()
+        for index in xrange(5):
+            Project(
+                name="Project %d" % index, organisation=organisation,
+                acl=[AccessControlList(team=team, role="admin")],
+                slug="project-%d" % index
+            ).save()
+
+        cookies = self.get_login_cookie()
+        names = []
+        url = '/%s/projects/?limit=2' % organisation.slug
+        while True:
+            response = self.fetch(
+                url, method="GET", follow_redirects=False,
+                headers={
+                    'Cookie': cookies,
+                    'X-Requested-With': 'XMLHttpRequest',
+                }
+            )
+            self.assertEqual(response.code, 200)
+            result = json.loads(response.body)
+            self.assertTrue(len(result['result']) <= 2)
+            names.extend(project['name'] for project in result['result'])
+            if result['next'] is None:
+                break
+            url = '/%s/projects/?limit=2&after=%s' % (
+                organisation.slug, result['next']
+            )
+        self.assertEqual(names, ["Project %d" % i for i in xrange(5)])
+
+        # Invalid cursor
+        response = self.fetch(
+            '/%s/projects/?after=invalid' % organisation.slug,
+            method="GET", follow_redirects=False,
+            headers={
+                'Cookie': cookies, 'X-Requested-With': 'XMLHttpRequest'
+            }
+        )
+        self.assertEqual(response.code, 400)
+
+    def test_0095_projectshandler_fields(self):
+        """
+        Select the fields of the projects returned by the XHR API
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        team = Team(
+            name="Developers", organisation=organisation,
+            members=[self.user]
+        )
+        team.save()
+        project = Project(
+            name="Titan", organisation=organisation, slug="titan",
+            acl=[AccessControlList(team=team, role="admin")]
+        )
+        project.save()
+
+        cookies = self.get_login_cookie()
+        for fields, expected in (
+                ('', {'id': unicode(project.id), 'name': "Titan"}),
+                ('slug,organisation,unknown', {
+                    'id': unicode(project.id), 'slug': "titan",
+                    'organisation': unicode(organisation.id),
+                })):
+            response = self.fetch(
+                '/%s/projects/?fields=%s' % (organisation.slug, fields),
+                method="GET", follow_redirects=False,
+                headers={
+                    'Cookie': cookies, 'X-Requested-With': 'XMLHttpRequest'
+                }
+            )
+            self.assertEqual(response.code, 200)
+            self.assertEqual(
+                json.loads(response.body)['result'], [expected]
+            )
+
+    def test_0100_attachments(self):
+        """
+        Upload an attachment and download it in full and by range
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        team = Team(
+            name="Developers", organisation=organisation,
+            members=[self.user]
+        )
+        team.save()
+        project = Project(
+            name="titan", organisation=organisation,
+            acl=[AccessControlList(team=team, role="admin")],
+            slug=slugify('titan project')
+        )
+        project.save()
+        cookies = self.get_login_cookie()
+        content = ''.join(chr(i % 256) for i in xrange(300 * 1024))
+
+        response = self.fetch(
+            '/%s/%s/+attachments?filename=data.bin' % (
+                organisation.slug, project.slug
+            ),
+            method="POST", body=content, follow_redirects=False,
+            headers={
+                'Cookie': cookies, 'Content-Type': 'application/octet-stream'
+            }
+        )
+        self.assertEqual(response.code, 201)
+        result = json.loads(response.body)
+        self.assertEqual(result['length'], len(content))
+        url = '/%s/%s/+attachments/%s' % (
+            organisation.slug, project.slug, result['id']
+        )
+
+        response = self.fetch(url, headers={'Cookie': cookies})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, content)
+        etag = response.headers['Etag']
+
+        response = self.fetch(
+            url, headers={'Cookie': cookies, 'If-None-Match': etag}
+        )
+        self.assertEqual(response.code, 304)
+
+        response = self.fetch(
+            url, headers={'Cookie': cookies, 'Range': 'bytes=100-199'}
+        )
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.body, content[100:200])
+        self.assertEqual(
+            response.headers['Content-Range'],
+            'bytes 100-199/%d' % len(content)
+        )
+
+        response = self.fetch(
+            url, headers={
+                'Cookie': cookies, 'Range': 'bytes=%d-' % len(content)
+            }
+        )
+        self.assertEqual(response.code, 416)
+
+    def test_0105_attachment_of_task(self):
+        """
+        Attach an upload with an unsafe name to a task
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        team = Team(
+            name="Developers", organisation=organisation,
+            members=[self.user]
+        )
+        team.save()
+        project = Project(
+            name="titan", organisation=organisation,
+            acl=[AccessControlList(team=team, role="admin")],
+            slug=slugify('titan project')
+        )
+        project.save()
+        task_list = TaskList(name="Sprint 1", project=project)
+        task_list.save()
+        task = Task(
+            title="Write tests", task_list=task_list, status="new",
+            assigned_to=self.user, watchers=[self.user]
+        )
+        task.save()
+        cookies = self.get_login_cookie()
+        url = '/%s/%s/+attachments' % (organisation.slug, project.slug)
+
+        response = self.fetch(
+            url + '?' + urlencode({
+                'filename': 'a"b;c\r\nd.txt', 'task': str(task_list.id),
+            }),
+            method="POST", body="data", follow_redirects=False,
+            headers={'Cookie': cookies, 'Content-Type': 'text/plain'}
+        )
+        self.assertEqual(response.code, 404)
+
+        response = self.fetch(
+            url + '?' + urlencode({
+                'filename': u'a"b;c\r\nd é.txt'.encode('utf-8'),
+                'task': str(task.id), 'message': 'Logs',
+            }),
+            method="POST", body="data", follow_redirects=False,
+            headers={'Cookie': cookies, 'Content-Type': 'text/plain'}
+        )
+        self.assertEqual(response.code, 201)
+        result = json.loads(response.body)
+        self.assertEqual(result['task'], str(task.id))
+        task.reload()
+        self.assertEqual(task.follow_ups[-1].message, 'Logs')
+        self.assertEqual(
+            str(task.follow_ups[-1].attachments[0].grid_id), result['id']
+        )
+
+        response = self.fetch(
+            '%s/%s' % (url, result['id']), headers={'Cookie': cookies}
+        )
+        self.assertEqual(response.code, 200)
+        self.assertEqual(
+            response.headers['Content-Disposition'],
+            'attachment; filename="a_b_c__d _.txt"; '
+            'filename*=UTF-8\'\'a_b_c__d%20%C3%A9.txt'
+        )
+
+    def test_0110_export(self):
+        """
+        Export the projects of an organisation as NDJSON and CSV
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        team = Team(
+            name="Developers", organisation=organisation,
+            members=[self.user]
+        )
+        team.save()
+        project = Project(
+            name="titan", organisation=organisation,
+            acl=[AccessControlList(team=team, role="admin")],
+            slug=slugify('titan project')
+        )
+        project.save()
+        task_list = TaskList(name="Version 0.1", project=project).save()
+        task = Task(
+            title="Design", status="new", assigned_to=self.user,
+            task_list=task_list, follow_ups=[FollowUp(message="Started")]
+        ).save()
+        cookies = self.get_login_cookie()
+
+        response = self.fetch(
+            '/%s/+export' % organisation.slug, headers={'Cookie': cookies}
+        )
+        self.assertEqual(response.code, 200)
+        records = [json.loads(line) for line in response.body.splitlines()]
+        self.assertEqual(
+            [record['type'] for record in records],
+            ['project', 'task_list', 'task', 'follow_up']
+        )
+        self.assertEqual(records[2]['id'], unicode(task.id))
+        self.assertEqual(records[2]['task_list'], unicode(task_list.id))
+        self.assertEqual(records[3]['message'], "Started")
+
+        response = self.fetch(
+            '/%s/+export?format=csv' % organisation.slug,
+            headers={'Cookie': cookies}
+        )
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(response.body.splitlines()), 5)
+
     def tearDown(self):
         """
         Drop the database after every test
         """
         from mongoengine.connection import get_connection
         get_connection().drop_database('test_project')
+        get_slug_index().clear()
 
 
 if __name__ == '__main__':
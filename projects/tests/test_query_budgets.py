@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+    test_query_budgets
+
+    Put a budget on the number of queries of every URL and fail on N+1
+    queries. The caches are cleared before each request, so the budgets
+    are those of a cold request.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import unittest
+import json
+from urllib import urlencode
+
+from tornado import testing, options
+from monstor.app import make_app
+from mongoengine.connection import get_connection
+
+from titan.projects.models import (User, Organisation, Team, Project,
+    AccessControlList, TaskList, Task, FollowUp)
+from titan.projects.cache import get_membership_cache, get_slug_index
+from titan.projects.dashboard import get_dashboard_cache
+from titan.projects.fragments import get_fragment_cache
+from titan.projects.testing import QueryAssertionsMixin
+from titan.projects.urls import HANDLERS
+from titan.settings import SETTINGS
+
+
+#: URL name to (query budget, times a query shape may repeat)
+BUDGETS = {
+    'home': (2, 1),
+    'metrics': (2, 1),
+    'projects.organisations': (7, 1),
+    'projects.organisation': (7, 1),
+    # The slug checks are answered by the slug index, loaded beforehand
+    'projects.organisations.slug-check': (3, 1),
+    'projects.organisations.slug-check-batch': (3, 1),
+    'projects.organisation.dashboard': (11, 1),
+    # The export streams the projects one by one, which queries the task
+    # lists of each project and the tasks of each task list.
+    'projects.organisation.export': (31, 10),
+    'projects.organisation.search': (8, 1),
+    'projects.projects': (7, 1),
+    'projects.project': (7, 1),
+    'projects.project.slug-check': (5, 1),
+    'projects.project.slug-check-batch': (5, 1),
+    'projects.project.attachments': (13, 2),
+    'projects.project.attachment': (11, 2),
+    'projects.project.tasks.import': (13, 2),
+    'projects.project.search': (8, 1),
+}
+
+
+class TestQueryBudgets(QueryAssertionsMixin, testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        options.options.database = 'test_query_budgets'
+        SETTINGS['xsrf_cookies'] = False
+        self.application = make_app(**SETTINGS)
+        return self.application
+
+    def setUp(self):
+        super(TestQueryBudgets, self).setUp()
+        user = User(name="Test User", email="test@example.com", active=True)
+        user.set_password("password")
+        user.save(safe=True)
+        self.organisation = Organisation(
+            name="open labs", slug="open-labs"
+        ).save()
+        team = Team(
+            name="Developers", organisation=self.organisation,
+            members=[user]
+        ).save()
+        # Several of everything, so that a query per item shows up as a
+        # repeated query
+        for index in xrange(3):
+            project = Project(
+                name="Project %d" % index, slug="project-%d" % index,
+                organisation=self.organisation,
+                acl=[AccessControlList(team=team, role="admin")]
+            ).save()
+            for task_list_index in xrange(3):
+                task_list = TaskList(
+                    name="Version %d" % task_list_index, project=project
+                ).save()
+                for task_index in xrange(3):
+                    Task(
+                        title="Deploy release %d" % task_index,
+                        task_list=task_list, assigned_to=user,
+                        follow_ups=[FollowUp(message="Deployed")],
+                    ).save()
+        self.cookies = self.get_login_cookie()
+        self.attachment_id = json.loads(self.fetch(
+            '/open-labs/project-0/+attachments?filename=test.txt',
+            method="POST", body='x' * 1024, headers={'Cookie': self.cookies}
+        ).body)['id']
+
+    def get_login_cookie(self):
+        response = self.fetch(
+            '/login', method="POST", follow_redirects=False,
+            body=urlencode({
+                'email': 'test@example.com', 'password': 'password'
+            })
+        )
+        return response.headers.get('Set-Cookie')
+
+    def get_requests(self):
+        """
+        Return a dictionary of the name of every URL to the arguments of a
+        request to it
+        """
+        url = self.application.reverse_url
+        org, project = 'open-labs', 'project-0'
+        return {
+            'home': (url('home'), {}),
+            'metrics': (url('metrics'), {}),
+            'projects.organisations': (url('projects.organisations'), {}),
+            'projects.organisation': (
+                url('projects.organisation', org), {}
+            ),
+            'projects.organisations.slug-check': (
+                url('projects.organisations.slug-check'),
+                {'method': 'POST', 'body': urlencode({'slug': 'new-org'})},
+            ),
+            'projects.organisations.slug-check-batch': (
+                url('projects.organisations.slug-check-batch'), {
+                    'method': 'POST',
+                    'body': urlencode([('slug', org), ('slug', 'new-org')]),
+                },
+            ),
+            'projects.organisation.dashboard': (
+                url('projects.organisation.dashboard', org), {}
+            ),
+            'projects.organisation.export': (
+                url('projects.organisation.export', org), {}
+            ),
+            'projects.organisation.search': (
+                url('projects.organisation.search', org) + '?q=deploy', {}
+            ),
+            'projects.projects': (url('projects.projects', org), {}),
+            'projects.project': (url('projects.project', org, project), {}),
+            'projects.project.slug-check': (
+                url('projects.project.slug-check', org), {
+                    'method': 'POST',
+                    'body': urlencode({'project_slug': project}),
+                },
+            ),
+            'projects.project.slug-check-batch': (
+                url('projects.project.slug-check-batch', org), {
+                    'method': 'POST',
+                    'body': urlencode([
+                        ('project_slug', project),
+                        ('project_slug', 'new-project'),
+                    ]),
+                },
+            ),
+            'projects.project.attachments': (
+                url('projects.project.attachments', org, project) +
+                    '?filename=budget.txt',
+                {'method': 'POST', 'body': 'x' * 1024},
+            ),
+            'projects.project.attachment': (
+                url(
+                    'projects.project.attachment', org, project,
+                    self.attachment_id
+                ), {}
+            ),
+            'projects.project.tasks.import': (
+                url('projects.project.tasks.import', org, project), {
+                    'method': 'POST',
+                    'body': '\n'.join(json.dumps({
+                        'title': 'Imported %d' % i, 'task_list': 'Version 0',
+                        'assigned_to': 'test@example.com',
+                    }) for i in xrange(10)),
+                },
+            ),
+            'projects.project.search': (
+                url('projects.project.search', org, project) + '?q=deploy',
+                {}
+            ),
+        }
+
+    def clear_caches(self):
+        get_membership_cache().clear()
+        get_dashboard_cache().clear()
+        get_fragment_cache().clear()
+        # Loaded once per slug_index_ttl, not per request
+        get_slug_index().load_organisations()
+        get_slug_index().load_projects()
+
+    def test_0010_every_url_has_a_budget(self):
+        """
+        A new URL needs a query budget
+        """
+        names = set(spec.name for spec in HANDLERS)
+        self.assertEqual(names - set(BUDGETS), set())
+        self.assertEqual(names - set(self.get_requests()), set())
+
+    def test_0020_query_budgets(self):
+        """
+        Every URL stays within its query budget, without N+1 queries
+        """
+        requests = self.get_requests()
+        for spec in HANDLERS:
+            url, kwargs = requests[spec.name]
+            budget, max_repeats = BUDGETS[spec.name]
+            self.clear_caches()
+            with self.assertQueryBudget(budget, max_repeats):
+                response = self.fetch(
+                    url, follow_redirects=False, headers={
+                        'Cookie': self.cookies,
+                        'X-Requested-With': 'XMLHttpRequest',
+                    }, **kwargs
+                )
+            self.assertTrue(
+                response.code < 400, "%s returned %d" % (
+                    spec.name, response.code
+                )
+            )
+
+    def tearDown(self):
+        get_connection().drop_database('test_query_budgets')
+        self.clear_caches()
+        get_slug_index().clear()
+        super(TestQueryBudgets, self).tearDown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+    test_search
+
+    Test the full text search of tasks
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from datetime import datetime
+
+import unittest2 as unittest
+from mongoengine import connect
+from mongoengine.connection import _get_connection
+
+from titan.projects.models import (Organisation, Team, User, Project,
+    AccessControlList, TaskList, Task, FollowUp, FollowUpRecord, ProjectRole)
+from titan.projects.search import (search_tasks, get_task_list_ids,
+    get_project_ids)
+
+
+class TestSearch(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        connect("test_search")
+
+    def setUp(self):
+        self.user = User(name="Test User", email="test@example.com")
+        self.user.set_password("password")
+        self.user.save()
+        self.organisation = Organisation(name="open labs", slug="open-labs")
+        self.organisation.save()
+        team = Team(
+            name="Developers", organisation=self.organisation,
+            members=[self.user]
+        ).save()
+        self.project = Project(
+            name="Titan", slug="titan", organisation=self.organisation,
+            acl=[AccessControlList(team=team, role="admin")]
+        ).save()
+        self.task_list = TaskList(
+            name="Version 0.1", project=self.project
+        ).save()
+        Task.ensure_indexes()
+
+    def tearDown(self):
+        for model in (User, Organisation, Team, Project, TaskList, Task,
+                FollowUpRecord, ProjectRole):
+            model.drop_collection()
+
+    def create_task(self, title, status="new", due_date=None):
+        return Task(
+            title=title, status=status, due_date=due_date,
+            assigned_to=self.user, task_list=self.task_list
+        ).save()
+
+    def test_0010_search(self):
+        """
+        Search the titles and follow ups of tasks, best match first
+        """
+        self.create_task("Fix the login page")
+        task = self.create_task("Login is slow")
+        task.add_follow_up(FollowUp(
+            message="The login query needs an index"
+        ))
+        self.create_task("Write the release notes")
+
+        task_list_ids = get_task_list_ids(
+            get_project_ids(self.organisation.id, [self.project.id])
+        )
+        self.assertEqual(task_list_ids, [self.task_list.id])
+
+        results, more = search_tasks(task_list_ids, "login")
+        self.assertFalse(more)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0]['id'], unicode(task.id))
+
+        results, more = search_tasks(task_list_ids, "index")
+        self.assertEqual(
+            [r['title'] for r in results], ["Login is slow"]
+        )
+
+        # Pagination
+        results, more = search_tasks(task_list_ids, "login", limit=1)
+        self.assertTrue(more)
+        self.assertEqual(len(results), 1)
+
+        # Tasks in other task lists are not found
+        self.assertEqual(search_tasks([], "login"), ([], False))
+
+    def test_0020_filters(self):
+        """
+        Filter the results on status and due date
+        """
+        self.create_task("Deploy the server", due_date=datetime(2012, 1, 1))
+        self.create_task(
+            "Deploy the docs", status="resolved",
+            due_date=datetime(2012, 6, 1)
+        )
+        task_list_ids = [self.task_list.id]
+
+        results, more = search_tasks(
+            task_list_ids, "deploy", status=["resolved"]
+        )
+        self.assertEqual([r['title'] for r in results], ["Deploy the docs"])
+
+        results, more = search_tasks(
+            task_list_ids, "deploy", due_before=datetime(2012, 3, 1)
+        )
+        self.assertEqual([r['title'] for r in results], ["Deploy the server"])
+
+        results, more = search_tasks(
+            task_list_ids, "deploy", assigned_to=self.user.id,
+            due_after=datetime(2012, 3, 1)
+        )
+        self.assertEqual([r['title'] for r in results], ["Deploy the docs"])
+
+    @classmethod
+    def tearDownClass(cls):
+        c = _get_connection()
+        c.drop_database('test_search')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,23 +10,49 @@ import tornado.web
 
 from .views import(OrganisationHandler, OrganisationsHandler, HomePageHandler,
     SlugVerificationHandler, ProjectsHandler, ProjectHandler,
-    ProjectSlugVerificationHandler)
+    ProjectSlugVerificationHandler, BatchSlugVerificationHandler,
+    BatchProjectSlugVerificationHandler, AttachmentsHandler,
+    AttachmentHandler, DashboardHandler, TaskImportHandler, ExportHandler,
+    SearchHandler, MetricsHandler)
 
 U = tornado.web.URLSpec
 
 HANDLERS = [
     U(r'/', HomePageHandler, name="home"),
+    U(r'/metrics', MetricsHandler, name="metrics"),
     U(r'/my-organisations/', OrganisationsHandler,
         name="projects.organisations"),
     U(r'/([a-zA-Z0-9_-]+)', OrganisationHandler,
         name="projects.organisation"),
     U(r'/\+slug-check', SlugVerificationHandler,
         name="projects.organisations.slug-check"),
+    U(r'/\+slug-check/batch', BatchSlugVerificationHandler,
+        name="projects.organisations.slug-check-batch"),
+    U(r'/([a-zA-Z0-9_-]+)/\+dashboard', DashboardHandler,
+        name="projects.organisation.dashboard"),
+    U(r'/([a-zA-Z0-9_-]+)/\+export', ExportHandler,
+        name="projects.organisation.export"),
+    U(r'/([a-zA-Z0-9_-]+)/\+search', SearchHandler,
+        name="projects.organisation.search"),
     U(r'/([a-zA-Z0-9_-]+)/projects/', ProjectsHandler,
         name="projects.projects"),
     U(r'/([a-zA-Z0-9-_]+)/([a-zA-Z0-9-_]+)', ProjectHandler,
         name="projects.project"),
     U(r'/([a-zA-Z0-9-_]+)/\+slug-check',
         ProjectSlugVerificationHandler,
-        name="projects.project.slug-check")
+        name="projects.project.slug-check"),
+    U(r'/([a-zA-Z0-9-_]+)/\+slug-check/batch',
+        BatchProjectSlugVerificationHandler,
+        name="projects.project.slug-check-batch"),
+    U(r'/([a-zA-Z0-9-_]+)/([a-zA-Z0-9-_]+)/\+attachments',
+        AttachmentsHandler,
+        name="projects.project.attachments"),
+    U(r'/([a-zA-Z0-9-_]+)/([a-zA-Z0-9-_]+)/\+attachments/([0-9a-f]{24})',
+        AttachmentHandler,
+        name="projects.project.attachment"),
+    U(r'/([a-zA-Z0-9-_]+)/([a-zA-Z0-9-_]+)/\+tasks/import',
+        TaskImportHandler,
+        name="projects.project.tasks.import"),
+    U(r'/([a-zA-Z0-9-_]+)/([a-zA-Z0-9-_]+)/\+search', SearchHandler,
+        name="projects.project.search"),
 ]
@@ -5,13 +5,368 @@
     :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import hashlib
+import unicodedata
+from datetime import datetime
+from functools import partial
+from urllib import quote
+
 import tornado
+from tornado import gen, stack_context
+from tornado.options import define, options
+from bson import ObjectId
+from gridfs import GridFS, NoFile
+from mongoengine.connection import get_db
 from wtforms import Form, TextField, StringField, SelectField
 from monstor.utils.wtforms import REQUIRED_VALIDATOR, TornadoMultiDict
-from monstor.utils.web import BaseHandler
+from monstor.utils.web import BaseHandler as MonstorBaseHandler
 from monstor.utils.i18n import _
+from mongoengine import ValidationError
+from mongoengine.fields import GridFSProxy
+
+from .models import (Organisation, Team, Project, AccessControlList, Task,
+    FollowUp, STATUS_CHOICES, RESERVED_ORGANISATION_SLUGS)
+from .cache import (get_membership, get_membership_cache, get_slug_index,
+    organisation_slugs_available, project_slugs_available)
+from .dashboard import get_dashboard_summary, get_dashboard_cache
+from .fragments import get_fragment_cache
+from .bulk import TaskImporter
+from .export import FORMATS, iter_export, read_chunk
+from .search import search_tasks, get_task_list_ids, get_project_ids
+from .serialise import ORGANISATION, PROJECT, TASK, clean, dumps
+from .records import OrganisationRecord, ProjectRecord
+from .instrumentation import (QueryStats, RequestContext,
+    log_slow_request, server_timing)
+from .metrics import get_metrics, route_name
+from . import db
+
+
+@db.wrap
+def get_user_organisation(membership, slug):
+    """
+    Return the organisation with the given slug if the user is a member of
+    it, else None.
+
+    :param membership: The :class:`~titan.projects.cache.Membership` of the
+                       user
+    """
+    organisation_id = membership.organisation_id(slug)
+    if organisation_id is None:
+        return None
+    return Organisation.objects.with_id(organisation_id)
+
+
+@db.wrap
+def get_version(document_class, query):
+    """
+    Return the id, version and update time of the first document of the
+    model matching the raw query, or None. This reads nothing else from
+    the document.
+    """
+    return document_class._get_collection().find_one(
+        query, {'version': 1, 'updated_at': 1}
+    )
+
+
+@gen.coroutine
+def check_organisation_slugs(slugs):
+    """
+    Returns a dictionary of each slug to True if it can be used for a new
+    organisation. While the slug index is fresh the answer does not need
+    the database, so it is given on the IOLoop.
+    """
+    if get_slug_index().is_fresh('organisations'):
+        raise gen.Return(organisation_slugs_available(slugs))
+    result = yield db.run(organisation_slugs_available, slugs)
+    raise gen.Return(result)
+
+
+@gen.coroutine
+def check_project_slugs(organisation_id, slugs):
+    """
+    Returns a dictionary of each slug to True if it can be used for a new
+    project in the organisation. See :func:`check_organisation_slugs`.
+    """
+    if get_slug_index().is_fresh('projects'):
+        raise gen.Return(project_slugs_available(organisation_id, slugs))
+    result = yield db.run(project_slugs_available, organisation_id, slugs)
+    raise gen.Return(result)
+
+
+@db.wrap
+def get_project(organisation_id, slug):
+    """
+    Return the project with the slug in the organisation, or None
+    """
+    return Project.objects(organisation=organisation_id, slug=slug).first()
+
+
+def get_grid_fs():
+    """
+    Return the GridFS in which the FileFields of the models are stored
+    """
+    return GridFS(get_db(), collection='fs')
+
+
+@db.wrap
+def get_attachment(project_id, file_id):
+    """
+    Return the GridOut of an attachment of the project, or None if the file
+    does not exist or belongs to another project.
+    """
+    if not ObjectId.is_valid(file_id):
+        return None
+    try:
+        grid_out = get_grid_fs().get(ObjectId(file_id))
+    except NoFile:
+        return None
+    if getattr(grid_out, 'project', None) != project_id:
+        return None
+    return grid_out
+
+
+@db.wrap
+def get_project_task(project_id, task_id):
+    """
+    Return the task with the id if it is in a task list of the project,
+    else None
+    """
+    if not ObjectId.is_valid(task_id):
+        return None
+    return Task.objects(
+        id=ObjectId(task_id), task_list__in=get_task_list_ids([project_id])
+    ).first()
+
+
+def sanitise_filename(filename):
+    """
+    Return the base name of an uploaded file without control characters,
+    quotes and semicolons, which are not safe in headers, or None if
+    nothing is left of it
+    """
+    if not filename:
+        return None
+    filename = filename.replace('\\', '/').rsplit('/', 1)[-1]
+    filename = u''.join(
+        u'_' if char in u'"\';' or unicodedata.category(char)[0] == 'C'
+        else char for char in unicode(filename)
+    ).strip(u' .')
+    return filename[:255] or None
+
+
+def content_disposition(filename):
+    """
+    Return the value of the Content-Disposition header of a download. The
+    name is given in the RFC 6266 `filename*` form, with an ASCII fallback
+    for older clients.
+    """
+    filename = sanitise_filename(filename)
+    if filename is None:
+        return 'attachment'
+    fallback = filename.encode('ascii', 'replace').replace('?', '_')
+    return 'attachment; filename="%s"; filename*=UTF-8\'\'%s' % (
+        fallback, quote(filename.encode('utf-8'), safe='')
+    )
+
+
+def parse_byte_range(header, size):
+    """
+    Parse the value of a Range header for a resource of `size` bytes and
+    return the (start, end) offsets with end exclusive, or None if the
+    range cannot be satisfied.
+
+    Only a single range is supported, a ValueError is raised for anything
+    else and the header should then be ignored.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        raise ValueError("Unsupported range %s" % header)
+    start, _, end = spec.strip().partition('-')
+    if not start:
+        # Suffix range: the last `end` bytes
+        length = int(end)
+        if length <= 0:
+            return None
+        return max(size - length, 0), size
+    start = int(start)
+    end = int(end) + 1 if end else size
+    if start >= size or end <= start:
+        return None
+    return start, min(end, size)
+
+
+@db.wrap
+def get_teams(organisation):
+    """
+    Return the list of teams in the organisation
+    """
+    return list(organisation.teams)
+
+
+define(
+    "max_attachment_size", default=100 * 1024 * 1024, type=int,
+    help="Maximum size of an uploaded attachment in bytes"
+)
+define(
+    "max_import_size", default=256 * 1024 * 1024, type=int,
+    help="Maximum size of the body of a bulk task import in bytes"
+)
+
+
+class BaseHandler(MonstorBaseHandler):
+    """
+    Base handler for the projects app
+    """
+
+    def _execute(self, transforms, *args, **kwargs):
+        """
+        Serve the request with its :attr:`query_stats` as the current stats
+        whenever a callback of the request runs, so that the queries it
+        makes are counted
+        """
+        #: The :class:`~titan.projects.instrumentation.QueryStats` of the
+        #: request
+        self.query_stats = QueryStats(options.slow_statements)
+        metrics = get_metrics()
+        metrics.start_lag_monitor()
+        metrics.request_started()
+        self._in_flight = True
+        with stack_context.StackContext(
+                partial(RequestContext, self.query_stats)):
+            return super(BaseHandler, self)._execute(
+                transforms, *args, **kwargs
+            )
+
+    def finish(self, chunk=None):
+        """
+        Add the Server-Timing header with the time spent in queries, in
+        debug mode
+        """
+        stats = getattr(self, 'query_stats', None)
+        if stats is not None and self.settings.get('debug'):
+            self.set_header(
+                'Server-Timing', server_timing(self.request, stats)
+            )
+        return super(BaseHandler, self).finish(chunk)
+
+    def record_request(self, status):
+        """
+        Record the end of the request in the metrics, only once: a request
+        whose client went away may still finish later.
+        """
+        if not getattr(self, '_in_flight', False):
+            return
+        self._in_flight = False
+        get_metrics().request_finished(
+            route_name(self.application, type(self), self.request.path),
+            self.request.method, status, self.request.request_time(),
+            self.query_stats
+        )
+
+    def on_finish(self):
+        stats = getattr(self, 'query_stats', None)
+        if stats is not None:
+            log_slow_request(self.request, stats)
+        self.record_request(self.get_status())
+        super(BaseHandler, self).on_finish()
+
+    def on_connection_close(self):
+        """
+        Record the request as ended with the status 499 (client closed
+        request), as it may never finish
+        """
+        self.record_request(499)
+        super(BaseHandler, self).on_connection_close()
+
+    def get_membership(self):
+        """
+        Return a future for the membership of the current user. The value is
+        looked up once per request and shared by every caller.
+        """
+        if getattr(self, '_membership', None) is None:
+            self._membership = db.run(get_membership, self.current_user.id)
+        return self._membership
+
+    @gen.coroutine
+    def get_member_project(self, organisation_slug, project_slug,
+            roles=None):
+        """
+        Return the project if the current user has a role in it, and one of
+        `roles` when given. Raises a 404 if the project is not accessible
+        and a 403 if the role is not sufficient.
+        """
+        membership = yield self.get_membership()
+        organisation_id = membership.organisation_id(organisation_slug)
+        if organisation_id is None:
+            raise tornado.web.HTTPError(404)
+        project = yield get_project(organisation_id, project_slug)
+        if project is None or project.id not in membership.project_roles:
+            raise tornado.web.HTTPError(404)
+        if roles is not None and \
+                membership.project_roles[project.id] not in roles:
+            raise tornado.web.HTTPError(403)
+        raise gen.Return(project)
+
+    #: Number of documents in a page when the limit is not specified
+    default_page_size = 50
+
+    #: Maximum number of documents a page can have
+    max_page_size = 200
 
-from .models import User, Organisation, Team, Project, AccessControlList
+    def get_page_arguments(self):
+        """
+        Returns the `after` cursor and `limit` arguments of a paginated
+        listing.
+        """
+        after = self.get_argument('after', None)
+        if after is not None and not ObjectId.is_valid(after):
+            raise tornado.web.HTTPError(400)
+        try:
+            limit = int(self.get_argument('limit', self.default_page_size))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        if limit < 1:
+            raise tornado.web.HTTPError(400)
+        return after, min(limit, self.max_page_size)
+
+    def get_serialiser(self, serialiser):
+        """
+        Returns the serialiser of the fields selected by the `fields`
+        argument, a comma separated list of field names.
+        """
+        fields = self.get_argument('fields', None)
+        if not fields:
+            return serialiser
+        return serialiser.select(fields.split(','))
+
+    def check_version_etag(self, *parts):
+        """
+        Set a strong ETag computed from the parts, which should include the
+        versions of the documents the response is built from, and return
+        True if the request's If-None-Match matches it. The response is
+        then a 304 and nothing else needs to be done.
+
+        The ETag also covers the user and whether the request is an XHR,
+        as the responses vary with both.
+        """
+        etag = hashlib.sha1(
+            repr((self.current_user.id, self.is_xhr) + parts)
+        ).hexdigest()
+        self.set_header('Etag', '"%s"' % etag)
+        self.set_header('Cache-Control', 'private, no-cache')
+        self.set_header('Vary', 'Cookie, X-Requested-With')
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+        return False
+
+    def write_json(self, value):
+        """
+        Write a value made of the basic types (see
+        :func:`~titan.projects.serialise.clean`) as the JSON response
+        """
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(dumps(value))
 
 
 class HomePageHandler(BaseHandler):
@@ -30,12 +385,32 @@ class OrganisationForm(Form):
     slug = StringField("slug", [REQUIRED_VALIDATOR])
 
 
+class MetricsHandler(BaseHandler):
+    """
+    The metrics of the process in the Prometheus text format. See
+    :mod:`titan.projects.metrics`.
+    """
+
+    def get(self):
+        if self.request.remote_ip not in options.metrics_hosts:
+            raise tornado.web.HTTPError(403)
+        self.set_header(
+            'Content-Type', 'text/plain; version=0.0.4; charset=utf-8'
+        )
+        self.write('\n'.join(get_metrics().samples({
+            'membership': get_membership_cache().stats(),
+            'dashboard': get_dashboard_cache().stats(),
+            'fragment': get_fragment_cache().stats(),
+        }, db.backlog())) + '\n')
+
+
 class SlugVerificationHandler(BaseHandler):
     """
     A handler that should help AJAX implementation of checking if a slug can
     be used for the organisation.
     """
     @tornado.web.authenticated
+    @gen.coroutine
     def post(self):
         """
         Accept a string and check if any existing organisation uses that
@@ -45,13 +420,35 @@ class SlugVerificationHandler(BaseHandler):
         literals which can be safely `eval`ed
         """
         slug = self.get_argument("slug")
-        organisation = Organisation.objects(slug=slug).first()
-        if not organisation:
+        result = yield check_organisation_slugs([slug])
+        if result[slug]:
             self.write('true')
         else:
             self.write('false')
 
 
+class BatchSlugVerificationHandler(BaseHandler):
+    """
+    Check several candidate slugs for an organisation in one request.
+    """
+
+    #: Maximum number of slugs which can be checked in one request
+    max_slugs = 50
+
+    @tornado.web.authenticated
+    @gen.coroutine
+    def post(self):
+        """
+        Accept one or more `slug` arguments and return a JSON object of
+        each slug to true if it can be used.
+        """
+        slugs = self.get_arguments("slug")
+        if not slugs or len(slugs) > self.max_slugs:
+            raise tornado.web.HTTPError(400)
+        result = yield check_organisation_slugs(slugs)
+        self.write({'result': result})
+
+
 class OrganisationsHandler(BaseHandler):
     """
     A Collections Handler
@@ -59,54 +456,61 @@ class OrganisationsHandler(BaseHandler):
 
     @tornado.web.authenticated
     @tornado.web.addslash
+    @gen.coroutine
     def get(self):
         """
         The organisations of the current user
         """
-        current_user = User.objects.with_id(self.current_user.id)
-        user_orgs = current_user.organisations
+        after, limit = self.get_page_arguments()
+        membership = yield self.get_membership()
+        queryset = Organisation.objects(id__in=membership.organisation_ids)
 
         if self.is_xhr:
-            self.write({
-                'result': [
-                    {
-                        'id': o.id,
-                        'name': o.name,
-                    } for o in user_orgs
-                ]
-            })
+            serialiser = self.get_serialiser(ORGANISATION)
+            records, next_cursor = yield db.run(
+                serialiser.find, queryset._query, after, limit
+            )
+            self.write_json({'result': records, 'next': next_cursor})
         else:
+            user_orgs, next_cursor = yield db.run(
+                OrganisationRecord.find, queryset._query, after, limit
+            )
             self.render(
                 'projects/organisations.html', organisations=user_orgs,
-                form=OrganisationForm()
+                form=OrganisationForm(), next=next_cursor
             )
         return
 
     @tornado.web.authenticated
     @tornado.web.addslash
+    @gen.coroutine
     def post(self):
         """
         Accept the form fields and create new organisation under current user.
         """
         form = OrganisationForm(TornadoMultiDict(self))
-        organisation = Organisation.objects(slug=form.slug.data).first()
+        organisation = yield db.run(
+            lambda: Organisation.objects(slug=form.slug.data).first()
+        )
         if organisation:
             self.flash(
                 _(
                     "An organisation with the same short code already exists."
                 ), 'Warning'
             )
+        elif form.slug.data in RESERVED_ORGANISATION_SLUGS:
+            self.flash(_("This short code is reserved."), 'Warning')
         elif form.validate():
             organisation = Organisation(
                 name = form.name.data,
                 slug = form.slug.data
             )
-            organisation.save()
+            yield db.run(organisation.save)
             team = Team(
                 name="Administrators", organisation=organisation,
                 memebers=[self.current_user]
             )
-            team.save()
+            yield db.run(team.save)
             self.flash(
                 _("Created a new organisation %(name)s",
                     name=organisation.name
@@ -116,7 +520,10 @@ class OrganisationsHandler(BaseHandler):
                 self.reverse_url('projects.organisation', organisation.slug)
             )
             return
-        self.render("projects/organisations.html", organisation_form=form)
+        self.render(
+            "projects/organisations.html", organisations=[], form=form,
+            next=None
+        )
 
 
 class OrganisationHandler(BaseHandler):
@@ -126,16 +533,25 @@ class OrganisationHandler(BaseHandler):
 
     @tornado.web.authenticated
     @tornado.web.removeslash
+    @gen.coroutine
     def get(self, slug):
         """
         Render organisation page
         """
-        current_user = User.objects.with_id(self.current_user.id)
-        for organisation in current_user.organisations:
-            if organisation.slug == slug:
-                break
-        else:
+        membership = yield self.get_membership()
+        organisation_id = membership.organisation_id(slug)
+        if organisation_id is None:
             raise tornado.web.HTTPError(404)
+        version = yield get_version(Organisation, {'_id': organisation_id})
+        if version is None:
+            raise tornado.web.HTTPError(404)
+        if self.check_version_etag(
+                'organisation', organisation_id, version.get('version'),
+                version.get('updated_at')):
+            return
+        organisation = yield db.run(
+            Organisation.objects.with_id, organisation_id
+        )
 
         # Response
         if self.is_xhr:
@@ -150,6 +566,71 @@ class OrganisationHandler(BaseHandler):
         return
 
 
+class DashboardHandler(BaseHandler):
+    """
+    Overview of the projects and tasks of an organisation
+    """
+
+    @tornado.web.authenticated
+    @gen.coroutine
+    def get(self, organisation_slug):
+        """
+        Render the dashboard of the organisation: its projects, the number
+        of tasks in each status, overdue tasks and the open tasks of each
+        assignee.
+        """
+        membership = yield self.get_membership()
+        organisation_id = membership.organisation_id(organisation_slug)
+        if organisation_id is None:
+            raise tornado.web.HTTPError(404)
+        dashboard = yield db.run(get_dashboard_summary, organisation_id)
+
+        if self.is_xhr:
+            self.write_json(clean(dashboard))
+        else:
+            self.render(
+                'projects/dashboard.html', dashboard=dashboard,
+                status_choices=STATUS_CHOICES,
+                organisation_slug=organisation_slug
+            )
+
+
+class ExportHandler(BaseHandler):
+    """
+    Export the projects of an organisation with their task lists, tasks
+    and follow ups, as NDJSON or CSV
+    """
+
+    @tornado.web.authenticated
+    @gen.coroutine
+    def get(self, organisation_slug):
+        """
+        Stream the export of the projects which the user has a role in. The
+        format is given by the `format` argument (ndjson or csv).
+        """
+        export_format = self.get_argument('format', 'ndjson')
+        if export_format not in FORMATS:
+            raise tornado.web.HTTPError(400)
+        membership = yield self.get_membership()
+        organisation_id = membership.organisation_id(organisation_slug)
+        if organisation_id is None:
+            raise tornado.web.HTTPError(404)
+
+        self.set_header('Content-Type', FORMATS[export_format])
+        self.set_header('Content-Disposition', content_disposition(
+            '%s.%s' % (organisation_slug, export_format)
+        ))
+        iterator = iter_export(
+            organisation_id, export_format, membership.project_roles.keys()
+        )
+        while True:
+            chunk = yield db.run(read_chunk, iterator)
+            if not chunk:
+                break
+            self.write(chunk)
+            yield self.flush()
+
+
 class ProjectForm(Form):
     """
     Generate form for creating a project
@@ -165,66 +646,80 @@ class ProjectsHandler(BaseHandler):
     """
     @tornado.web.authenticated
     @tornado.web.addslash
+    @gen.coroutine
     def get(self, organisation_slug):
         """
         Projects under the current organisations
         """
-        for organisation in self.current_user.organisations:
-            if organisation.slug == organisation_slug:
-                break
-        else:
+        after, limit = self.get_page_arguments()
+        membership = yield self.get_membership()
+        # Only the id of the organisation is needed, which the membership
+        # already has.
+        organisation_id = membership.organisation_id(organisation_slug)
+        if organisation_id is None:
             raise tornado.web.HTTPError(404)
+        # The version of the organisation changes with its projects and
+        # teams, which is all this page shows.
+        version = yield get_version(Organisation, {'_id': organisation_id})
+        if version is None:
+            raise tornado.web.HTTPError(404)
+        if self.check_version_etag(
+                'projects', organisation_id, version.get('version'),
+                version.get('updated_at'), after, limit,
+                self.get_argument('fields', None)):
+            return
 
-        projects = Project.objects(organisation=organisation).all()
+        queryset = Project.objects(organisation=organisation_id)
         if self.is_xhr:
-            self.write({
-                'result': [
-                    {
-                        'id': project.id,
-                        'name': project.name,
-                    } for project in projects
-                ]
-            })
+            serialiser = self.get_serialiser(PROJECT)
+            records, next_cursor = yield db.run(
+                serialiser.find, queryset._query, after, limit
+            )
+            self.write_json({'result': records, 'next': next_cursor})
         else:
+            projects, next_cursor = yield db.run(
+                ProjectRecord.find, queryset._query, after, limit
+            )
             form=ProjectForm()
+            teams = yield db.run(
+                lambda: list(Team.objects(organisation=organisation_id))
+            )
             form.team.choices = [
-                (unicode(team.id), team.name) for team in organisation.teams
+                (unicode(team.id), team.name) for team in teams
             ]
             self.render(
-                'projects/projects.html', projects=projects, form=form
+                'projects/projects.html', projects=projects, form=form,
+                next=next_cursor, roles=membership.project_roles,
+                organisation_slug=organisation_slug
             )
         return
 
     @tornado.web.authenticated
+    @gen.coroutine
     def post(self, organisation_slug):
         """
         Accept the form fields and create a new project under the
         current Organisation
         """
         form = ProjectForm(TornadoMultiDict(self))
-        for organisation in self.current_user.organisations:
-            if organisation.slug == organisation_slug:
-                break
-        else:
+        membership = yield self.get_membership()
+        organisation = yield get_user_organisation(
+            membership, organisation_slug
+        )
+        if organisation is None:
             raise tornado.web.HTTPError(404)
 
+        teams = yield get_teams(organisation)
         form.team.choices = [
-            (unicode(team.id), team.name) for team in organisation.teams
+            (unicode(team.id), team.name) for team in teams
         ]
 
-        existing = Project.objects(
-            slug=form.slug.data, organisation=organisation
-        ).first()
-        if existing:
-            self.flash(
-                _(
-                    "A project with the same short code already exists with\
-                    in current organisation."
-                ), 'Warning'
+        if form.validate():
+            admin_team = yield db.run(Team.objects().with_id, form.team.data)
+            is_member = yield db.run(
+                lambda: self.current_user in admin_team.members
             )
-        elif form.validate():
-            admin_team = Team.objects().with_id(form.team.data)
-            if self.current_user not in admin_team.members:
+            if not is_member:
                 self.flash(
                     _(
                         "You are not an administrator. Only administrators can\
@@ -234,26 +729,53 @@ class ProjectsHandler(BaseHandler):
                 self.send_error(403)
                 return
             acl_admin = AccessControlList(team=admin_team, role="admin")
-            project = Organisation(
+            project = Project(
                 name = form.name.data,
                 acl = [acl_admin],
                 slug = form.slug.data,
                 organisation = organisation
             )
-            project.save()
-            self.flash(
-                _("Created a new project %(name)s",
-                    name=project.name
-                ), "info"
-            )
-            self.redirect(
-                self.reverse_url(
-                    'projects.project', organisation.slug,
-                    project.slug
+            try:
+                # The unique index on (organisation, slug) decides if the
+                # slug is taken, there is no read before the write.
+                yield db.run(project.save)
+            except ValidationError as exc:
+                if exc.field_name != 'slug':
+                    raise
+                duplicate = True
+            else:
+                self.flash(
+                    _("Created a new project %(name)s",
+                        name=project.name
+                    ), "info"
+                )
+                self.redirect(
+                    self.reverse_url(
+                        'projects.project', organisation.slug,
+                        project.slug
+                    )
                 )
+                return
+        else:
+            # The form is shown again anyway, so also tell the user if the
+            # slug is taken.
+            duplicate = yield db.run(
+                lambda: Project.objects(
+                    slug=form.slug.data, organisation=organisation
+                ).only('id').first() is not None
             )
-            return
-        self.render("projects/projects.html", form=form)
+        if duplicate:
+            self.flash(
+                _(
+                    "A project with the same short code already exists with\
+                    in current organisation."
+                ), 'Warning'
+            )
+        self.render(
+            "projects/projects.html", projects=[], form=form, next=None,
+            roles=membership.project_roles,
+            organisation_slug=organisation_slug
+        )
 
 
 class ProjectSlugVerificationHandler(BaseHandler):
@@ -262,6 +784,7 @@ class ProjectSlugVerificationHandler(BaseHandler):
     be used for the project under current organisation.
     """
     @tornado.web.authenticated
+    @gen.coroutine
     def post(self, organisation_slug):
         """
         Accept a string and check if any existing project under current
@@ -271,38 +794,71 @@ class ProjectSlugVerificationHandler(BaseHandler):
         literals which can be safely `eval`ed
         """
         project_slug = self.get_argument("project_slug")
-        for organisation in self.current_user.organisations:
-            if organisation.slug == organisation_slug:
-                break
-        else:
+        membership = yield self.get_membership()
+        organisation_id = membership.organisation_id(organisation_slug)
+        if organisation_id is None:
             raise tornado.web.HTTPError(404)
-        project = Project.objects(
-            slug=project_slug,
-            organisation=organisation
-        ).first()
-        if not project:
+        result = yield check_project_slugs(organisation_id, [project_slug])
+        if result[project_slug]:
             self.write('true')
         else:
             self.write('false')
 
 
+class BatchProjectSlugVerificationHandler(BaseHandler):
+    """
+    Check several candidate project slugs under an organisation in one
+    request.
+    """
+
+    #: Maximum number of slugs which can be checked in one request
+    max_slugs = 50
+
+    @tornado.web.authenticated
+    @gen.coroutine
+    def post(self, organisation_slug):
+        """
+        Accept one or more `project_slug` arguments and return a JSON object
+        of each slug to true if it can be used.
+        """
+        slugs = self.get_arguments("project_slug")
+        if not slugs or len(slugs) > self.max_slugs:
+            raise tornado.web.HTTPError(400)
+        membership = yield self.get_membership()
+        organisation_id = membership.organisation_id(organisation_slug)
+        if organisation_id is None:
+            raise tornado.web.HTTPError(404)
+        result = yield check_project_slugs(organisation_id, slugs)
+        self.write({'result': result})
+
+
 class ProjectHandler(BaseHandler):
     """
     Handle a particular project
     """
     @tornado.web.authenticated
+    @gen.coroutine
     def get(self, organisation_slug, project_slug):
         """
         Render project page
         """
-        for organisation in self.current_user.organisations:
-            if organisation.slug == organisation_slug:
-                break
-        else:
+        membership = yield self.get_membership()
+        organisation_id = membership.organisation_id(organisation_slug)
+        if organisation_id is None:
+            raise tornado.web.HTTPError(404)
+        version = yield get_version(Project, Project.objects(
+            organisation=organisation_id, slug=project_slug
+        )._query)
+        if version is None:
             raise tornado.web.HTTPError(404)
-        project = Project.objects(
-            slug=project_slug, organisation=organisation
-        ).first()
+        # The page shows the role of the user, which changes with the
+        # teams without changing the project
+        role = membership.project_roles.get(version['_id'])
+        if self.check_version_etag(
+                'project', version['_id'], version.get('version'),
+                version.get('updated_at'), role):
+            return
+        project = yield db.run(Project.objects.with_id, version['_id'])
         if not project:
             raise tornado.web.HTTPError(404)
 
@@ -314,6 +870,282 @@ class ProjectHandler(BaseHandler):
             })
         else:
             self.render(
-                'projects/project.html', project=project
+                'projects/project.html', project=project,
+                role=role, organisation_slug=organisation_slug
             )
         return
+
+
+@tornado.web.stream_request_body
+class AttachmentsHandler(BaseHandler):
+    """
+    Upload an attachment to a project.
+
+    The body of the request is written to GridFS as it arrives, so the
+    whole file is never held in memory. The file name is taken from the
+    `filename` query argument and the content type from the request.
+
+    With a `task` argument, the file is attached to a new follow up of
+    that task, whose message is the `message` argument. Files which are
+    not attached to a follow up are removed by `titand
+    remove_orphan_attachments`.
+    """
+
+    #: Roles in the project which can upload attachments
+    upload_roles = ('admin', 'participant')
+
+    @gen.coroutine
+    def prepare(self):
+        self.grid_in = None
+        self.task = None
+        if not self.current_user:
+            raise tornado.web.HTTPError(403)
+        organisation_slug, project_slug = self.path_args
+        project = yield self.get_member_project(
+            organisation_slug, project_slug, self.upload_roles
+        )
+        task_id = self.get_argument('task', None)
+        if task_id is not None:
+            self.task = yield get_project_task(project.id, task_id)
+            if self.task is None:
+                raise tornado.web.HTTPError(404)
+
+        self.request.connection.set_max_body_size(options.max_attachment_size)
+        self.grid_in = yield db.run(
+            get_grid_fs().new_file,
+            filename=sanitise_filename(self.get_argument('filename', None)),
+            content_type=self.request.headers.get(
+                'Content-Type', 'application/octet-stream'
+            ),
+            project=project.id,
+        )
+
+    def data_received(self, chunk):
+        # Returning the future makes tornado wait for the write before
+        # reading more of the body.
+        return db.run(self.grid_in.write, chunk)
+
+    @gen.coroutine
+    def post(self, organisation_slug, project_slug):
+        """
+        Finish the upload, attach the file to the task if one was given
+        and return the id of the file
+        """
+        yield db.run(self.grid_in.close)
+        result = {
+            'id': unicode(self.grid_in._id),
+            'length': self.grid_in.length,
+        }
+        if self.task is not None:
+            yield db.run(self.task.add_follow_up, FollowUp(
+                message=self.get_argument('message', None),
+                attachments=[GridFSProxy(self.grid_in._id)],
+            ))
+            result['task'] = unicode(self.task.id)
+        self.set_status(201)
+        self.write(result)
+
+    def on_connection_close(self):
+        """
+        Remove the chunks of an incomplete upload
+        """
+        super(AttachmentsHandler, self).on_connection_close()
+        if self.grid_in is not None and not self.grid_in.closed:
+            db.run(get_grid_fs().delete, self.grid_in._id)
+
+
+class AttachmentHandler(BaseHandler):
+    """
+    Download an attachment of a project.
+
+    The file is read from GridFS and written out one chunk at a time.
+    Single byte ranges and conditional requests with If-None-Match are
+    supported. Files in GridFS are never modified, so the file id is used
+    as the ETag.
+    """
+
+    #: Number of bytes read from GridFS and flushed to the client at a time
+    chunk_size = 255 * 1024
+
+    @tornado.web.authenticated
+    @gen.coroutine
+    def get(self, organisation_slug, project_slug, file_id,
+            include_body=True):
+        project = yield self.get_member_project(
+            organisation_slug, project_slug
+        )
+        grid_out = yield get_attachment(project.id, file_id)
+        if grid_out is None:
+            raise tornado.web.HTTPError(404)
+
+        self.set_header('Etag', '"%s"' % file_id)
+        self.set_header('Accept-Ranges', 'bytes')
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        size = grid_out.length
+        start, end = 0, size
+        if 'Range' in self.request.headers:
+            try:
+                byte_range = parse_byte_range(
+                    self.request.headers['Range'], size
+                )
+            except ValueError:
+                byte_range = (start, end)
+            if byte_range is None:
+                self.set_status(416)
+                self.set_header('Content-Range', 'bytes */%d' % size)
+                return
+            if byte_range != (0, size):
+                start, end = byte_range
+                self.set_status(206)
+                self.set_header(
+                    'Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size)
+                )
+
+        self.set_header(
+            'Content-Type', grid_out.content_type or 'application/octet-stream'
+        )
+        if grid_out.filename:
+            self.set_header(
+                'Content-Disposition', content_disposition(grid_out.filename)
+            )
+        self.set_header('Content-Length', end - start)
+        if not include_body:
+            return
+
+        yield db.run(grid_out.seek, start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = yield db.run(
+                grid_out.read, min(self.chunk_size, remaining)
+            )
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            self.write(chunk)
+            yield self.flush()
+
+    def head(self, organisation_slug, project_slug, file_id):
+        return self.get(
+            organisation_slug, project_slug, file_id, include_body=False
+        )
+
+
+@tornado.web.stream_request_body
+class TaskImportHandler(BaseHandler):
+    """
+    Create and update tasks of a project in bulk from an NDJSON body. See
+    :mod:`titan.projects.bulk` for the format of the lines.
+
+    The body is parsed as it arrives and written in batches, so the size of
+    the import does not affect the memory used. The response is a JSON
+    summary with the errors of individual lines.
+    """
+
+    #: Roles in the project which can import tasks
+    import_roles = ('admin', 'participant')
+
+    #: Number of tasks written in one bulk operation
+    batch_size = 1000
+
+    @gen.coroutine
+    def prepare(self):
+        self.importer = None
+        self.buffer = ''
+        if not self.current_user:
+            raise tornado.web.HTTPError(403)
+        organisation_slug, project_slug = self.path_args
+        project = yield self.get_member_project(
+            organisation_slug, project_slug, self.import_roles
+        )
+        self.request.connection.set_max_body_size(options.max_import_size)
+        self.importer = TaskImporter(project, self.batch_size)
+
+    def process(self, lines):
+        """
+        Feed complete lines to the importer, writing full batches
+        """
+        for line in lines:
+            if self.importer.feed(line):
+                self.importer.flush()
+
+    def data_received(self, chunk):
+        lines = (self.buffer + chunk).split('\n')
+        self.buffer = lines.pop()
+        # Returning the future makes tornado wait for the batch to be
+        # written before reading more of the body.
+        return db.run(self.process, lines)
+
+    @gen.coroutine
+    def post(self, organisation_slug, project_slug):
+        """
+        Write the remaining lines and return the summary
+        """
+        yield db.run(self.process, [self.buffer])
+        yield db.run(self.importer.flush)
+        self.write(self.importer.result())
+
+
+class SearchHandler(BaseHandler):
+    """
+    Full text search of the tasks in an organisation or a project
+    """
+
+    @tornado.web.authenticated
+    @gen.coroutine
+    def get(self, organisation_slug, project_slug=None):
+        """
+        Search for the text in the `q` argument in the tasks of the
+        projects the user has a role in, or of one project. The results
+        can be filtered by `status` (repeatable), `assigned_to` (user id),
+        `due_before` and `due_after` (YYYY-MM-DD), and are paginated with
+        `offset` and `limit`. The `fields` argument selects the fields of
+        the tasks in the results.
+        """
+        text = self.get_argument('q')
+        statuses = self.get_arguments('status')
+        assigned_to = self.get_argument('assigned_to', None)
+        if assigned_to is not None and not ObjectId.is_valid(assigned_to):
+            raise tornado.web.HTTPError(400)
+        try:
+            due_before, due_after = [
+                datetime.strptime(value, '%Y-%m-%d') if value else None
+                for value in (
+                    self.get_argument('due_before', None),
+                    self.get_argument('due_after', None),
+                )
+            ]
+            offset = max(int(self.get_argument('offset', 0)), 0)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        limit = self.get_page_arguments()[1]
+
+        membership = yield self.get_membership()
+        organisation_id = membership.organisation_id(organisation_slug)
+        if organisation_id is None:
+            raise tornado.web.HTTPError(404)
+        if project_slug is not None:
+            project = yield self.get_member_project(
+                organisation_slug, project_slug
+            )
+            project_ids = [project.id]
+        else:
+            project_ids = yield db.run(
+                get_project_ids, organisation_id,
+                membership.project_roles.keys()
+            )
+
+        task_list_ids = yield db.run(get_task_list_ids, project_ids)
+        results, more = yield db.run(
+            search_tasks, task_list_ids, text, status=statuses,
+            assigned_to=assigned_to and ObjectId(assigned_to),
+            due_before=due_before, due_after=due_after,
+            offset=offset, limit=limit,
+            serialiser=self.get_serialiser(TASK)
+        )
+        self.write_json({
+            'result': results,
+            'next': offset + len(results) if more else None,
+        })
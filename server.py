@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+    server
+
+    Run titan in one or more processes sharing the listening socket.
+
+    With more than one worker, a master process binds the socket and forks
+    the workers. Each worker builds the application, and so its own
+    connection to MongoDB, after the fork. The master respawns workers
+    which die, waiting longer between respawns while they keep failing.
+    SIGTERM or SIGINT to the master shuts down every worker.
+
+    On SIGHUP the master executes itself again, so that the code deployed
+    since it started is loaded, handing the listening sockets and its
+    workers to the new process through the environment. The new master
+    forks workers running the new code and then stops the old ones, so no
+    connection is refused during the restart.
+
+    Every worker has its own caches, which its signals only invalidate in
+    that process. The cached memberships and dashboards are therefore
+    checked against the versions of the organisations and task lists in
+    the database before use, the fragments are keyed by the versions of
+    their documents, so no worker serves data another worker changed. The
+    slug index only answers the advisory slug checks and is reloaded every
+    `slug_index_ttl` seconds; the unique indexes decide on save.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import time
+import errno
+import fcntl
+import signal
+import socket
+import logging
+
+from tornado import ioloop, netutil, process
+from tornado.platform.auto import set_close_exec
+from tornado.httpserver import HTTPServer
+from tornado.options import define, options
+from monstor.app import make_app
+
+from titan.projects.metrics import get_metrics
+
+
+define(
+    "workers", default=1, type=int,
+    help="Number of worker processes. 0 starts one per CPU"
+)
+define(
+    "worker_max_restarts", default=100, type=int,
+    help="Number of times dead workers are respawned before giving up"
+)
+define(
+    "worker_respawn_delay", default=1.0, type=float,
+    help="Seconds before a dead worker is respawned. The delay doubles, up "
+        "to a minute, while the workers die within a minute of starting"
+)
+define(
+    "shutdown_timeout", default=10, type=int,
+    help="Seconds a worker waits for open connections before exiting"
+)
+
+#: Environment variable with the file descriptor and address family of
+#: each socket a restarting master hands to the new one
+SOCKETS_ENV = 'TITAN_SOCKETS'
+
+#: Environment variable with the process ids of the workers a restarting
+#: master hands to the new one to stop
+WORKERS_ENV = 'TITAN_WORKERS'
+
+
+def inherit_sockets():
+    """
+    Return the listening sockets handed over by the master this process
+    replaced, or None if the process was not started by a restart
+    """
+    value = os.environ.pop(SOCKETS_ENV, None)
+    if not value:
+        return None
+    sockets = []
+    for item in value.split(','):
+        fd, family = [int(part) for part in item.split(':')]
+        sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+        # fromfd duplicates the descriptor
+        os.close(fd)
+        set_close_exec(sock.fileno())
+        sock.setblocking(0)
+        sockets.append(sock)
+    return sockets
+
+
+def run_worker(sockets, settings):
+    """
+    Serve the application on the given sockets until SIGTERM is received.
+
+    The requests in flight are given `shutdown_timeout` seconds to finish
+    after the socket is closed.
+    """
+    application = make_app(**settings)
+
+    server = HTTPServer(application)
+    server.add_sockets(sockets)
+    io_loop = ioloop.IOLoop.instance()
+
+    def stop_when_idle(deadline):
+        if get_metrics().in_flight > 0 and time.time() < deadline:
+            io_loop.add_timeout(
+                time.time() + 0.1, lambda: stop_when_idle(deadline)
+            )
+            return
+        io_loop.stop()
+
+    def shutdown():
+        server.stop()
+        stop_when_idle(time.time() + options.shutdown_timeout)
+
+    signal.signal(
+        signal.SIGTERM,
+        lambda signum, frame: io_loop.add_callback_from_signal(shutdown)
+    )
+    io_loop.start()
+
+
+class Master(object):
+    """
+    Fork and supervise the worker processes
+    """
+
+    #: Seconds between checks for dead workers and signals
+    poll_interval = 0.5
+
+    #: Maximum seconds between the respawns of failing workers
+    max_respawn_delay = 60
+
+    #: Workers which die within this many seconds of starting make the
+    #: next respawn wait longer
+    failure_window = 60
+
+    def __init__(self, sockets, settings, workers, retiring=()):
+        self.sockets = sockets
+        self.settings = settings
+        self.workers = workers
+        #: Process id of each worker to the time it was started
+        self.children = dict((pid, time.time()) for pid in retiring)
+        #: Workers of the master this one replaced, stopped once the new
+        #: workers are started
+        self.retiring = set(retiring)
+        self.restarts = 0
+        #: Number of workers in a row which died soon after starting
+        self.failures = 0
+        #: Times at which dead workers are to be respawned
+        self.respawns = []
+        self.stopping = False
+        self.reload = False
+
+    def respawn_delay(self):
+        """
+        Return the seconds to wait before respawning a worker, doubled for
+        every worker in a row which died soon after starting
+        """
+        return min(
+            options.worker_respawn_delay * 2 ** min(self.failures, 16),
+            self.max_respawn_delay
+        )
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            # Worker
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                run_worker(self.sockets, self.settings)
+            except Exception:
+                logging.exception("Worker %d failed", os.getpid())
+                os._exit(1)
+            os._exit(0)
+        self.children[pid] = time.time()
+        return pid
+
+    def signal_children(self, signum, pids=None):
+        for pid in (self.children if pids is None else pids):
+            try:
+                os.kill(pid, signum)
+            except OSError as exc:
+                if exc.errno != errno.ESRCH:
+                    raise
+
+    def reexec(self):
+        """
+        Replace the master with a new process running the code currently
+        deployed, which is handed the listening sockets and the workers.
+        Only returns if the execution fails.
+        """
+        for sock in self.sockets:
+            flags = fcntl.fcntl(sock.fileno(), fcntl.F_GETFD)
+            fcntl.fcntl(
+                sock.fileno(), fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC
+            )
+        os.environ[SOCKETS_ENV] = ','.join(
+            '%d:%d' % (sock.fileno(), sock.family) for sock in self.sockets
+        )
+        os.environ[WORKERS_ENV] = ','.join(
+            str(pid) for pid in self.children
+        )
+        try:
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+        except OSError:
+            del os.environ[SOCKETS_ENV]
+            del os.environ[WORKERS_ENV]
+            for sock in self.sockets:
+                set_close_exec(sock.fileno())
+            raise
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def handle_reload(self, signum, frame):
+        self.reload = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+
+        for _ in xrange(self.workers):
+            self.spawn()
+
+        # Workers being replaced during a graceful restart. These are not
+        # respawned when they exit.
+        retiring = self.retiring
+        self.signal_children(signal.SIGTERM, retiring)
+        stopped = False
+        while self.children or self.respawns:
+            if self.stopping and not stopped:
+                stopped = True
+                self.respawns = []
+                self.signal_children(signal.SIGTERM)
+            if self.reload and not stopped:
+                self.reload = False
+                try:
+                    self.reexec()
+                except OSError:
+                    logging.exception(
+                        "Could not execute the master again, replacing the "
+                        "workers with the code already loaded"
+                    )
+                # The new workers replace the ones waiting to be respawned
+                self.respawns = []
+                old = set(self.children)
+                for _ in xrange(self.workers):
+                    self.spawn()
+                retiring |= old
+                self.signal_children(signal.SIGTERM, old)
+            now = time.time()
+            while self.respawns and self.respawns[0] <= now and \
+                    not stopped:
+                self.respawns.pop(0)
+                self.spawn()
+            # Poll so that the flags set by the signal handlers are seen
+            # even when no worker exits.
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                if exc.errno == errno.ECHILD:
+                    self.children.clear()
+                    time.sleep(self.poll_interval)
+                    continue
+                raise
+            if pid == 0:
+                time.sleep(self.poll_interval)
+                continue
+            started = self.children.pop(pid, None)
+            if pid in retiring:
+                retiring.discard(pid)
+                continue
+            if stopped:
+                continue
+            self.restarts += 1
+            if self.restarts > options.worker_max_restarts:
+                logging.error("Too many worker restarts, shutting down")
+                self.stopping = True
+                continue
+            if started is not None and \
+                    time.time() - started > self.failure_window:
+                self.failures = 0
+            delay = self.respawn_delay()
+            self.failures += 1
+            logging.warning(
+                "Worker %d exited with status %d, respawning in %.1fs",
+                pid, status, delay
+            )
+            self.respawns.append(time.time() + delay)
+        return 1 if self.restarts > options.worker_max_restarts else 0
+
+
+def serve(settings):
+    """
+    Serve titan on `options.port` with `options.workers` processes
+    """
+    sockets = inherit_sockets()
+    if sockets is None:
+        sockets = netutil.bind_sockets(
+            options.port, address=options.address
+        )
+    retiring = [
+        int(pid) for pid in os.environ.pop(WORKERS_ENV, '').split(',') if pid
+    ]
+    workers = options.workers or process.cpu_count()
+    if workers == 1 and not retiring:
+        run_worker(sockets, settings)
+        return 0
+    return Master(sockets, settings, workers, retiring).run()
+
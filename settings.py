@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from pkg_resources import resource_filename
 
+from titan.projects.fragments import Fragment
+
 SETTINGS = {
     'installed_apps': [
         'monstor.contrib.auth',
@@ -8,5 +10,6 @@ SETTINGS = {
     ],
     'cookie_secret': 'N7qxweo0malDySdP',
     'template_path': resource_filename('titan', 'templates'),
-    'login_url': '/login'
+    'login_url': '/login',
+    'ui_modules': {'Fragment': Fragment},
 }
@@ -27,6 +27,8 @@ setup(
     },
     install_requires = [
         'monstor',
+        'futures',
+        'blinker',
     ],
     scripts = [
         'bin/titand',